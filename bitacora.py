@@ -0,0 +1,152 @@
+"""
+Daemon Log (syslog_core.txt)
+Lines are queued and written by a background thread in batches, with
+size-based rotation. Whether logging is on (the logging.enabled flag file)
+is checked once and refreshed on SIGHUP or by refrescar(), so with logging
+off a call costs one attribute check.
+
+Processes forked from the daemon (pool workers, background workers) don't
+inherit the writer thread: they write their lines directly, under flock.
+
+The debug stack keeps raw (time, parts) tuples and formats them only when
+it's dumped.
+
+SnmpQuery - Network Discovery and Monitoring Tool
+Copyright (C) 2025 Agustin Garcia Maiztegui
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+"""
+
+import atexit
+import fcntl
+import os
+import queue
+import signal
+import threading
+import time
+from collections import deque
+
+FORMATO_STAMP = "%d/%m/%Y %H:%M:%S - "
+
+
+def _stamp(momento):
+    return time.strftime(FORMATO_STAMP, time.localtime(momento))
+
+
+class Bitacora:
+    """Queue-backed log file. Only the process that created it runs the writer thread."""
+
+    def __init__(self, archivo, flag, maxBytes=10 * 1024 * 1024, copias=3):
+        self.archivo = str(archivo)
+        self.flag = str(flag)
+        self.maxBytes = maxBytes
+        self.copias = copias
+        self.habilitado = False
+        self._pid = os.getpid()
+        self._cola = queue.SimpleQueue()
+        self._hilo = None
+        self.refrescar()
+
+    def refrescar(self, *_senal):
+        """Re-checks the flag file. Also usable as a signal handler."""
+        self.habilitado = os.path.exists(self.flag)
+
+    def escucharSenal(self, senal=signal.SIGHUP):
+        """`kill -HUP <pid>` after creating/removing the flag file applies it right away."""
+        signal.signal(senal, self.refrescar)
+
+    def configurar(self, maxBytes, copias):
+        self.maxBytes = int(maxBytes)
+        self.copias = int(copias)
+
+    def escribir(self, texto):
+        """Queues one line (the stamp is taken now). Returns 0, or -1 if it could not be written."""
+        if not self.habilitado:
+            return 0
+        if os.getpid() != self._pid:
+            return self._escribirDirecto([(time.time(), texto)])
+        if self._hilo is None:
+            self._iniciar()
+        self._cola.put((time.time(), texto))
+        return 0
+
+    def cerrar(self):
+        """Writes whatever is still queued and stops the writer."""
+        if self._hilo is not None and os.getpid() == self._pid:
+            self._cola.put(None)
+            self._hilo.join(timeout=5)
+            self._hilo = None
+
+    # ------------------------------------------------------------------------
+
+    def _iniciar(self):
+        self._hilo = threading.Thread(target=self._escritor, name="bitacora", daemon=True)
+        self._hilo.start()
+        atexit.register(self.cerrar)
+
+    def _escritor(self):
+        while True:
+            lote = [self._cola.get()]
+            # Everything already waiting goes in the same write.
+            while True:
+                try:
+                    lote.append(self._cola.get_nowait())
+                except queue.Empty:
+                    break
+            fin = None in lote
+            lineas = [linea for linea in lote if linea is not None]
+            if lineas:
+                self._escribirDirecto(lineas)
+                self._rotarSiHaceFalta()
+            if fin:
+                return
+
+    def _escribirDirecto(self, lineas):
+        texto = "".join(_stamp(momento) + linea + "\n" for momento, linea in lineas)
+        try:
+            with open(self.archivo, "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.write(texto)
+                f.flush()
+                fcntl.flock(f, fcntl.LOCK_UN)
+            return 0
+        except Exception as e:
+            print("There was an error attempting to read/write the syslog (!)")
+            print(e)
+            return -1
+
+    def _rotarSiHaceFalta(self):
+        # syslog_core.txt -> .1 -> .2 ... -> .copias (the oldest is dropped).
+        try:
+            if self.maxBytes <= 0 or os.path.getsize(self.archivo) < self.maxBytes:
+                return
+            for i in range(self.copias - 1, 0, -1):
+                if os.path.exists(self.archivo + "." + str(i)):
+                    os.replace(self.archivo + "." + str(i), self.archivo + "." + str(i + 1))
+            if self.copias > 0:
+                os.replace(self.archivo, self.archivo + ".1")
+            else:
+                os.remove(self.archivo)
+        except OSError:
+            pass
+
+
+# ============================================================================
+# DEBUG STACK
+# ============================================================================
+
+class PilaDebug(deque):
+    """
+    Ring of the last `maxlen` (time, parts) entries. The parts are joined and
+    stamped only when the stack is read (iterating gives the formatted lines).
+    """
+
+    def agregar(self, *partes):
+        self.append((time.time(), partes))
+
+    def __iter__(self):
+        for momento, partes in deque.__iter__(self):
+            yield _stamp(momento) + "".join(str(parte) for parte in partes).rstrip()
@@ -41,12 +41,19 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
 
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
-from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required
-import sqlite3
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, Response, g, send_from_directory, abort
+from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from datetime import datetime
+import itertools
+import json
 import pathlib
 import funciones
+import metricas
+import memoria
+import trazas
+import perfilador
+import os
+import time
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -66,9 +73,19 @@ login_manager.login_view = 'login'
 # Paths - ADJUST THESE to match your setup
 RAMDISK_DB = "/ramdisk/snmpqserver.db"
 BASE_DIR = pathlib.Path(__file__).resolve().parent
-histDBPath = BASE_DIR / "historicaldata.db"
-histDB = sqlite3.connect(histDBPath, isolation_level=None)
-HISTORIC_DB = str(histDBPath)  # Adjust to your BASE_DIR / "historicaldata.db"
+
+
+# Web metrics, served by /metrics together with the files dumped by the other processes (see metricas.py)
+registro = metricas.Registro("web")
+mPeticion = registro.histograma("web_request_seconds", "Web request latency, by endpoint.")
+mErrores = registro.contador("web_errors_total", "Web responses with status >= 500, by endpoint.")
+# Who may scrape /metrics: METRICS_ALLOW, re-read every 30 s rather than on every scrape.
+#  Unset, only this host; "*" lets everyone in.
+METRICS_LOCAL = ('127.0.0.1', '::1')
+_metricsAllow = {'leido': 0.0, 'ips': METRICS_LOCAL}
+
+# On-demand profiling of the next N requests, started from /profiles (see perfilador.py)
+elPerfil = perfilador.Perfilador("web")
 
 
 # Simple user database (replace with your own system)
@@ -110,6 +127,30 @@ def load_user(user_id):
     return None
 
 
+# ============================================================================
+# REQUEST METRICS AND PROFILING
+# ============================================================================
+
+@app.before_request
+def empezar_medicion():
+    g.inicio_peticion = time.perf_counter()
+    g.perfil = elPerfil.iniciar()
+
+@app.after_request
+def terminar_medicion(response):
+    inicio = g.get('inicio_peticion')
+    if inicio is not None:
+        endpoint = request.endpoint or 'unknown'
+        mPeticion.observe(time.perf_counter() - inicio, endpoint=endpoint)
+        if response.status_code >= 500:
+            mErrores.inc(endpoint=endpoint)
+    return response
+
+@app.teardown_request
+def terminar_perfil(_error):
+    # teardown also runs when the view raised, so a profiled request never leaves the profiler on.
+    elPerfil.finalizar(g.pop('perfil', None))
+
 # ============================================================================
 # QUERY PARSER (adapted from your interpretarDireccion)
 # ============================================================================
@@ -131,6 +172,14 @@ def parse_query(query_string):
     cmd = parts[0].lower()
     params = parts[1:]
     
+    if cmd == 'diff':
+        return parse_diff(parts[1:])
+    
+    # History: "ip|mac <address> at <time>" or "ip|mac <address> between <time> and <time>".
+    historico = parse_history(parts)
+    if historico is not None:
+        return historico
+    
     # Import COMMANDS from your functions.py
     # TODO: Replace this with: from functions import COMMANDS
     # For now, using a local definition
@@ -150,6 +199,78 @@ def parse_query(query_string):
     
     return (None, None, f"Unknown command or invalid input: '{query_string}'")
 
+def parse_when(texto):
+    """Epoch seconds, ISO date/time (2026-10-10T14:05, '2026-10-10 14:05') or 'now'. None if invalid."""
+    texto = texto.strip()
+    if texto.lower() == "now":
+        return datetime.now().timestamp()
+    try:
+        return float(texto)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(texto).timestamp()
+    except ValueError:
+        return None
+
+def parse_history(parts):
+    """
+    History variants of ip/mac (the command word is optional):
+        mac aa-bb-cc-dd-ee-ff at 2026-10-10T14:05
+        ip 10.1.2.3 between 2026-10-01 and 2026-10-02T08:00
+    Returns parse_query's tuple, or None if it's not a history query.
+    "at" gives (address, moment, None): the search widens it by HISTORY_GAP, so parsing never reads the DB.
+    """
+    palabras = [p.lower() for p in parts]
+    if "at" not in palabras and "between" not in palabras:
+        return None
+    if palabras[0] in ('ip', 'mac'):
+        parts = parts[1:]
+        palabras = palabras[1:]
+    if len(parts) < 3:
+        return (None, None, "Usage: ip|mac <address> at <time> | between <time> and <time>")
+    tipo, direccion = interpretarDireccion(parts[0])
+    if tipo == 'mac' and not funciones.standarizeFullMAC(direccion[0]):
+        return (None, None, "History searches need a full MAC address")
+    if tipo is None:
+        return (None, None, f"Invalid IP or MAC address: '{parts[0]}'")
+    if palabras[1] == "at":
+        desde = parse_when(" ".join(parts[2:]))
+        if desde is None:
+            return (None, None, f"Invalid time: '{' '.join(parts[2:])}'")
+        hasta = None
+    elif palabras[1] == "between" and "and" in palabras[3:]:
+        corte = palabras.index("and", 3)
+        desde = parse_when(" ".join(parts[2:corte]))
+        hasta = parse_when(" ".join(parts[corte + 1:]))
+        if desde is None or hasta is None:
+            return (None, None, "Invalid time range")
+        if desde > hasta:
+            desde, hasta = hasta, desde
+    else:
+        return (None, None, "Usage: ip|mac <address> at <time> | between <time> and <time>")
+    return (tipo + 'Hist', (direccion[0], desde, hasta), None)
+
+def parse_diff(params):
+    """
+    diff <time>                    -> from <time> to now (live tables)
+    diff <time> to|and <time>      -> between two points of the history
+    """
+    uso = (None, None, "Usage: diff <time> [to <time>]")
+    if not params:
+        return uso
+    palabras = [p.lower() for p in params]
+    corte = next((i for i, p in enumerate(palabras) if p in ('to', 'and')), None)
+    if corte is None:
+        desde, hasta = parse_when(" ".join(params)), None
+    else:
+        desde, hasta = parse_when(" ".join(params[:corte])), parse_when(" ".join(params[corte + 1:]))
+        if hasta is None:
+            return uso
+    if desde is None:
+        return uso
+    return ('diff', (desde, hasta), None)
+
 def interpretarDireccion(cmd):
     """Your existing IP/MAC detection logic"""
     # 1. Is it an IP?
@@ -163,7 +284,7 @@ def interpretarDireccion(cmd):
             pass
     
     # 2. Is it a full MAC?
-    posibleMac = funciones.sanitizeMac(cmd)
+    posibleMac = funciones.sanitizeMAC(cmd)
     mac_address_std = funciones.standarizeFullMAC(posibleMac)
     if mac_address_std:
         return ("mac", (mac_address_std,))
@@ -295,7 +416,10 @@ def query():
             'map': funciones.mapSwitch,
             'report': funciones.report,
             'ip': funciones.ipSearch,
-            'mac': lambda mac: funciones.macSearch(mac) if funciones.standarizeFullMAC(mac) else funciones.macSearchPart(mac)
+            'mac': lambda mac: funciones.macSearch(mac) if funciones.standarizeFullMAC(mac) else funciones.macSearchPart(mac),
+            'ipHist': funciones.ipSearchHist,
+            'macHist': funciones.macSearchHist,
+            'diff': funciones.diffRed
         }
         
         # Execute the command
@@ -311,7 +435,13 @@ def query():
         # Sort Results.
         show_netflow = False
         netflow_data = None
-        if (cmd_name == "ip" or cmd_name == "mac"):
+        if cmd_name in ("ipHist", "macHist"):
+            # Past positions: no NetFlow for them.
+            devices, aps = result
+            devices = sorted( devices, key=lambda d: (d[1], int(d[2])) )
+            result = (devices, aps)
+        
+        elif (cmd_name == "ip" or cmd_name == "mac"):
             # es ip, mac ó mac parcial.
             devices, aps = result
             devices = sorted( devices, key=lambda d: (d[1], int(d[2])) )
@@ -345,9 +475,12 @@ def query():
             'map': 'mapSwitch',
             'report': 'report',
             'ip': 'ipSearch',
-            'mac': 'macSearch'
+            'mac': 'macSearch',
+            'ipHist': 'ipSearch',
+            'macHist': 'macSearch'
         }
         return render_template('results.html',
+                             diff_columns=funciones.DIFF_SECCIONES,
                              query=query_string,
                              query_type=query_type_map.get(cmd_name, cmd_name),
                              result=result,
@@ -397,6 +530,186 @@ def api_query():
             'error': 'An internal error occurred while processing the request.'
         }), 500
 
+@app.route('/api/topology')
+@login_required
+def api_topology():
+    """Full switch tree as JSON. The ETag is the topology signature, so
+    clients polling with If-None-Match get a 304 until the tree changes."""
+    firma = funciones.topologyETag()
+    if firma is not None and firma in request.if_none_match:
+        respuesta = Response(status=304)
+        respuesta.set_etag(firma)
+        return respuesta
+    try:
+        firma, arbol = funciones.topologyTree()
+    except Exception as e:
+        logging.error(f"Error in topologyTree: {str(e)}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'error': 'An internal error occurred while processing the request.'
+        }), 500
+    respuesta = jsonify({
+        'success': True,
+        'signature': firma,
+        'tree': arbol
+    })
+    if firma is not None:
+        respuesta.set_etag(firma)
+    respuesta.headers['Cache-Control'] = 'private, no-cache'
+    return respuesta
+
+@app.route('/api/diff')
+@login_required
+def api_diff():
+    """What changed between ?from= and ?to= (epoch or ISO time, 'to' defaults
+    to now / live tables). Streamed as funciones.diffRedFilas produces the rows:
+    a JSON object of sections, each a list of objects (columns in
+    funciones.DIFF_SECCIONES). "success" comes last, once every row is out:
+    if the history fails mid-stream the sections are partial, and the object
+    ends with "success": false, "partial": true and "error". Clients must
+    check "success" rather than the HTTP status (already 200 by then)."""
+    desde = parse_when(request.args.get('from', ''))
+    hasta = request.args.get('to')
+    if hasta is not None:
+        hasta = parse_when(hasta)
+    if desde is None or (request.args.get('to') is not None and hasta is None):
+        return jsonify({
+            'success': False,
+            'error': "Invalid 'from' or 'to' time"
+        }), 400
+    # The first row is taken here: a DB that can't be opened or read still gets a proper 500.
+    filas = funciones.diffRedFilas(desde, hasta)
+    try:
+        primera = next(filas, None)
+    except Exception as e:
+        logging.error(f"Error in diffRed: {str(e)}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'error': 'An internal error occurred while processing the request.'
+        }), 500
+    
+    def generar():
+        yield '{"from": ' + json.dumps(desde) + ', "to": ' + json.dumps(hasta)
+        secciones = list(funciones.DIFF_SECCIONES)
+        abiertas = 0        # sections already opened (they come in DIFF_SECCIONES order)
+        hayFila = False
+        error = False
+        try:
+            for seccion, fila in itertools.chain([primera] if primera else [], filas):
+                indice = secciones.index(seccion)
+                while abiertas <= indice:
+                    yield (']' if abiertas else '') + ', ' + json.dumps(secciones[abiertas]) + ': ['
+                    abiertas += 1
+                    hayFila = False
+                yield (', ' if hayFila else '') + json.dumps(dict(zip(funciones.DIFF_SECCIONES[seccion], fila)))
+                hayFila = True
+        except Exception as e:
+            # Too late for a status code: the object is closed as a failed, partial answer.
+            logging.error(f"Error in diffRed: {str(e)}", exc_info=True)
+            error = True
+        while abiertas < len(secciones):
+            yield (']' if abiertas else '') + ', ' + json.dumps(secciones[abiertas]) + ': ['
+            abiertas += 1
+        yield ']'
+        if error:
+            yield ', "success": false, "partial": true, "error": "An internal error occurred while processing the request."}'
+        else:
+            yield ', "success": true}'
+    
+    return Response(generar(), mimetype='application/json')
+
+@app.route('/traces')
+@login_required
+def traces():
+    """Last daemon cycles as a waterfall, plus the slowest switches and phases (see trazas.py)."""
+    cantidad = request.args.get('n', 10, type=int)
+    try:
+        ciclos = trazas.ultimosCiclos(max(1, min(cantidad, 50)))
+        lentosSwitch = trazas.masLentos("switch")
+        lentosFase = trazas.masLentos("phase")
+        lentosEtapa = trazas.masLentos("stage")
+        error = None
+    except Exception as e:
+        logging.error(f"Error reading traces: {str(e)}", exc_info=True)
+        ciclos, lentosSwitch, lentosFase, lentosEtapa = [], [], [], []
+        error = "Traces are not available (is snmpPyServer.py running?)"
+    return render_template('traces.html',
+                         ciclos=ciclos,
+                         lentos_switch=lentosSwitch,
+                         lentos_fase=lentosFase,
+                         lentos_etapa=lentosEtapa,
+                         error=error,
+                         history=get_query_history(),
+                         format_timestamp=format_timestamp)
+
+@app.route('/profiles', methods=['GET', 'POST'])
+@login_required
+def profiles():
+    """Start a profile (admin only) and browse the top functions of the saved ones."""
+    mensaje = None
+    if request.method == 'POST':
+        if current_user.id != 'admin':
+            abort(403)
+        cantidad = max(1, min(request.form.get('count', 3, type=int), 1000))
+        if request.form.get('target') == 'core':
+            # The daemon picks the request up at the start of its next cycle.
+            perfilador.pedirPorArchivo("core", cantidad)
+            mensaje = f"snmpPyServer.py will profile its next {cantidad} cycles."
+        else:
+            elPerfil.pedir(cantidad)
+            mensaje = f"The next {cantidad} web requests will be profiled."
+    archivos = [os.path.basename(ruta) for ruta in perfilador.listar()]
+    elegido = request.args.get('file')
+    if elegido not in archivos:
+        elegido = archivos[0] if archivos else None
+    orden = 'cumtime' if request.args.get('sort') == 'cumtime' else 'tottime'
+    funciones_top = []
+    if elegido:
+        funciones_top = perfilador.topFunciones(os.path.join(perfilador.DIR_PERFILES, elegido), 40, orden)
+    return render_template('profiles.html',
+                         archivos=archivos,
+                         elegido=elegido,
+                         orden=orden,
+                         funciones_top=funciones_top,
+                         pendientes=elPerfil.pendientes,
+                         mensaje=mensaje,
+                         history=get_query_history())
+
+@app.route('/profiles/download/<nombre>')
+@login_required
+def profiles_download(nombre):
+    """Raw .pstats / .collapsed file."""
+    if not (nombre.endswith('.pstats') or nombre.endswith('.collapsed')):
+        abort(404)
+    return send_from_directory(perfilador.DIR_PERFILES, nombre, as_attachment=True)
+
+def metrics_allow():
+    """Client IPs allowed on /metrics (None: any), from METRICS_ALLOW."""
+    ahora = time.time()
+    if ahora - _metricsAllow['leido'] > 30:
+        laDB = funciones.conectarDB(RAMDISK_DB)
+        try:
+            valor = funciones.leerDBenSQL(laDB, "METRICS_ALLOW")
+        finally:
+            laDB.close()
+        ips = tuple(ip.strip() for ip in (valor or '').split(',') if ip.strip())
+        _metricsAllow['ips'] = None if '*' in ips else (ips or METRICS_LOCAL)
+        _metricsAllow['leido'] = ahora
+    return _metricsAllow['ips']
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus/OpenMetrics scrape endpoint: this process, the
+    metrics_*.prom files of the daemon, the netflow processor and the
+    collector, and every process's memory report (memoria.py). No login
+    (scrapers can't use one), so only the client IPs in METRICS_ALLOW get
+    in; until it is set, only localhost."""
+    permitidas = metrics_allow()
+    if permitidas is not None and request.remote_addr not in permitidas:
+        return Response("forbidden\n", status=403, mimetype='text/plain')
+    texto = metricas.unirFamilias([registro.exportar(), metricas.leerVolcados(), memoria.exportarMetricas()])
+    return Response(texto, content_type=metricas.TIPO_CONTENIDO)
+
 # ============================================================================
 # MAIN
 # ============================================================================
@@ -19,21 +19,26 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 # MAIN and Auxiliary Functions.
-import subprocess
-from subprocess import PIPE
-import re
 import time
 import os
 import sqlite3
-from html import escape
+import hashlib
+import heapq
+import pathlib
 from services import get_service_name
+import oui
+import historico
+import memoria
 
 
 
+# Vendor (OUI) file and the IEEE registry CSVs it is built from. See oui.py.
+OUI_DIR = pathlib.Path(__file__).resolve().parent / "oui"
+OUI_BIN = OUI_DIR / "oui.bin"
+# History partitions (see historico.py).
+HIST_DIR = pathlib.Path(__file__).resolve().parent / "historico"
 
 
-vendors_regex = re.compile(r'^([0-9A-Fa-f\-]+)\s*\(hex\)\s*(.+)$')
-
 
 # --------------------------------------------------------------------------------
 # --------------------------------------------------------------------------------
@@ -426,6 +431,66 @@ def sanitizeMAC(algoMac):
 
 
 
+# Vendor file (see oui.py), memory-mapped once per process and reopened when it's replaced.
+_vendores = {"base": None, "archivo": None}
+
+
+
+def macAEntero(unaMAC):
+    # aa-bb-cc-dd-ee-ff (or with ":"/".") to a 48 bit integer. None if it's not a whole MAC.
+    if(unaMAC is None):
+        return None
+    hexa = unaMAC.replace("-", "").replace(":", "").replace(".", "")
+    if(len(hexa) != 12):
+        return None
+    try:
+        return int(hexa, 16)
+    except ValueError:
+        return None
+
+
+
+def macVendor(unaMAC):
+    # Longest prefix match: MA-S, then MA-M, then MA-L. Also available in SQL as macVendor() (see conectarDB).
+    numero = macAEntero(unaMAC)
+    if( (numero is None) or (_vendores["base"] is None) ):
+        return None
+    return _vendores["base"].buscar(numero)
+
+
+
+def cargarVendores():
+    # (Re)opens the vendor file if it appeared or was replaced since the last time. Just a stat() otherwise.
+    try:
+        estado = os.stat(OUI_BIN)
+    except OSError:
+        return
+    elArchivo = (estado.st_ino, estado.st_mtime)
+    if(elArchivo == _vendores["archivo"]):
+        return
+    laBase = oui.abrir(str(OUI_BIN))
+    if(laBase is not None):
+        _vendores["base"] = laBase
+        _vendores["archivo"] = elArchivo
+
+
+
+def conectarDB(ruta="/ramdisk/snmpqserver.db"):
+    # Connection to the ramdisk DB, with the usual PRAGMAs and our SQL functions registered.
+    laDB = sqlite3.connect(ruta, isolation_level=None)
+    laDB.execute("PRAGMA journal_mode=WAL;")
+    laDB.execute("PRAGMA synchronous=NORMAL;")
+    cargarVendores()
+    laDB.create_function("macVendor", 1, macVendor, deterministic=True)
+    return laDB
+
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------
+
+
+
 def validarMacParcial(unaParte):
     unaParte = unaParte.replace(":", "-")
     chars_unaParte = list(unaParte)
@@ -499,51 +564,6 @@ def standarizeFullMAC(posibleMac):
 
 
 
-def updateVendors(laDB):
-    localCur = laDB.cursor()
-    comando = "wget -P /ramdisk/ https://standards-oui.ieee.org/"
-    try:
-        os.remove("/ramdisk/index.html")
-        print("index.html (vendors) deleted.")
-    except Exception:
-        print("index.html not deleted.")
-        pass
-    proceso2 = subprocess.Popen(comando, shell=True, close_fds=True, stdout=PIPE)
-    proceso2.communicate()[0]
-    with open("/ramdisk/index.html","r") as volatil:
-        bodoque = volatil.readlines()
-        lineasHex = []
-        for cadaRenglon in bodoque:
-            if("(hex)" in cadaRenglon):
-                escapada = escape(cadaRenglon)
-                lineasHex.append(escapada)
-    if(len(lineasHex)>50):
-        # We've got the 'hex' lines:
-        # A0-59-11   (hex)		Cisco Meraki
-        # 8-31-39   (hex)		zte corporation
-        lasRows = []
-        for linea in lineasHex:
-            elMatch = vendors_regex.match(linea)
-            if elMatch:
-                hex_part = elMatch.group(1)
-                description = elMatch.group(2)
-                lasRows.append((hex_part.lower(), description))
-        localCur.execute("BEGIN")
-        localCur.execute("DELETE FROM vendor")
-        localCur.executemany("""
-            INSERT INTO vendor (halfMac, elVendor)
-            VALUES (?, ?)
-        """, lasRows)
-        laDB.commit()
-        
-
-
-
-# ---------------------------------------------------------------------------------------------------------------------
-# ---------------------------------------------------------------------------------------------------------------------
-
-
-
 def extraerVariable(linea):
     caracteres = 0
     while( (linea[caracteres:caracteres+1] != '=') and (caracteres < 100) ):
@@ -575,80 +595,32 @@ def leerDBenSQL(laDB, variable):
 
 
 
+def leerDBenSQLnum(laDB, variable, porDefecto):
+    # Same as leerDBenSQL, for numeric settings. Missing or invalid values give porDefecto.
+    try:
+        return float(leerDBenSQL(laDB, variable))
+    except (TypeError, ValueError):
+        return porDefecto
+
+
+
+def agregarColumna(laDB, tabla, columna, tipo):
+    # Adds a column to an existing table, if it is not there yet (tables created by older versions).
+    localCur = laDB.cursor()
+    columnas = [row[1] for row in localCur.execute("PRAGMA table_info("+tabla+")")]
+    if( columna not in columnas ):
+        localCur.execute("ALTER TABLE "+tabla+" ADD COLUMN "+columna+" "+tipo)
+
+
+
 # ---------------------------------------------------------------------------------------------------------------------
 # ---------------------------------------------------------------------------------------------------------------------
 
 
 
 def crearTablasHistoricas(histDB):
-    localCur = histDB.cursor()
-    #
-    localCur.execute("""
-        CREATE TABLE IF NOT EXISTS arp (
-            stamp TEXT,
-            ifNameA TEXT,
-            laVlan TEXT,
-            ipaddr TEXT,
-            macaddr TEXT
-        )
-    """)
-    localCur.execute("""
-        CREATE TABLE IF NOT EXISTS hostname (
-            stamp TEXT,
-            ipaddr TEXT,
-            hostname TEXT
-        )
-    """)
-    localCur.execute("""
-        CREATE TABLE IF NOT EXISTS switch (
-            stamp TEXT,
-            switchIP TEXT,
-            switchMAC TEXT,
-            switchDesc TEXT,
-            switchStatus TEXT
-        )
-    """)
-    localCur.execute("""
-        CREATE TABLE IF NOT EXISTS macaddress (
-            stamp TEXT,
-            switchIP TEXT,
-            unaVLAN TEXT,
-            unaMAC TEXT,
-            unPuerto TEXT
-        )
-    """)
-    localCur.execute("""
-        CREATE TABLE IF NOT EXISTS switchHijosPadre (
-            stamp TEXT,
-            switchPadre TEXT,
-            portPadre TEXT,
-            switchHijo TEXT
-        )
-    """)
-    localCur.execute("""
-        CREATE TABLE IF NOT EXISTS siteData (
-            stamp TEXT,
-            parametro TEXT,
-            valor TEXT
-        )
-    """)
-    localCur.execute("""
-        CREATE TABLE IF NOT EXISTS accessPoints (
-            stamp TEXT,
-            apMac TEXT,
-            apNombre TEXT
-        )
-    """)
-    localCur.execute("""
-        CREATE TABLE IF NOT EXISTS switchPort (
-            stamp TEXT,
-            switchIP TEXT,
-            portNum TEXT,
-            portDesc TEXT,
-            portType TEXT,
-            isRoot TEXT
-        )
-    """)
+    # History is kept as validity intervals (first_seen, last_seen), see historico.py.
+    historico.crearTablas(histDB)
 
 
 
@@ -658,9 +630,7 @@ def crearTablasHistoricas(histDB):
 
 
 def report(elSwitch):
-    diskDB = sqlite3.connect("/ramdisk/snmpqserver.db", isolation_level=None)
-    diskDB.execute("PRAGMA journal_mode=WAL;")
-    diskDB.execute("PRAGMA synchronous=NORMAL;")
+    diskDB = conectarDB()
     diskCur = diskDB.cursor()
     # HEADER: switch information. We get it using the "status" function.
     # The rest: port by port, except trunks, what does it see there. State uplinks and downlinks.
@@ -679,7 +649,7 @@ def report(elSwitch):
         return (None,None)
     # From now on we're working with a switch that is ONLINE.
     for row in diskCur.execute("""
-        SELECT switchPort.portNum, switchPort.portDesc, switchPort.portType, switchPort.isRoot, mAccess.unaMac, arp.ipaddr, hst.hostname, v.elVendor, mAccess.unaVlan, shp.switchHijo, shp.portPadre, shp2.switchPadre, shp2.portPadre, rr.hijoRoot
+        SELECT switchPort.portNum, switchPort.portDesc, switchPort.portType, switchPort.isRoot, mAccess.unaMac, arp.ipaddr, COALESCE(mh.hostname, hst.hostname), COALESCE(mAccess.elVendor, macVendor(mAccess.unaMac)), mAccess.unaVlan, shp.switchHijo, shp.portPadre, shp2.switchPadre, shp2.portPadre, rr.hijoRoot
         FROM switchPort LEFT JOIN (
                 SELECT DISTINCT *
                 FROM macaddress
@@ -693,7 +663,7 @@ def report(elSwitch):
             LEFT JOIN switchHijosPadre as shp2 ON (switchPort.switchIP = shp2.switchHijo AND switchPort.isROOT = 'ROOT')
             LEFT JOIN arp ON mAccess.unaMac = arp.macAddr
             LEFT JOIN hostname AS hst ON arp.ipaddr = hst.ipaddr
-            LEFT JOIN vendor AS v ON mAccess.unaMac LIKE v.halfMac || '%'
+            LEFT JOIN macHostname AS mh ON mAccess.unaMac = mh.macaddr
             LEFT JOIN (SELECT switchIP AS hijo, portNum AS hijoRoot
                 FROM switchPort
                 WHERE isRoot = 'ROOT'
@@ -742,9 +712,7 @@ def report(elSwitch):
 
 
 def status(elSwitchIP=None):
-    diskDB = sqlite3.connect("/ramdisk/snmpqserver.db", isolation_level=None)
-    diskDB.execute("PRAGMA journal_mode=WAL;")
-    diskDB.execute("PRAGMA synchronous=NORMAL;")
+    diskDB = conectarDB()
     diskCur = diskDB.cursor()
     # We want: A list of switches with IP, Description, Ports with MACs, Trunks,
     # No# of MACs / OFFLINE, and vendor.
@@ -755,12 +723,8 @@ def status(elSwitchIP=None):
         opcional = "ORDER BY switch.switchIP"
     
     for row in diskCur.execute("""
-        SELECT switch.switchIP, switch.switchDesc, switch.switchStatus, COALESCE(troncos.troncales, 0), COALESCE(terminales.accesos,0), swVend.switchMAC, swVend.elVendor, switch.stamp
+        SELECT switch.switchIP, switch.switchDesc, switch.switchStatus, COALESCE(troncos.troncales, 0), COALESCE(terminales.accesos,0), switch.switchMAC, macVendor(switch.switchMAC), switch.stamp
         FROM switch
-            LEFT JOIN (
-                SELECT switch.switchIP, vendor.elVendor, switch.switchDesc, switch.switchMAC
-                FROM switch LEFT JOIN vendor ON switch.switchMAC LIKE vendor.halfMac || '%'
-            ) AS swVend ON switch.switchIP = swVend.switchIP
             LEFT JOIN (
                 SELECT switchPort.switchIP, COUNT(switchPort.switchIP) as troncales
                 FROM switchPort
@@ -785,9 +749,7 @@ def status(elSwitchIP=None):
 
 
 def macSwitch(unaMac, unSwitch):
-    diskDB = sqlite3.connect("/ramdisk/snmpqserver.db", isolation_level=None)
-    diskDB.execute("PRAGMA journal_mode=WAL;")
-    diskDB.execute("PRAGMA synchronous=NORMAL;")
+    diskDB = conectarDB()
     diskCur = diskDB.cursor()
     
     # NOT implemented yet. Does a Switch see a MAC address? If so, on which port?
@@ -861,9 +823,7 @@ def macSwitch(unaMac, unSwitch):
 
 
 def macSearchPart(unaParte):
-    diskDB = sqlite3.connect("/ramdisk/snmpqserver.db", isolation_level=None)
-    diskDB.execute("PRAGMA journal_mode=WAL;")
-    diskDB.execute("PRAGMA synchronous=NORMAL;")
+    diskDB = conectarDB()
     diskCur = diskDB.cursor()
     
     # We get a partial MAC address.
@@ -875,10 +835,10 @@ def macSearchPart(unaParte):
     for row in diskCur.execute("""
         SELECT DISTINCT macaddress.stamp, macaddress.switchIP,
             macaddress.unPuerto, macaddress.unaMAC, macaddress.unaVLAN,
-            arp.ipaddr, vendor.elVendor, hostname.hostname, switch.switchDesc, switch.switchMac
+            arp.ipaddr, COALESCE(macaddress.elVendor, macVendor(macaddress.unaMAC)), COALESCE(macHostname.hostname, hostname.hostname), switch.switchDesc, switch.switchMac
         FROM macaddress LEFT JOIN arp ON macaddress.unaMAC = arp.macaddr
-            LEFT JOIN vendor ON macaddress.unaMAC LIKE vendor.halfMac || '%'
             LEFT JOIN hostname ON arp.ipaddr = hostname.ipaddr
+            LEFT JOIN macHostname ON macaddress.unaMAC = macHostname.macaddr
             JOIN switch ON macaddress.switchIP = switch.switchIP
         WHERE macaddress.unaMac LIKE ?
             AND (macaddress.switchIP, macaddress.unPuerto) IN (
@@ -925,9 +885,7 @@ def macSearchPart(unaParte):
 
 
 def macSearch(unaMac):
-    diskDB = sqlite3.connect("/ramdisk/snmpqserver.db", isolation_level=None)
-    diskDB.execute("PRAGMA journal_mode=WAL;")
-    diskDB.execute("PRAGMA synchronous=NORMAL;")
+    diskDB = conectarDB()
     diskCur = diskDB.cursor()
 
     # The MAC could be Whole or partial. We only know it has valid characters.
@@ -941,10 +899,10 @@ def macSearch(unaMac):
     elQuery = """
         SELECT DISTINCT macaddress.stamp, macaddress.switchIP,
             macaddress.unPuerto, macaddress.unaMAC, macaddress.unaVLAN,
-            arp.ipaddr, vendor.elVendor, hostname.hostname, switch.switchDesc, switch.switchMac
+            arp.ipaddr, COALESCE(macaddress.elVendor, macVendor(macaddress.unaMAC)), COALESCE(macHostname.hostname, hostname.hostname), switch.switchDesc, switch.switchMac
         FROM macaddress LEFT JOIN arp ON macaddress.unaMAC = arp.macaddr
-            LEFT JOIN vendor ON macaddress.unaMAC LIKE vendor.halfMac || '%'
             LEFT JOIN hostname ON arp.ipaddr = hostname.ipaddr
+            LEFT JOIN macHostname ON macaddress.unaMAC = macHostname.macaddr
             JOIN switch ON macaddress.switchIP = switch.switchIP """+elWHERE+"""
             AND (macaddress.switchIP, macaddress.unPuerto) IN (
                 SELECT switchIP, portNum
@@ -992,63 +950,221 @@ def macSearch(unaMac):
 
 
 
+# --------------------------------------------------------------------------------
+# --------------------------------------------------------------------------------
+
+
+
+def historySearch(tipo, valor, desde, hasta):
+    # "Where was this device" between desde and hasta (timestamps), from the history intervals.
+    # tipo is "ip" or "mac". Same layout as ipSearch/macSearch:
+    #   devices: [stamp][switchIP][port][mac][vlan][ip][vendor][hostname][switchDesc][switchMac]
+    #   aps: [apMac][apNombre] seen on the same port in that time range.
+    # stamp is the last time that row was seen inside the range.
+    # Only the partitions overlapping [desde, hasta] are opened.
+    rango = {"valor": valor, "desde": desde, "hasta": hasta}
+    subconsultas = """
+            (SELECT h.hostname FROM histHostname AS h
+                WHERE h.ipaddr = i.ipaddr AND h.first_seen <= :hasta AND h.last_seen >= :desde
+                ORDER BY h.last_seen DESC LIMIT 1),
+            (SELECT s.switchDesc FROM histSwitch AS s
+                WHERE s.switchIP = m.switchIP ORDER BY s.last_seen DESC LIMIT 1),
+            (SELECT s.switchMAC FROM histSwitch AS s
+                WHERE s.switchIP = m.switchIP ORDER BY s.last_seen DESC LIMIT 1)
+        """
+    if( tipo == "ip" ):
+        elQuery = """
+        SELECT MIN(m.last_seen, i.last_seen, :hasta), m.switchIP, m.portNum, m.macaddr, m.vlan, i.ipaddr, """+subconsultas+"""
+        FROM histIP AS i
+            JOIN histMac AS m ON (m.macaddr = i.macaddr AND m.first_seen <= :hasta AND m.last_seen >= :desde)
+        WHERE i.ipaddr = :valor AND i.first_seen <= :hasta AND i.last_seen >= :desde
+        """
+    else:
+        elQuery = """
+        SELECT MIN(m.last_seen, :hasta), m.switchIP, m.portNum, m.macaddr, m.vlan, i.ipaddr, """+subconsultas+"""
+        FROM histMac AS m
+            LEFT JOIN histIP AS i ON (i.macaddr = m.macaddr AND i.first_seen <= :hasta AND i.last_seen >= :desde)
+        WHERE m.macaddr = :valor AND m.first_seen <= :hasta AND m.last_seen >= :desde
+        """
+    # The same row may come from several partitions: we keep the most recent.
+    porClave = {}
+    for row in historico.consultar(str(HIST_DIR), elQuery, rango, desde, hasta):
+        clave = (row[1], row[2], row[3], row[4], row[5])
+        if( (clave not in porClave) or (row[0] > porClave[clave][0]) ):
+            porClave[clave] = row
+    devolver = []
+    for row in sorted(porClave.values(), key=lambda r: (seg(r[1]), seg(r[2]), -r[0])):
+        campoVENDOR = macVendor(row[3])
+        if(campoVENDOR is None):
+            campoVENDOR = "N/A"
+        campoHOSTNAME = row[6]
+        if(campoHOSTNAME is None):
+            campoHOSTNAME = "N/A"
+        devolver.append(row[:6] + (campoVENDOR, campoHOSTNAME) + row[7:])
+    # Access Points (current list) that were on the same port.
+    unAP = []
+    if( len(devolver) > 0 ):
+        diskDB = conectarDB()
+        losAPs = dict(diskDB.execute("SELECT apMac, apNombre FROM accessPoints").fetchall())
+        enPuerto = historico.consultar(str(HIST_DIR), """
+            SELECT DISTINCT macaddr FROM histMac
+            WHERE switchIP = :switchIP AND portNum = :portNum AND first_seen <= :hasta AND last_seen >= :desde
+            """, {"switchIP": devolver[-1][1], "portNum": devolver[-1][2], "desde": desde, "hasta": hasta}, desde, hasta)
+        for unaMac in sorted(set(row[0] for row in enPuerto)):
+            if( unaMac in losAPs ):
+                unAP.append((unaMac, losAPs[unaMac]))
+    return devolver,unAP
+
+
+
+def historyGap(laDB):
+    # HISTORY_GAP (default 3 x HISTORY_PERIOD): how long something can go unseen and still count as present.
+    periodo = leerDBenSQLnum(laDB, "HISTORY_PERIOD", 60)
+    return leerDBenSQLnum(laDB, "HISTORY_GAP", 3 * periodo)
+
+
+
+def historyWindow(momento):
+    # Range that stands for "at momento": a device present then was last merged at most HISTORY_GAP seconds before.
+    return momento - historyGap(conectarDB()), momento
+
+
+
+def ipSearchHist(unaIP, desde, hasta=None):
+    # hasta=None: "at desde" (see historyWindow).
+    if( hasta is None ):
+        desde, hasta = historyWindow(desde)
+    return historySearch("ip", unaIP, desde, hasta)
+
+
+
+def macSearchHist(unaMac, desde, hasta=None):
+    if( hasta is None ):
+        desde, hasta = historyWindow(desde)
+    return historySearch("mac", standarizeFullMAC(unaMac), desde, hasta)
+
+
+
+
+# Column names of each diffRed() section (also the JSON field names of /api/diff).
+DIFF_SECCIONES = {
+    "macsMoved": ("mac", "switchBefore", "portBefore", "vlanBefore", "switchAfter", "portAfter", "vlanAfter"),
+    "macsAppeared": ("mac", "switchIP", "port", "vlan"),
+    "macsGone": ("mac", "switchIP", "port", "vlan"),
+    "switchesOffline": ("switchIP", "switchDesc", "statusBefore", "statusAfter"),
+    "switchesOnline": ("switchIP", "switchDesc", "statusBefore", "statusAfter"),
+    "parentsChanged": ("switchIP", "parentBefore", "portBefore", "parentAfter", "portAfter"),
+    "trunksNew": ("switchIP", "port", "portDesc"),
+}
+
+
+
+def diffRed(desde, hasta=None):
+    # What changed in the network between two times (timestamps). hasta=None compares against the live DB.
+    # Returns {section: [rows]}, sections and columns as in DIFF_SECCIONES. See diffRedFilas.
+    devolver = dict((seccion, []) for seccion in DIFF_SECCIONES)
+    for seccion, fila in diffRedFilas(desde, hasta):
+        devolver[seccion].append(fila)
+    return devolver
+
+
+
+def diffRedFilas(desde, hasta=None):
+    # diffRed as a generator of (section, row), one section after the other in DIFF_SECCIONES order
+    #  (/api/diff streams them as they come). Each table is read once per side, only when its sections
+    #  come up, as a sorted list of states; the differences come from a merge walk
+    #  (historico.compararOrdenados), so no query ever joins both sides.
+    diskDB = conectarDB()
+    tolerancia = historyGap(diskDB)
+
+    def leer(tabla):
+        antes = historico.estadoEn(str(HIST_DIR), tabla, desde, tolerancia)
+        if( hasta is None ):
+            despues = historico.estadoActual(diskDB, tabla)
+        else:
+            despues = historico.estadoEn(str(HIST_DIR), tabla, hasta, tolerancia)
+        return (antes, despues) + historico.compararOrdenados(antes, despues)
+
+    # MACs: (macaddr, switchIP, portNum, vlan). Only the MACs with some difference are looked at.
+    antes, despues, quitados, agregados = leer("histMac")
+    macsAntes = set(row[0] for row in antes)
+    macsDespues = set(row[0] for row in despues)
+    antes = despues = None
+    dondeAntes = {}
+    for row in quitados:
+        dondeAntes.setdefault(row[0], row[1:])
+    dondeDespues = {}
+    for row in agregados:
+        dondeDespues.setdefault(row[0], row[1:])
+    for unaMac in sorted(set(dondeAntes) & set(dondeDespues)):
+        if (unaMac in macsAntes and unaMac in macsDespues):
+            yield "macsMoved", (unaMac,) + dondeAntes[unaMac] + dondeDespues[unaMac]
+    for row in agregados:
+        if row[0] not in macsAntes:
+            yield "macsAppeared", row
+    for row in quitados:
+        if row[0] not in macsDespues:
+            yield "macsGone", row
+    # Switches: (switchIP, switchMAC, switchDesc, switchStatus).
+    antes, despues, quitados, agregados = leer("histSwitch")
+    estadoAntes = dict((row[0], (row[2], row[3])) for row in antes)
+    estadoDespues = dict((row[0], (row[2], row[3])) for row in despues)
+    enLinea = []
+    for elSwitch in sorted(set(row[0] for row in quitados) | set(row[0] for row in agregados), key=seg):
+        descAntes, statusAntes = estadoAntes.get(elSwitch, (None, "MISSING"))
+        descAhora, statusAhora = estadoDespues.get(elSwitch, (None, "MISSING"))
+        # switchStatus is "ONLINE (n MACs)": only going in or out of ONLINE counts.
+        onlineAntes = (statusAntes or "").startswith("ONLINE")
+        onlineAhora = (statusAhora or "").startswith("ONLINE")
+        fila = (elSwitch, descAhora or descAntes, statusAntes, statusAhora)
+        if( onlineAntes and not onlineAhora ):
+            yield "switchesOffline", fila
+        elif( onlineAhora and not onlineAntes ):
+            enLinea.append(fila)
+    for fila in enLinea:
+        yield "switchesOnline", fila
+    # Topology: (switchPadre, portPadre, switchHijo).
+    antes, despues, quitados, agregados = leer("histLink")
+    padreAntes = dict((row[2], row[:2]) for row in antes)
+    padreDespues = dict((row[2], row[:2]) for row in despues)
+    for hijo in sorted(set(row[2] for row in quitados) | set(row[2] for row in agregados), key=seg):
+        if padreAntes.get(hijo) != padreDespues.get(hijo):
+            yield "parentsChanged", (hijo,) + padreAntes.get(hijo, (None, None)) + padreDespues.get(hijo, (None, None))
+    # Ports: (switchIP, portNum, portDesc, portType, isRoot).
+    antes, despues, quitados, agregados = leer("histPort")
+    trunksAntes = set(row[:2] for row in antes if row[3] == "TRUNK")
+    for row in sorted(
+        set((row[0], row[1], row[2]) for row in agregados if row[3] == "TRUNK" and row[:2] not in trunksAntes),
+        key=lambda row: (seg(row[0]), seg(row[1]))
+    ):
+        yield "trunksNew", row
+
+
+
+
 # --------------------------------------------------------------------------------
 # --------------------------------------------------------------------------------
 
 
 
 def mapSwitch(elSwitch):
-    diskDB = sqlite3.connect("/ramdisk/snmpqserver.db", isolation_level=None)
-    diskDB.execute("PRAGMA journal_mode=WAL;")
-    diskDB.execute("PRAGMA synchronous=NORMAL;")
+    diskDB = conectarDB()
     diskCur = diskDB.cursor()
-    elRoot = rootSwitchFinder(diskDB)
-    #
-    # Is is ONLINE?
-    if( not isOnline(diskDB, elSwitch) ):
-        print("switch OFFLINE o inexistente")
-        return None
+    # The path from a switch up to the Root is materialized in switchPath (see rebuildSwitchPaths).
+    # One indexed read, ordered from the switch being queried (depth 0) up to the Root.
+    # Each row: [port on this switch towards the previous one][switch][its root-port]
+    # An OFFLINE (or unknown) switch gives no rows.
     arbolito = []
-    ### We can add the first switch (the one being queried).
-    # LEFT [switch_buscado][root-port]
-    puertoRoot = None
     for row in diskCur.execute("""
-        SELECT portNum
-        FROM switchPort
-        WHERE switchIP = ?
-            AND isRoot = "ROOT"
+        SELECT switchPath.portPadre, switchPath.ancestorIP, switchPath.rootPort
+        FROM switchPath JOIN switch ON switchPath.switchIP = switch.switchIP
+        WHERE switchPath.switchIP = ?
+            AND switch.switchStatus != "OFFLINE"
+        ORDER BY switchPath.depth
         """, (elSwitch,)):
-            puertoRoot = row[0]
-    arbolito.append((None,elSwitch,puertoRoot))
-    hijoIterable = elSwitch
-    puertoIterable = None
-    flagFin = 0
-    while ( flagFin == 0 ):
-        # We keep going as long as the "hijoIterable" is not the Root switch.
-        for row in diskCur.execute("""
-            SELECT switchPadre, portPadre
-            FROM switchHijosPadre
-            WHERE switchHijo = ?
-            """, (hijoIterable,)):
-                hijoIterable = row[0]
-                puertoIterable = row[1]
-                ### We can go to the CENTERED position.:
-                # CENTER [puertoIterable][hijoIterable][root-port]
-                #  We find the root-port of that switch.
-        puertoRoot = None
-        if( hijoIterable == elRoot[0] ):
-            flagFin = 1
-        else:
-            for row in diskCur.execute("""
-                SELECT portNum
-                FROM switchPort
-                WHERE switchIP = ?
-                    AND isRoot = "ROOT"
-                """, (hijoIterable,)):
-                    puertoRoot = row[0]
-        arbolito.append((puertoIterable,hijoIterable,puertoRoot))
-    # Done
+        arbolito.append(row)
     if( len(arbolito) == 0 ):
+        print("switch OFFLINE o inexistente")
         return None
     else:
         return arbolito
@@ -1060,10 +1176,158 @@ def mapSwitch(elSwitch):
 # --------------------------------------------------------------------------------
 
 
-def ipSearch(unaIP):
+
+def topologySignature(laDB, elRoot):
+    # A hash of everything the switch tree depends on. If it didn't change, switchPath is still valid.
+    localCur = laDB.cursor()
+    partes = ["root="+seg(elRoot)]
+    for row in localCur.execute("""
+        SELECT DISTINCT switchPadre, portPadre, switchHijo
+        FROM switchHijosPadre
+        ORDER BY switchHijo, switchPadre, portPadre
+        """):
+        partes.append("link="+seg(row[0])+"/"+seg(row[1])+">"+seg(row[2]))
+    for row in localCur.execute("""
+        SELECT DISTINCT switchIP, portNum
+        FROM switchPort
+        WHERE isRoot = "ROOT"
+        ORDER BY switchIP, portNum
+        """):
+        partes.append("rootport="+seg(row[0])+"/"+seg(row[1]))
+    for row in localCur.execute("""
+        SELECT switchIP, switchDesc, (switchStatus != "OFFLINE")
+        FROM switch
+        ORDER BY switchIP
+        """):
+        partes.append("switch="+seg(row[0])+"/"+seg(row[1])+"/"+seg(row[2]))
+    return hashlib.sha1("\n".join(partes).encode("utf-8")).hexdigest()
+
+
+
+def rebuildSwitchPaths(laDB, elRoot):
+    # Closure table: for every switch, one row per ancestor (itself included, depth 0) up to the Root.
+    #   switchPath: [switchIP][ancestorIP][depth][portPadre][rootPort]
+    #   portPadre is the ancestor's port towards switchIP (None on depth 0).
+    #   rootPort is the ancestor's root-port (None for the Root itself, except on depth 0).
+    # Only rebuilt when the topology signature changes. Returns True if it was rebuilt.
+    localCur = laDB.cursor()
+    laFirma = topologySignature(laDB, elRoot)
+    for row in localCur.execute("SELECT firma FROM switchPathMeta"):
+        if( row[0] == laFirma ):
+            return False
+    padres = {}
+    for row in localCur.execute("""
+        SELECT switchHijo, switchPadre, portPadre
+        FROM switchHijosPadre
+        ORDER BY CAST(stamp AS REAL)
+        """):
+        # If a son shows up twice, the most recent relationship wins.
+        padres[row[0]] = (row[1], row[2])
+    rootPorts = {}
+    for row in localCur.execute("""
+        SELECT switchIP, portNum
+        FROM switchPort
+        WHERE isRoot = "ROOT"
+        """):
+        rootPorts[row[0]] = row[1]
+    losSwitches = []
+    for row in localCur.execute("SELECT switchIP FROM switch"):
+        losSwitches.append(row[0])
+    filas = []
+    for unSwitch in losSwitches:
+        filas.append((unSwitch, unSwitch, 0, None, rootPorts.get(unSwitch)))
+        visitados = {unSwitch}
+        actual = unSwitch
+        depth = 0
+        while( (actual != elRoot) and (actual in padres) ):
+            elPadre, elPuerto = padres[actual]
+            if( elPadre in visitados ):
+                # A cycle sneaked into switchHijosPadre. We stop here instead of spinning forever.
+                print("rebuildSwitchPaths: ciclo en switchHijosPadre desde "+seg(unSwitch)+" en "+seg(elPadre))
+                break
+            visitados.add(elPadre)
+            depth = depth + 1
+            if( elPadre == elRoot ):
+                puertoRoot = None
+            else:
+                puertoRoot = rootPorts.get(elPadre)
+            filas.append((unSwitch, elPadre, depth, elPuerto, puertoRoot))
+            actual = elPadre
+    try:
+        localCur.execute("BEGIN")
+        localCur.execute("DELETE FROM switchPath")
+        localCur.executemany("""
+            INSERT INTO switchPath (switchIP, ancestorIP, depth, portPadre, rootPort)
+            VALUES (?, ?, ?, ?, ?)
+            """, filas)
+        localCur.execute("DELETE FROM switchPathMeta")
+        localCur.execute("""
+            INSERT INTO switchPathMeta (firma, rootSwitch, stamp)
+            VALUES (?, ?, ?)
+            """, (laFirma, elRoot, time.time()))
+        laDB.commit()
+    except Exception:
+        laDB.rollback()
+        raise
+    return True
+
+
+
+def topologyTree():
+    # Full network tree (JSON-ready) built from switchPath. Returns (firma, [root nodes]).
+    # firma is the topology signature, to be used as an ETag.
+    diskDB = conectarDB()
+    diskCur = diskDB.cursor()
+    laFirma = None
+    for row in diskCur.execute("SELECT firma FROM switchPathMeta"):
+        laFirma = row[0]
+    nodos = {}
+    for row in diskCur.execute("""
+        SELECT switchPath.switchIP, switch.switchDesc, switch.switchStatus, switchPath.rootPort
+        FROM switchPath JOIN switch ON switchPath.switchIP = switch.switchIP
+        WHERE switchPath.depth = 0
+        ORDER BY switchPath.switchIP
+        """):
+        nodos[row[0]] = {
+            'switchIP': row[0],
+            'switchDesc': row[1],
+            'switchStatus': row[2],
+            'rootPort': row[3],
+            'parentPort': None,
+            'children': []
+        }
+    tienePadre = set()
+    for row in diskCur.execute("""
+        SELECT switchIP, ancestorIP, portPadre
+        FROM switchPath
+        WHERE depth = 1
+        ORDER BY ancestorIP, CAST(portPadre AS INTEGER)
+        """):
+        if( (row[0] in nodos) and (row[1] in nodos) ):
+            nodos[row[0]]['parentPort'] = row[2]
+            nodos[row[1]]['children'].append(nodos[row[0]])
+            tienePadre.add(row[0])
+    raices = [nodo for ip, nodo in nodos.items() if ip not in tienePadre]
+    return (laFirma, raices)
+
+
+
+def topologyETag():
+    # Just the signature (cheap). None if switchPath was never built.
     diskDB = sqlite3.connect("/ramdisk/snmpqserver.db", isolation_level=None)
-    diskDB.execute("PRAGMA journal_mode=WAL;")
-    diskDB.execute("PRAGMA synchronous=NORMAL;")
+    diskCur = diskDB.cursor()
+    laFirma = None
+    try:
+        for row in diskCur.execute("SELECT firma FROM switchPathMeta"):
+            laFirma = row[0]
+    except sqlite3.OperationalError:
+        pass
+    return laFirma
+
+
+
+def ipSearch(unaIP):
+    diskDB = conectarDB()
     diskCur = diskDB.cursor()
 
     # We Want: SWITCH, MAC, VLAN, HOSTNAME, VENDOR
@@ -1081,10 +1345,10 @@ def ipSearch(unaIP):
     for row in diskCur.execute("""
         SELECT DISTINCT macaddress.stamp, macaddress.switchIP,
             macaddress.unPuerto, macaddress.unaMAC, macaddress.unaVLAN,
-            arp.ipaddr, vendor.elVendor, hostname.hostname, switch.switchDesc, switch.switchMac
+            arp.ipaddr, COALESCE(macaddress.elVendor, macVendor(macaddress.unaMAC)), COALESCE(macHostname.hostname, hostname.hostname), switch.switchDesc, switch.switchMac
         FROM macaddress LEFT JOIN arp ON macaddress.unaMAC = arp.macaddr
-            LEFT JOIN vendor ON macaddress.unaMAC LIKE vendor.halfMac || '%'
             LEFT JOIN hostname ON arp.ipaddr = hostname.ipaddr
+            LEFT JOIN macHostname ON macaddress.unaMAC = macHostname.macaddr
             JOIN switch ON macaddress.switchIP = switch.switchIP
         WHERE macaddress.unaMac IN (
             SELECT macaddr
@@ -1134,9 +1398,7 @@ def ipSearch(unaIP):
 
 
 def switchport(elSwitch, elPuerto):
-    diskDB = sqlite3.connect("/ramdisk/snmpqserver.db", isolation_level=None)
-    diskDB.execute("PRAGMA journal_mode=WAL;")
-    diskDB.execute("PRAGMA synchronous=NORMAL;")
+    diskDB = conectarDB()
     diskCur = diskDB.cursor()
     # Switch INFO:
     datosSwitch = []
@@ -1159,10 +1421,10 @@ def switchport(elSwitch, elPuerto):
     # MAC table with additional detail.
     resultados = []
     for row in diskCur.execute("""
-        SELECT DISTINCT macaddress.stamp, macaddress.unaMAC, macaddress.unaVLAN, arp.ipaddr, vendor.elVendor, hostname.hostname
+        SELECT DISTINCT macaddress.stamp, macaddress.unaMAC, macaddress.unaVLAN, arp.ipaddr, COALESCE(macaddress.elVendor, macVendor(macaddress.unaMAC)), COALESCE(macHostname.hostname, hostname.hostname)
         FROM macaddress LEFT JOIN arp ON macaddress.unaMAC = arp.macaddr
-            LEFT JOIN vendor ON macaddress.unaMAC LIKE vendor.halfMac || '%'
             LEFT JOIN hostname ON arp.ipaddr = hostname.ipaddr
+            LEFT JOIN macHostname ON macaddress.unaMAC = macHostname.macaddr
         WHERE macaddress.switchIP IN (
             SELECT switchIP
             FROM switch
@@ -1203,6 +1465,17 @@ def switchport(elSwitch, elPuerto):
 # NetFlow database path
 NETFLOW_DB = "/ramdisk/netflow.db"
 
+# netflowFlows.direction and netflowFlows.scope (written by netflowProcessor.py)
+NETFLOW_UPLOAD, NETFLOW_DOWNLOAD = 0, 1
+NETFLOW_PUBLIC, NETFLOW_PRIVATE = 0, 1
+# (direction, scope) -> key of the stats dictionaries
+NETFLOW_BLOCKS = {
+    (NETFLOW_UPLOAD, NETFLOW_PUBLIC): 'publicUS',
+    (NETFLOW_DOWNLOAD, NETFLOW_PUBLIC): 'publicDS',
+    (NETFLOW_UPLOAD, NETFLOW_PRIVATE): 'privateUS',
+    (NETFLOW_DOWNLOAD, NETFLOW_PRIVATE): 'privateDS',
+}
+
 # Protocol mapping
 PROTOCOL_MAP = {
     "tcp": "TCP",
@@ -1285,7 +1558,40 @@ def calculate_speed(total_bytes, time_seconds):
 def get_protocol_name(protocol_str):
     """Convert protocol string/number to readable name"""
     protocol_lower = str(protocol_str).lower()
-    return PROTOCOL_MAP.get(protocol_lower, protocol_str.upper())
+    return PROTOCOL_MAP.get(protocol_lower, str(protocol_str).upper())
+
+def netflow_blocks(grouped_rows, time_seconds):
+    """
+    The four stats blocks (publicUS, publicDS, privateUS, privateDS) out of one grouped pass.
+    grouped_rows: (direction, scope, remote_ip, port, protocol, bytes, packets, flows) per group.
+    """
+    totals = {}
+    groups = {}
+    for direction, scope, ip, port, proto, bytes_val, packets, flows in grouped_rows:
+        key = NETFLOW_BLOCKS.get((direction, scope))
+        if key is None:
+            continue
+        total = totals.setdefault(key, [0, 0, 0])
+        total[0] += bytes_val or 0
+        total[1] += packets or 0
+        total[2] += flows
+        groups.setdefault(key, []).append((ip, port, proto, bytes_val or 0))
+    blocks = {}
+    for key in NETFLOW_BLOCKS.values():
+        total_bytes, total_packets, flow_count = totals.get(key, (0, 0, 0))
+        # Format top5 with human-readable bytes and service names
+        top5 = []
+        for ip, port, proto, bytes_val in heapq.nlargest(5, groups.get(key, []), key=lambda group: group[3]):
+            top5.append((ip, port, get_protocol_name(proto), bytes_val, format_bytes(bytes_val), get_service_name(ip)))
+        blocks[key] = {
+            'total_bytes': total_bytes,
+            'total_packets': total_packets,
+            'flow_count': flow_count,
+            'avg_speed': calculate_speed(total_bytes, time_seconds),
+            'formatted_bytes': format_bytes(total_bytes),
+            'top5': top5
+        }
+    return blocks
 
 # ============================================================================
 # GLOBAL NETFLOW STATISTICS
@@ -1293,7 +1599,7 @@ def get_protocol_name(protocol_str):
 
 def netflow_global_stats(minutes=5):
     """
-    Get global NetFlow statistics for all tables
+    Get global NetFlow statistics (upload/download, public/private)
     
     Args:
         minutes: Time window in minutes (default 5, min 20s=0.33, max 5)
@@ -1329,77 +1635,26 @@ def netflow_global_stats(minutes=5):
         'privateDS': None
     }
     
-    # Helper function to query one table
-    def query_table(table_name, is_upload):
-        # Get totals
-        cur.execute(f"""
-            SELECT 
-                SUM(CAST(bytes AS INTEGER)) as total_bytes,
-                SUM(CAST(packets AS INTEGER)) as total_packets,
-                COUNT(*) as flow_count
-            FROM {table_name}
-            WHERE CAST(stamp AS REAL) > ?
-        """, (cutoff,))
-        
-        row = cur.fetchone()
-        total_bytes = row[0] or 0
-        total_packets = row[1] or 0
-        flow_count = row[2] or 0
-        
-        # Calculate average speed
-        time_seconds = minutes * 60
-        avg_speed = calculate_speed(total_bytes, time_seconds)
-        
-        # Get top 5 connections (by bytes)
-        # For upload: group by destination, for download: group by source
-        if is_upload:
-            #group_field = "dstIP"
-            group_field = "srcIP"
-        else:
-            #group_field = "srcIP"
-            group_field = "dstIP"
-        cur.execute(f"""
+    # One grouped pass over the stamp index for the four blocks. Top 5 by local host:
+    #  srcIP for upload, dstIP for download.
+    try:
+        cur.execute("""
             SELECT 
-                {group_field} as remote_ip,
+                direction,
+                scope,
+                CASE direction WHEN ? THEN srcIP ELSE dstIP END as local_ip,
                 dstPort,
                 protocol,
-                SUM(CAST(bytes AS INTEGER)) as total_bytes
-            FROM {table_name}
-            WHERE CAST(stamp AS REAL) > ?
-            GROUP BY {group_field}, dstPort, protocol
-            ORDER BY total_bytes DESC
-            LIMIT 5
-        """, (cutoff,))
-        
-        top5_raw = cur.fetchall()
-        
-        # Format top5 with human-readable bytes and service names
-        top5 = []
-        for ip, port, proto, bytes_val in top5_raw:
-            formatted = format_bytes(bytes_val)
-            proto_name = get_protocol_name(proto)
-            service_name = get_service_name(ip)
-            
-            
-            top5.append((ip, port, proto_name, bytes_val, formatted, service_name))
-        
-        return {
-            'total_bytes': total_bytes,
-            'total_packets': total_packets,
-            'flow_count': flow_count,
-            'avg_speed': avg_speed,
-            'formatted_bytes': format_bytes(total_bytes),
-            'top5': top5
-        }
-    
-    # Query all four tables
-    try:
-        result['publicUS'] = query_table('netflowPublicUS', True)
-        result['publicDS'] = query_table('netflowPublicDS', False)
-        result['privateUS'] = query_table('netflowPrivateUS', True)
-        result['privateDS'] = query_table('netflowPrivateDS', False)
+                SUM(bytes),
+                SUM(packets),
+                COUNT(*)
+            FROM netflowFlows
+            WHERE stamp > ?
+            GROUP BY direction, scope, local_ip, dstPort, protocol
+        """, (NETFLOW_UPLOAD, cutoff))
+        result.update(netflow_blocks(cur.fetchall(), minutes * 60))
     except sqlite3.OperationalError:
-        # Tables might not exist yet
+        # Table might not exist yet
         pass
     finally:
         conn.close()
@@ -1454,123 +1709,31 @@ def netflow_host_stats(ip_address, minutes=5):
         'privateDS': None
     }
     
+    # One grouped pass: upload rows by srcIP and download rows by dstIP (each off its own
+    #  index), grouped by the remote end.
     has_data = False
-    time_seconds = minutes * 60
-    
-    # Helper function for upload tables (srcIP = host)
-    def query_upload_table(table_name):
-        nonlocal has_data
-        
-        # Get totals
-        cur.execute(f"""
-            SELECT 
-                SUM(CAST(bytes AS INTEGER)),
-                SUM(CAST(packets AS INTEGER)),
-                COUNT(*)
-            FROM {table_name}
-            WHERE srcIP = ? AND CAST(stamp AS REAL) > ?
-        """, (ip_address, cutoff))
-        
-        row = cur.fetchone()
-        total_bytes = row[0] or 0
-        total_packets = row[1] or 0
-        flow_count = row[2] or 0
-        
-        if flow_count > 0:
-            has_data = True
-        
-        # Top 5 destinations
-        cur.execute(f"""
+    try:
+        cur.execute("""
             SELECT 
-                dstIP,
-                dstPort,
+                direction,
+                scope,
+                CASE direction WHEN ? THEN dstIP ELSE srcIP END as remote_ip,
+                CASE direction WHEN ? THEN dstPort ELSE srcPort END as remote_port,
                 protocol,
-                SUM(CAST(bytes AS INTEGER)) as total_bytes
-            FROM {table_name}
-            WHERE srcIP = ? AND CAST(stamp AS REAL) > ?
-            GROUP BY dstIP, dstPort, protocol
-            ORDER BY total_bytes DESC
-            LIMIT 5
-        """, (ip_address, cutoff))
-        
-        top5_raw = cur.fetchall()
-        top5 = []
-        for ip, port, proto, bytes_val in top5_raw:
-            formatted = format_bytes(bytes_val)
-            proto_name = get_protocol_name(proto)
-            service_name = get_service_name(ip)
-            top5.append((ip, port, proto_name, bytes_val, formatted, service_name))
-        
-        return {
-            'total_bytes': total_bytes,
-            'total_packets': total_packets,
-            'flow_count': flow_count,
-            'avg_speed': calculate_speed(total_bytes, time_seconds),
-            'formatted_bytes': format_bytes(total_bytes),
-            'top5': top5
-        }
-    
-    # Helper function for download tables (dstIP = host)
-    def query_download_table(table_name):
-        nonlocal has_data
-        
-        # Get totals
-        cur.execute(f"""
-            SELECT 
-                SUM(CAST(bytes AS INTEGER)),
-                SUM(CAST(packets AS INTEGER)),
+                SUM(bytes),
+                SUM(packets),
                 COUNT(*)
-            FROM {table_name}
-            WHERE dstIP = ? AND CAST(stamp AS REAL) > ?
-        """, (ip_address, cutoff))
-        
-        row = cur.fetchone()
-        total_bytes = row[0] or 0
-        total_packets = row[1] or 0
-        flow_count = row[2] or 0
-        
-        if flow_count > 0:
-            has_data = True
-        
-        # Top 5 sources
-        cur.execute(f"""
-            SELECT 
-                srcIP,
-                srcPort,
-                protocol,
-                SUM(CAST(bytes AS INTEGER)) as total_bytes
-            FROM {table_name}
-            WHERE dstIP = ? AND CAST(stamp AS REAL) > ?
-            GROUP BY srcIP, srcPort, protocol
-            ORDER BY total_bytes DESC
-            LIMIT 5
-        """, (ip_address, cutoff))
-        
-        top5_raw = cur.fetchall()
-        top5 = []
-        for ip, port, proto, bytes_val in top5_raw:
-            formatted = format_bytes(bytes_val)
-            proto_name = get_protocol_name(proto)
-            service_name = get_service_name(ip)
-            top5.append((ip, port, proto_name, bytes_val, formatted, service_name))
-        
-        return {
-            'total_bytes': total_bytes,
-            'total_packets': total_packets,
-            'flow_count': flow_count,
-            'avg_speed': calculate_speed(total_bytes, time_seconds),
-            'formatted_bytes': format_bytes(total_bytes),
-            'top5': top5
-        }
-    
-    # Query all four tables
-    try:
-        result['publicUS'] = query_upload_table('netflowPublicUS')
-        result['publicDS'] = query_download_table('netflowPublicDS')
-        result['privateUS'] = query_upload_table('netflowPrivateUS')
-        result['privateDS'] = query_download_table('netflowPrivateDS')
+            FROM netflowFlows
+            WHERE (srcIP = ? AND stamp > ? AND direction = ?)
+               OR (dstIP = ? AND stamp > ? AND direction = ?)
+            GROUP BY direction, scope, remote_ip, remote_port, protocol
+        """, (NETFLOW_UPLOAD, NETFLOW_UPLOAD,
+              ip_address, cutoff, NETFLOW_UPLOAD, ip_address, cutoff, NETFLOW_DOWNLOAD))
+        grouped_rows = cur.fetchall()
+        has_data = len(grouped_rows) > 0
+        result.update(netflow_blocks(grouped_rows, minutes * 60))
     except sqlite3.OperationalError:
-        # Tables don't exist yet
+        # Table doesn't exist yet
         pass
     finally:
         conn.close()
@@ -1612,9 +1775,8 @@ def extensionCheck(unaIP, unaDB):
 
 
 def systemStatus():
-    diskDB = sqlite3.connect("/ramdisk/snmpqserver.db", isolation_level=None)
-    diskDB.execute("PRAGMA journal_mode=WAL;")
-    diskDB.execute("PRAGMA synchronous=NORMAL;")
+    # Returns (last stamp of each table, memory report of each process: see memoria.py).
+    diskDB = conectarDB()
     diskCur = diskDB.cursor()
     #
     losStamps = []
@@ -1660,5 +1822,5 @@ def systemStatus():
         """):
         aux = row
     losStamps.append(aux)
-    return losStamps
+    return losStamps, memoria.leerReportes()
 
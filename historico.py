@@ -0,0 +1,417 @@
+"""
+Historical Data (validity intervals, time partitioned)
+Instead of copying every table on each pass, history keeps one row per
+distinct state with the time it was first and last seen. Every cycle the
+rows still present are extended (last_seen = now) and only new states are
+inserted, so the history grows with the change rate, not with time.
+
+History lives in one SQLite file per day (or week) under historico/, listed
+in catalogo.db. Old partitions are compacted and lzma compressed, expired
+ones are deleted as whole files, and queries only open the partitions that
+overlap the requested time range.
+
+SnmpQuery - Network Discovery and Monitoring Tool
+Copyright (C) 2025 Agustin Garcia Maiztegui
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+"""
+
+import datetime
+import lzma
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+# ============================================================================
+# INTERVAL TABLES
+# ============================================================================
+
+# tabla: (key columns, SELECT over the live (ramdisk) tables giving those columns).
+# A row is "the same state" when every key column matches (NULLs included).
+TABLAS = {
+    # Where a MAC is connected. Only ACCESS ports: on trunks every MAC shows up everywhere.
+    "histMac": (
+        ("macaddr", "switchIP", "portNum", "vlan"),
+        """
+        SELECT DISTINCT macaddress.unaMAC, macaddress.switchIP, macaddress.unPuerto, macaddress.unaVLAN
+        FROM main.macaddress JOIN main.switchPort
+            ON (macaddress.switchIP = switchPort.switchIP AND macaddress.unPuerto = switchPort.portNum)
+        WHERE switchPort.portType = "ACCESS"
+        """,
+    ),
+    # Which MAC had which IP.
+    "histIP": (
+        ("ipaddr", "macaddr"),
+        """
+        SELECT DISTINCT ipaddr, macaddr
+        FROM main.arp
+        """,
+    ),
+    "histHostname": (
+        ("ipaddr", "hostname"),
+        """
+        SELECT DISTINCT ipaddr, hostname
+        FROM main.hostname
+        """,
+    ),
+    "histSwitch": (
+        ("switchIP", "switchMAC", "switchDesc", "switchStatus"),
+        """
+        SELECT DISTINCT switchIP, switchMAC, switchDesc,
+            CASE WHEN switchStatus LIKE 'ONLINE%' THEN 'ONLINE' ELSE switchStatus END
+        FROM main.switch
+        """,
+    ),
+    # Switch topology: parent port -> son.
+    "histLink": (
+        ("switchPadre", "portPadre", "switchHijo"),
+        """
+        SELECT DISTINCT switchPadre, portPadre, switchHijo
+        FROM main.switchHijosPadre
+        """,
+    ),
+    "histPort": (
+        ("switchIP", "portNum", "portDesc", "portType", "isRoot"),
+        """
+        SELECT DISTINCT switchIP, portNum, portDesc, portType, isRoot
+        FROM main.switchPort
+        """,
+    ),
+}
+
+
+# Extra indexes, for the point-in-time searches (funciones.historySearch joins histIP by MAC).
+INDICES_EXTRA = {
+    "histIP": (("macaddr", "last_seen"),),
+}
+
+
+def crearTablas(histDB, esquema="main"):
+    """Interval tables and their indexes, in `esquema` of histDB."""
+    localCur = histDB.cursor()
+    for tabla, (claves, _fuente) in TABLAS.items():
+        columnas = ", ".join(clave + " TEXT" for clave in claves)
+        localCur.execute(
+            "CREATE TABLE IF NOT EXISTS " + esquema + "." + tabla + " ("
+            + columnas + ", first_seen REAL, last_seen REAL)"
+        )
+        # Lookups by key (extending an interval, "where was X") and by time.
+        localCur.execute(
+            "CREATE INDEX IF NOT EXISTS " + esquema + ".idx_" + tabla + "_claves ON "
+            + tabla + " (" + ", ".join(claves) + ", last_seen)"
+        )
+        localCur.execute(
+            "CREATE INDEX IF NOT EXISTS " + esquema + ".idx_" + tabla + "_tiempo ON "
+            + tabla + " (last_seen, first_seen)"
+        )
+        for i, columnas in enumerate(INDICES_EXTRA.get(tabla, ())):
+            localCur.execute(
+                "CREATE INDEX IF NOT EXISTS " + esquema + ".idx_" + tabla + "_extra" + str(i) + " ON "
+                + tabla + " (" + ", ".join(columnas) + ")"
+            )
+
+
+def registrarCiclo(localCur, ahora, tolerancia, esquema="history"):
+    """
+    One history pass, inside the caller's transaction, with the history DB attached as `esquema`.
+    For each table: intervals seen within the last `tolerancia` seconds whose state is still
+    present get last_seen = ahora; states with no such interval get a new one [ahora, ahora].
+    A state that disappears for longer than `tolerancia` starts a new interval when it comes back.
+    Returns {tabla: (extended, inserted)}.
+    """
+    resumen = {}
+    for tabla, (claves, fuente) in TABLAS.items():
+        iguales = " AND ".join("actual." + clave + " IS " + tabla + "." + clave for clave in claves)
+        localCur.execute("DROP TABLE IF EXISTS temp.actual")
+        localCur.execute(
+            "CREATE TEMP TABLE actual (" + ", ".join(claves) + ")"
+        )
+        localCur.execute(
+            "INSERT INTO temp.actual (" + ", ".join(claves) + ") " + fuente
+        )
+        # Driven from temp.actual: each live state finds its open interval through idx_<tabla>_claves
+        #  (an EXISTS per history row would scan temp.actual once per row).
+        localCur.execute(
+            "UPDATE " + esquema + "." + tabla + " SET last_seen = ?"
+            + " WHERE rowid IN (SELECT " + tabla + ".rowid FROM temp.actual AS actual"
+            + " JOIN " + esquema + "." + tabla + " AS " + tabla + " ON " + iguales
+            + " WHERE " + tabla + ".last_seen >= ? AND " + tabla + ".last_seen < ?)",
+            (ahora, ahora - tolerancia, ahora),
+        )
+        extendidos = localCur.rowcount
+        localCur.execute(
+            "INSERT INTO " + esquema + "." + tabla + " (" + ", ".join(claves) + ", first_seen, last_seen)"
+            + " SELECT " + ", ".join("actual." + clave for clave in claves) + ", ?, ?"
+            + " FROM temp.actual AS actual"
+            + " WHERE NOT EXISTS (SELECT 1 FROM " + esquema + "." + tabla
+            + " WHERE " + iguales + " AND " + tabla + ".last_seen = ?)",
+            (ahora, ahora, ahora),
+        )
+        resumen[tabla] = (extendidos, localCur.rowcount)
+    localCur.execute("DROP TABLE IF EXISTS temp.actual")
+    return resumen
+
+
+# ============================================================================
+# PARTITIONS AND CATALOG
+# ============================================================================
+
+CATALOGO = "catalogo.db"
+# Decompressed copies of cold partitions, reused while they are fresh. Private to the owner of
+#  dirHist (0700): never a shared temp directory someone else could plant files or symlinks in.
+DIR_CACHE = ".cache"
+
+
+def dirCache(dirHist):
+    """The cache directory of dirHist, created 0700 if needed."""
+    directorio = os.path.join(dirHist, DIR_CACHE)
+    os.makedirs(directorio, mode=0o700, exist_ok=True)
+    if (os.stat(directorio).st_mode & 0o777) != 0o700:
+        os.chmod(directorio, 0o700)
+    return directorio
+
+
+def abrirCatalogo(dirHist):
+    """Connection to the partition catalog, creating dirHist and the table if needed."""
+    os.makedirs(dirHist, exist_ok=True)
+    catalogo = sqlite3.connect(os.path.join(dirHist, CATALOGO), isolation_level=None)
+    catalogo.execute("""
+        CREATE TABLE IF NOT EXISTS particiones (
+            archivo TEXT PRIMARY KEY,
+            desde REAL,
+            hasta REAL,
+            comprimido INTEGER,
+            stamp REAL
+        )
+    """)
+    catalogo.execute("""
+        CREATE INDEX IF NOT EXISTS idx_particiones_tiempo
+        ON particiones (desde, hasta)
+    """)
+    return catalogo
+
+
+def limitesParticion(ahora, modo="day"):
+    """(name, start, end) of the partition holding `ahora`. modo: "day" or "week" (ISO, from Monday)."""
+    dia = datetime.date.fromtimestamp(ahora)
+    if modo == "week":
+        inicio = dia - datetime.timedelta(days=dia.weekday())
+        fin = inicio + datetime.timedelta(days=7)
+        anio, semana, _ = inicio.isocalendar()
+        nombre = "hist-%04d-W%02d.db" % (anio, semana)
+    else:
+        inicio = dia
+        fin = inicio + datetime.timedelta(days=1)
+        nombre = "hist-" + inicio.strftime("%Y%m%d") + ".db"
+    desde = time.mktime(inicio.timetuple())
+    hasta = time.mktime(fin.timetuple())
+    return (nombre, desde, hasta)
+
+
+def particionActual(dirHist, ahora, modo="day"):
+    """Path of the (uncompressed) partition for `ahora`, created and catalogued if new."""
+    nombre, desde, hasta = limitesParticion(ahora, modo)
+    ruta = os.path.join(dirHist, nombre)
+    catalogo = abrirCatalogo(dirHist)
+    try:
+        catalogada = catalogo.execute("SELECT 1 FROM particiones WHERE archivo = ?", (nombre,)).fetchone()
+        if (catalogada is None) or (not os.path.exists(ruta)):
+            histDB = sqlite3.connect(ruta, isolation_level=None)
+            try:
+                crearTablas(histDB)
+            finally:
+                histDB.close()
+            catalogo.execute("""
+                INSERT OR REPLACE INTO particiones (archivo, desde, hasta, comprimido, stamp)
+                VALUES (?, ?, ?, 0, ?)
+                """, (nombre, desde, hasta, time.time()))
+    finally:
+        catalogo.close()
+    return ruta
+
+
+def _comprimir(ruta):
+    # VACUUM, then ruta -> ruta.xz (written aside and renamed). The plain file is removed afterwards.
+    histDB = sqlite3.connect(ruta, isolation_level=None)
+    try:
+        histDB.execute("VACUUM")
+    finally:
+        histDB.close()
+    temporal = ruta + ".xz.tmp"
+    with open(ruta, "rb") as origen, lzma.open(temporal, "wb", preset=6) as destino:
+        shutil.copyfileobj(origen, destino, 1024 * 1024)
+    os.replace(temporal, ruta + ".xz")
+
+
+def mantenimiento(dirHist, ahora, retencionDias, comprimirDias):
+    """
+    Deletes partitions that ended more than retencionDias ago (0: keep forever) and
+    compresses the ones that ended more than comprimirDias ago (0: never).
+    Returns (deleted, compressed).
+    """
+    catalogo = abrirCatalogo(dirHist)
+    borradas = 0
+    comprimidas = 0
+    try:
+        if retencionDias > 0:
+            vencidas = catalogo.execute("""
+                SELECT archivo, comprimido FROM particiones WHERE hasta < ?
+                """, (ahora - retencionDias * 86400,)).fetchall()
+            for archivo, comprimido in vencidas:
+                ruta = os.path.join(dirHist, archivo) + (".xz" if comprimido else "")
+                if os.path.exists(ruta):
+                    os.remove(ruta)
+                catalogo.execute("DELETE FROM particiones WHERE archivo = ?", (archivo,))
+                borradas = borradas + 1
+        if comprimirDias > 0:
+            frias = catalogo.execute("""
+                SELECT archivo FROM particiones WHERE comprimido = 0 AND hasta < ?
+                """, (ahora - comprimirDias * 86400,)).fetchall()
+            for (archivo,) in frias:
+                ruta = os.path.join(dirHist, archivo)
+                if os.path.exists(ruta):
+                    _comprimir(ruta)
+                catalogo.execute("UPDATE particiones SET comprimido = 1 WHERE archivo = ?", (archivo,))
+                if os.path.exists(ruta):
+                    os.remove(ruta)
+                comprimidas = comprimidas + 1
+    finally:
+        catalogo.close()
+    # Stale decompressed copies (and temporaries of writers that died). A reader may be
+    #  replacing or removing them at the same time.
+    directorio = os.path.join(dirHist, DIR_CACHE)
+    if os.path.isdir(directorio):
+        for archivo in os.listdir(directorio):
+            ruta = os.path.join(directorio, archivo)
+            try:
+                if (ahora - os.path.getmtime(ruta)) > 86400:
+                    os.remove(ruta)
+            except FileNotFoundError:
+                continue
+    return (borradas, comprimidas)
+
+
+def _rutaLegible(dirHist, archivo, comprimido):
+    # Path of a plain SQLite file for a partition, decompressing cold ones into DIR_CACHE.
+    ruta = os.path.join(dirHist, archivo)
+    if not comprimido:
+        return ruta
+    ruta = ruta + ".xz"
+    directorio = dirCache(dirHist)
+    copia = os.path.join(directorio, archivo)
+    try:
+        if os.path.getmtime(copia) >= os.path.getmtime(ruta):
+            return copia
+    except FileNotFoundError:
+        pass
+    # Each writer has its own temporary (two threads or processes may decompress the same
+    #  partition at once); the complete copy is published in one rename.
+    descriptor, temporal = tempfile.mkstemp(dir=directorio, prefix=archivo + ".", suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "wb") as destino, lzma.open(ruta, "rb") as origen:
+            shutil.copyfileobj(origen, destino, 1024 * 1024)
+        os.replace(temporal, copia)
+    except BaseException:
+        try:
+            os.remove(temporal)
+        except OSError:
+            pass
+        raise
+    return copia
+
+
+def particionesEnRango(dirHist, desde, hasta):
+    """Readable paths of the partitions overlapping [desde, hasta], oldest first."""
+    catalogo = abrirCatalogo(dirHist)
+    try:
+        filas = catalogo.execute("""
+            SELECT archivo, comprimido
+            FROM particiones
+            WHERE desde <= ? AND hasta >= ?
+            ORDER BY desde
+            """, (hasta, desde)).fetchall()
+    finally:
+        catalogo.close()
+    rutas = []
+    for archivo, comprimido in filas:
+        try:
+            rutas.append(_rutaLegible(dirHist, archivo, comprimido))
+        except (OSError, lzma.LZMAError):
+            continue
+    return rutas
+
+
+def consultar(dirHist, elQuery, parametros, desde, hasta):
+    """Runs elQuery on every partition overlapping [desde, hasta] (read only) and returns all the rows."""
+    filas = []
+    for ruta in particionesEnRango(dirHist, desde, hasta):
+        if not os.path.exists(ruta):
+            continue
+        histDB = sqlite3.connect("file:" + ruta + "?mode=ro", uri=True)
+        try:
+            filas.extend(histDB.execute(elQuery, parametros).fetchall())
+        except sqlite3.OperationalError:
+            continue
+        finally:
+            histDB.close()
+    return filas
+
+
+# ============================================================================
+# SNAPSHOTS AND DIFF
+# ============================================================================
+
+def _ordenNulos(fila):
+    # Tuples with NULLs don't compare in Python: None sorts first.
+    return tuple((valor is not None, valor or "") for valor in fila)
+
+
+def estadoEn(dirHist, tabla, momento, tolerancia):
+    """Sorted, distinct key tuples of `tabla` present at `momento` (seen within `tolerancia` before it)."""
+    claves = ", ".join(TABLAS[tabla][0])
+    filas = consultar(
+        dirHist,
+        "SELECT DISTINCT " + claves + " FROM " + tabla
+        + " WHERE first_seen <= :momento AND last_seen >= :desde",
+        {"momento": momento, "desde": momento - tolerancia},
+        momento - tolerancia, momento,
+    )
+    return sorted(set(filas), key=_ordenNulos)
+
+
+def estadoActual(laDB, tabla):
+    """Same as estadoEn, from the live tables of laDB."""
+    # History columns are TEXT: the live values are compared as text too.
+    filas = laDB.execute(TABLAS[tabla][1]).fetchall()
+    filas = set(tuple(None if valor is None else str(valor) for valor in fila) for fila in filas)
+    return sorted(filas, key=_ordenNulos)
+
+
+def compararOrdenados(antes, despues):
+    """
+    Merge walk over two sorted lists of tuples (estadoEn/estadoActual order).
+    Returns (only in antes, only in despues), both still sorted. O(n + m), no joins.
+    """
+    soloAntes = []
+    soloDespues = []
+    i = j = 0
+    while i < len(antes) and j < len(despues):
+        a = _ordenNulos(antes[i])
+        b = _ordenNulos(despues[j])
+        if a == b:
+            i += 1
+            j += 1
+        elif a < b:
+            soloAntes.append(antes[i])
+            i += 1
+        else:
+            soloDespues.append(despues[j])
+            j += 1
+    soloAntes.extend(antes[i:])
+    soloDespues.extend(despues[j:])
+    return soloAntes, soloDespues
@@ -0,0 +1,476 @@
+"""
+Hostname Resolution (DHCP leases, reverse DNS and NetBIOS)
+Incremental DHCP lease file reader plus native asyncio PTR and NBSTAT
+queriers, used by snmpPyServer's hostname worker. Each source is cached
+per IP in hostnameCache; the name shown in `hostname` is the best cached
+answer by PRIORIDAD.
+
+SnmpQuery - Network Discovery and Monitoring Tool
+Copyright (C) 2025 Agustin Garcia Maiztegui
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+"""
+
+import asyncio
+import calendar
+import os
+import random
+import re
+import struct
+import time
+import ipaddress
+
+# ============================================================================
+# SOURCES
+# ============================================================================
+
+# Higher wins when more than one source knows a name for the same IP.
+PRIORIDAD = {
+    "dhcp": 3,
+    "dns": 2,
+    "netbios": 1,
+}
+
+
+def sqlPrioridad(columna):
+    """CASE expression giving the PRIORIDAD of the source stored in `columna`."""
+    casos = " ".join("WHEN '%s' THEN %d" % (fuente, valor) for fuente, valor in PRIORIDAD.items())
+    return "(CASE %s %s ELSE 0 END)" % (columna, casos)
+
+
+def fusionarHostnames(localCur, lasIPs, unStamp, retirar=()):
+    """
+    Copies the best positive answer of hostnameCache into hostname, for every IP in lasIPs.
+    IPs without any positive answer are left as they are (a NetBIOS or DNS timeout does not
+    erase a name), except when the name shown came from a source in `retirar` whose answer
+    is now negative (a released DHCP lease): then the next best answer replaces it, or the
+    name is removed.
+    """
+    for fuente in retirar:
+        localCur.executemany("""
+            DELETE FROM hostname
+            WHERE ipaddr = ? AND source = ? AND EXISTS (
+                SELECT 1 FROM hostnameCache AS c
+                WHERE c.ipaddr = hostname.ipaddr AND c.source = hostname.source AND c.hostname IS NULL
+            )
+            """, [(unaIP, fuente) for unaIP in lasIPs])
+    localCur.executemany("""
+        INSERT INTO hostname (stamp, ipaddr, hostname, source)
+        SELECT ?, ipaddr, hostname, source
+        FROM hostnameCache
+        WHERE ipaddr = ? AND hostname IS NOT NULL
+        ORDER BY """+sqlPrioridad("source")+""" DESC, CAST(stamp AS REAL) DESC
+        LIMIT 1
+        ON CONFLICT(ipaddr) DO UPDATE SET
+            stamp = excluded.stamp,
+            hostname = excluded.hostname,
+            source = excluded.source
+        """, [(unStamp, unaIP) for unaIP in lasIPs])
+
+
+# ============================================================================
+# DHCP LEASES (ISC dhcpd.leases / Kea memfile CSV)
+# ============================================================================
+
+_ISC_BLOQUE = re.compile(r"lease\s+(\S+)\s*\{(.*?)\}", re.S)
+_ISC_MAC = re.compile(r"^\s*hardware\s+ethernet\s+([0-9A-Fa-f:]+)\s*;", re.M)
+_ISC_NOMBRE = re.compile(r'^\s*client-hostname\s+"([^"]*)"\s*;', re.M)
+_ISC_ESTADO = re.compile(r"^\s*binding\s+state\s+(\w+)\s*;", re.M)
+_ISC_FIN = re.compile(r"^\s*ends\s+(?:\d\s+(\d{4}/\d\d/\d\d\s+\d\d:\d\d:\d\d)|epoch\s+(\d+)|(never))", re.M)
+
+
+def _finISC(bloque):
+    # Lease end as a unix timestamp (None: never / not present). dhcpd writes UTC.
+    unMatch = _ISC_FIN.search(bloque)
+    if unMatch is None or unMatch.group(3):
+        return None
+    if unMatch.group(2):
+        return float(unMatch.group(2))
+    return float(calendar.timegm(time.strptime(unMatch.group(1), "%Y/%m/%d %H:%M:%S")))
+
+
+def parsearLeasesISC(texto):
+    """
+    Lease blocks of an ISC dhcpd.leases chunk, in file order.
+    Each one: (ip, mac, hostname or None, activo, vence or None).
+    """
+    leases = []
+    for unMatch in _ISC_BLOQUE.finditer(texto):
+        bloque = unMatch.group(2)
+        laMac = _ISC_MAC.search(bloque)
+        elNombre = _ISC_NOMBRE.search(bloque)
+        elEstado = _ISC_ESTADO.search(bloque)
+        activo = (elEstado is None) or (elEstado.group(1) == "active")
+        leases.append((
+            unMatch.group(1),
+            laMac.group(1) if laMac else None,
+            (elNombre.group(1) or None) if elNombre else None,
+            activo,
+            _finISC(bloque),
+        ))
+    return leases
+
+
+def parsearLeasesKea(lineas, cabecera):
+    """
+    Rows of a Kea memfile CSV (kea-leases4.csv), `cabecera` being its first line.
+    Same tuples as parsearLeasesISC. Kea's state 0 is "default" (active).
+    """
+    columnas = cabecera.strip().split(",")
+    try:
+        iIP = columnas.index("address")
+        iMac = columnas.index("hwaddr")
+        iNombre = columnas.index("hostname")
+        iVence = columnas.index("expire")
+        iEstado = columnas.index("state")
+    except ValueError:
+        return []
+    leases = []
+    for linea in lineas:
+        campos = linea.strip().split(",")
+        if len(campos) < len(columnas) or campos[iIP] == "address":
+            continue
+        try:
+            vence = float(campos[iVence])
+        except ValueError:
+            vence = None
+        leases.append((
+            campos[iIP],
+            campos[iMac] or None,
+            campos[iNombre].rstrip(".") or None,
+            campos[iEstado] == "0",
+            vence,
+        ))
+    return leases
+
+
+def leerLeasesNuevos(archivo, inode, offset):
+    """
+    Reads what was appended to a lease file since `offset`.
+    If the file was rotated (new inode) or truncated, it starts over from 0.
+    Only complete records are consumed; a half written one is left for the next call.
+    Returns (inode, nuevoOffset, [leases]) or None if the file can't be read.
+    """
+    try:
+        with open(archivo, "rb") as elArchivo:
+            estado = os.fstat(elArchivo.fileno())
+            if inode is None or estado.st_ino != int(inode) or estado.st_size < int(offset):
+                offset = 0
+            offset = int(offset)
+            cabecera = elArchivo.readline().decode("utf-8", "replace")
+            esKea = cabecera.startswith("address,")
+            elArchivo.seek(offset)
+            nuevo = elArchivo.read()
+    except OSError:
+        return None
+    if esKea:
+        fin = nuevo.rfind(b"\n")
+        if fin < 0:
+            return (estado.st_ino, offset, [])
+        lineas = nuevo[:fin + 1].decode("utf-8", "replace").splitlines()
+        return (estado.st_ino, offset + fin + 1, parsearLeasesKea(lineas, cabecera))
+    fin = nuevo.rfind(b"}")
+    if fin < 0:
+        return (estado.st_ino, offset, [])
+    texto = nuevo[:fin + 1].decode("utf-8", "replace")
+    return (estado.st_ino, offset + fin + 1, parsearLeasesISC(texto))
+
+
+# ============================================================================
+# NETBIOS NODE STATUS (RFC 1002, 4.2.17 / 4.2.18)
+# ============================================================================
+
+NETBIOS_PORT = 137
+
+# "*" padded with NULs to 16 bytes, first-level encoded (each nibble + 'A').
+_NOMBRE_COMODIN = b"".join(
+    bytes((0x41 + (c >> 4), 0x41 + (c & 0x0F))) for c in b"*" + b"\x00" * 15
+)
+_QTYPE_NBSTAT = 0x0021
+_QCLASS_IN = 0x0001
+
+
+def armarConsulta(txid):
+    """NBSTAT request for the wildcard name, transaction id `txid`."""
+    cabecera = struct.pack("!HHHHHH", txid, 0x0000, 1, 0, 0, 0)
+    pregunta = bytes((32,)) + _NOMBRE_COMODIN + b"\x00" + struct.pack("!HH", _QTYPE_NBSTAT, _QCLASS_IN)
+    return cabecera + pregunta
+
+
+def _saltearNombre(data, pos):
+    # Skips a (possibly compressed) name. Returns the offset right after it.
+    while pos < len(data):
+        largo = data[pos]
+        if largo == 0:
+            return pos + 1
+        if largo & 0xC0 == 0xC0:
+            return pos + 2
+        pos = pos + 1 + largo
+    raise ValueError("nombre truncado")
+
+
+def parsearRespuesta(data):
+    """
+    Extracts the workstation name (suffix 0x00, unique) from an NBSTAT answer.
+    Returns None if the packet is not a usable NBSTAT response.
+    """
+    if len(data) < 12:
+        return None
+    flags, qdcount, ancount = struct.unpack("!HHH", data[2:8])
+    if not (flags & 0x8000) or (flags & 0x000F) or ancount < 1:
+        return None
+    try:
+        pos = 12
+        for _ in range(qdcount):
+            pos = _saltearNombre(data, pos) + 4
+        pos = _saltearNombre(data, pos)
+        tipo, _clase, _ttl, _rdlength = struct.unpack("!HHIH", data[pos:pos + 10])
+        if tipo != _QTYPE_NBSTAT:
+            return None
+        pos = pos + 10
+        cantidad = data[pos]
+        pos = pos + 1
+        primero = None
+        for _ in range(cantidad):
+            entrada = data[pos:pos + 18]
+            if len(entrada) < 18:
+                break
+            pos = pos + 18
+            nombre = entrada[:15].decode("ascii", "replace").rstrip(" \x00")
+            sufijo = entrada[15]
+            (nbFlags,) = struct.unpack("!H", entrada[16:18])
+            esGrupo = bool(nbFlags & 0x8000)
+            if sufijo == 0x00 and not esGrupo and nombre:
+                return nombre
+            if primero is None and not esGrupo and nombre:
+                primero = nombre
+        return primero
+    except (IndexError, ValueError, struct.error):
+        return None
+
+
+# ============================================================================
+# REVERSE DNS (PTR)
+# ============================================================================
+
+DNS_PORT = 53
+_QTYPE_PTR = 12
+_QTYPE_SOA = 6
+
+
+def nombrePTR(unaIP):
+    """1.2.3.4 -> 4.3.2.1.in-addr.arpa (ip6.arpa for IPv6)."""
+    return ipaddress.ip_address(unaIP).reverse_pointer
+
+
+def armarConsultaPTR(txid, unaIP):
+    """Recursive PTR query for unaIP, transaction id `txid`."""
+    cabecera = struct.pack("!HHHHHH", txid, 0x0100, 1, 0, 0, 0)
+    etiquetas = b""
+    for etiqueta in nombrePTR(unaIP).split("."):
+        etiquetas = etiquetas + bytes((len(etiqueta),)) + etiqueta.encode("ascii")
+    return cabecera + etiquetas + b"\x00" + struct.pack("!HH", _QTYPE_PTR, _QCLASS_IN)
+
+
+def _leerNombre(data, pos):
+    # Reads a (possibly compressed) domain name. Returns (name, offset right after it).
+    etiquetas = []
+    siguiente = None
+    saltos = 0
+    while True:
+        largo = data[pos]
+        if largo == 0:
+            pos = pos + 1
+            break
+        if largo & 0xC0 == 0xC0:
+            if siguiente is None:
+                siguiente = pos + 2
+            pos = ((largo & 0x3F) << 8) | data[pos + 1]
+            saltos = saltos + 1
+            if saltos > 32:
+                raise ValueError("bucle de compresion")
+            continue
+        etiquetas.append(data[pos + 1:pos + 1 + largo].decode("ascii", "replace"))
+        pos = pos + 1 + largo
+    if siguiente is None:
+        siguiente = pos
+    return (".".join(etiquetas), siguiente)
+
+
+def parsearRespuestaPTR(data):
+    """
+    Returns (hostname, ttl) from a PTR answer.
+      - (name, ttl): found, cacheable for ttl seconds.
+      - (None, ttl): NXDOMAIN / no PTR. ttl from the SOA (RFC 2308), None if there is no SOA.
+      - None: unusable answer (SERVFAIL, REFUSED, truncated...). Asked again later.
+    """
+    if len(data) < 12:
+        return None
+    flags, qdcount, ancount, nscount = struct.unpack("!HHHH", data[2:10])
+    rcode = flags & 0x000F
+    if not (flags & 0x8000) or (flags & 0x0200) or rcode not in (0, 3):
+        return None
+    try:
+        pos = 12
+        for _ in range(qdcount):
+            pos = _leerNombre(data, pos)[1] + 4
+        for _ in range(ancount):
+            pos = _leerNombre(data, pos)[1]
+            tipo, _clase, ttl, rdlength = struct.unpack("!HHIH", data[pos:pos + 10])
+            pos = pos + 10
+            if tipo == _QTYPE_PTR and rcode == 0:
+                return (_leerNombre(data, pos)[0].rstrip("."), ttl)
+            pos = pos + rdlength
+        for _ in range(nscount):
+            pos = _leerNombre(data, pos)[1]
+            tipo, _clase, ttl, rdlength = struct.unpack("!HHIH", data[pos:pos + 10])
+            pos = pos + 10
+            if tipo == _QTYPE_SOA:
+                finRdata = pos + rdlength
+                pos = _leerNombre(data, pos)[1]
+                pos = _leerNombre(data, pos)[1]
+                if pos + 20 > finRdata:
+                    return None
+                (minimo,) = struct.unpack("!I", data[pos + 16:pos + 20])
+                return (None, min(ttl, minimo))
+            pos = pos + rdlength
+        return (None, None)
+    except (IndexError, ValueError, struct.error):
+        return None
+
+
+def servidoresDNS(configurados=None, resolvConf="/etc/resolv.conf"):
+    """
+    DNS servers as [(ip, port)]. `configurados` is the DNS_SERVERS setting
+    ("10.0.0.2,10.0.0.3" or "127.0.0.1:5353"); without it, resolv.conf is used.
+    """
+    servidores = []
+    if configurados:
+        for unServidor in configurados.split(","):
+            unServidor = unServidor.strip()
+            if not unServidor:
+                continue
+            if unServidor.count(":") == 1:
+                ip, puerto = unServidor.split(":")
+                servidores.append((ip, int(puerto)))
+            else:
+                servidores.append((unServidor, DNS_PORT))
+        return servidores
+    try:
+        with open(resolvConf) as archivo:
+            for linea in archivo:
+                partes = linea.split()
+                if len(partes) >= 2 and partes[0] == "nameserver" and ":" not in partes[1]:
+                    # The querier socket is IPv4 only.
+                    servidores.append((partes[1], DNS_PORT))
+    except OSError:
+        pass
+    return servidores
+
+
+# ============================================================================
+# ASYNC QUERIER
+# ============================================================================
+
+class _UdpProtocol(asyncio.DatagramProtocol):
+    # One socket for every query; answers are matched by (source ip, txid).
+    def __init__(self):
+        self.pendientes = {}
+
+    def datagram_received(self, data, addr):
+        if len(data) < 2:
+            return
+        (txid,) = struct.unpack("!H", data[:2])
+        futuro = self.pendientes.get((addr[0], txid))
+        if futuro is not None and not futuro.done():
+            futuro.set_result(data)
+
+    def error_received(self, exc):
+        # ICMP unreachable and friends: the affected query simply times out.
+        pass
+
+
+async def _consultarUno(transporte, protocolo, semaforo, clave, destinos, armar, parsear, timeout, retries):
+    # Sends armar(txid) to destinos[intento % len(destinos)] until parsear() gives something.
+    loop = asyncio.get_running_loop()
+    async with semaforo:
+        for intento in range(retries + 1):
+            destino = destinos[intento % len(destinos)]
+            txid = random.randint(0, 0xFFFF)
+            while (destino[0], txid) in protocolo.pendientes:
+                txid = random.randint(0, 0xFFFF)
+            futuro = loop.create_future()
+            protocolo.pendientes[(destino[0], txid)] = futuro
+            try:
+                transporte.sendto(armar(txid), destino)
+                resultado = parsear(await asyncio.wait_for(futuro, timeout))
+                if resultado is not None:
+                    return (clave, resultado)
+            except (asyncio.TimeoutError, OSError):
+                pass
+            finally:
+                protocolo.pendientes.pop((destino[0], txid), None)
+    return (clave, None)
+
+
+async def _consultarTodos(consultas, timeout, retries, concurrencia):
+    # consultas: [(clave, destinos, armar, parsear)]. Returns {clave: resultado or None}.
+    if not consultas:
+        return {}
+    loop = asyncio.get_running_loop()
+    transporte, protocolo = await loop.create_datagram_endpoint(
+        _UdpProtocol, local_addr=("0.0.0.0", 0)
+    )
+    try:
+        semaforo = asyncio.Semaphore(concurrencia)
+        tareas = [
+            _consultarUno(transporte, protocolo, semaforo, clave, destinos, armar, parsear, timeout, retries)
+            for clave, destinos, armar, parsear in consultas
+        ]
+        return dict(await asyncio.gather(*tareas))
+    finally:
+        transporte.close()
+
+
+async def consultarNetbios(lasIPs, timeout=0.5, retries=1, concurrencia=64):
+    """
+    Asks every IP in `lasIPs` for its NetBIOS name.
+    Returns {ip: hostname or None}; None means no (usable) answer.
+    At most `concurrencia` queries are in flight at any time.
+    """
+    consultas = [
+        (unaIP, [(unaIP, NETBIOS_PORT)], armarConsulta, parsearRespuesta)
+        for unaIP in lasIPs
+    ]
+    return await _consultarTodos(consultas, timeout, retries, concurrencia)
+
+
+def resolverNetbios(lasIPs, timeout=0.5, retries=1, concurrencia=64):
+    """Blocking wrapper around consultarNetbios(), for the worker process."""
+    return asyncio.run(consultarNetbios(lasIPs, timeout, retries, concurrencia))
+
+
+async def consultarPTR(lasIPs, servidores, timeout=1.0, retries=2, concurrencia=32):
+    """
+    Reverse DNS for every IP in `lasIPs`, against `servidores` [(ip, port)]
+    (retries rotate through them). Returns {ip: (hostname, ttl) or None},
+    see parsearRespuestaPTR. At most `concurrencia` queries are in flight.
+    """
+    if not servidores:
+        return {unaIP: None for unaIP in lasIPs}
+    consultas = []
+    for unaIP in lasIPs:
+        def armar(txid, unaIP=unaIP):
+            return armarConsultaPTR(txid, unaIP)
+        # Each IP starts on a different server, so the load is spread.
+        inicio = len(consultas) % len(servidores)
+        consultas.append((unaIP, servidores[inicio:] + servidores[:inicio], armar, parsearRespuestaPTR))
+    return await _consultarTodos(consultas, timeout, retries, concurrencia)
+
+
+def resolverPTR(lasIPs, servidores, timeout=1.0, retries=2, concurrencia=32):
+    """Blocking wrapper around consultarPTR(), for the worker process."""
+    return asyncio.run(consultarPTR(lasIPs, servidores, timeout, retries, concurrencia))
@@ -0,0 +1,166 @@
+"""
+Memory Accounting
+Every process (daemon, pool workers, hostname worker, netflow processor,
+collector) writes a small JSON report to the ramdisk at its cycle
+boundaries: RSS always, and with MEMORY_TRACE=1 also the tracemalloc
+totals and the allocation sites that grew the most since the previous
+report. The web server's /metrics exports them (exportarMetricas), so a
+leak shows up as a steadily growing site long before the box swaps.
+
+SnmpQuery - Network Discovery and Monitoring Tool
+Copyright (C) 2025 Agustin Garcia Maiztegui
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+"""
+
+import glob
+import json
+import os
+import time
+import tracemalloc
+import metricas
+
+DIR_MEMORIA = "/ramdisk/memoria"
+# Allocations made by tracemalloc itself and by imports are not interesting.
+_FILTROS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def rss():
+    """Resident set size of this process, in bytes (0 if /proc is not there)."""
+    try:
+        with open("/proc/self/statm") as archivo:
+            return int(archivo.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class Contabilidad:
+    """Memory reports of one process, written as <proceso>.json in `directorio`."""
+
+    def __init__(self, proceso, directorio=DIR_MEMORIA, top=15):
+        self.proceso = proceso
+        self.directorio = directorio
+        self.top = top
+        self._anterior = None
+        self._pid = os.getpid()
+        self._ultimo = 0.0
+
+    def configurar(self, activo, cuadros=1):
+        """MEMORY_TRACE on/off, applied at a cycle boundary."""
+        if activo:
+            self.habilitar(cuadros)
+        else:
+            self.deshabilitar()
+
+    def habilitar(self, cuadros=1):
+        """Starts tracemalloc (cuadros = frames kept per allocation; 1 is the cheapest)."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(cuadros)
+
+    def deshabilitar(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._anterior = None
+
+    def cortarCada(self, intervalo):
+        """cortar(), for loops without cycles: at most once every `intervalo` seconds."""
+        if time.time() - self._ultimo < intervalo:
+            return None
+        return self.cortar()
+
+    def cortar(self):
+        """One report at a cycle boundary. Returns it (also written to disk)."""
+        if os.getpid() != self._pid:
+            # Forked child (e.g. a pool worker): it gets its own baseline.
+            self._pid = os.getpid()
+            self._anterior = None
+        self._ultimo = time.time()
+        reporte = {"proceso": self.proceso, "pid": self._pid, "stamp": time.time(), "rss": rss()}
+        if tracemalloc.is_tracing():
+            actual, pico = tracemalloc.get_traced_memory()
+            reporte["traced"] = actual
+            reporte["tracedPeak"] = pico
+            foto = tracemalloc.take_snapshot().filter_traces(_FILTROS)
+            if self._anterior is not None:
+                reporte["crecimiento"] = [
+                    {
+                        "sitio": str(diferencia.traceback[0]),
+                        "bytes": diferencia.size,
+                        "delta": diferencia.size_diff,
+                        "bloques": diferencia.count,
+                    }
+                    for diferencia in foto.compare_to(self._anterior, "lineno")[:self.top]
+                    if diferencia.size_diff > 0
+                ]
+            self._anterior = foto
+        self._escribir(reporte)
+        return reporte
+
+    def _escribir(self, reporte):
+        try:
+            os.makedirs(self.directorio, exist_ok=True)
+            ruta = os.path.join(self.directorio, self.proceso + ".json")
+            with open(ruta + ".tmp", "w") as archivo:
+                json.dump(reporte, archivo)
+            os.replace(ruta + ".tmp", ruta)
+        except OSError:
+            pass
+
+
+def borrar(patron, directorio=DIR_MEMORIA):
+    """Removes the reports of processes that are gone (e.g. "pool-*" once the pool is closed)."""
+    for ruta in glob.glob(os.path.join(directorio, patron + ".json")):
+        try:
+            os.remove(ruta)
+        except OSError:
+            pass
+
+
+def leerReportes(directorio=DIR_MEMORIA, vencidos=3600):
+    """Every process report, newest first. Reports older than `vencidos` seconds are deleted."""
+    reportes = []
+    ahora = time.time()
+    for ruta in glob.glob(os.path.join(directorio, "*.json")):
+        try:
+            with open(ruta) as archivo:
+                reporte = json.load(archivo)
+        except (OSError, ValueError):
+            continue
+        if ahora - reporte.get("stamp", 0) > vencidos:
+            try:
+                os.remove(ruta)
+            except OSError:
+                pass
+            continue
+        reportes.append(reporte)
+    reportes.sort(key=lambda reporte: reporte["stamp"], reverse=True)
+    return reportes
+
+
+def exportarMetricas(reportes=None):
+    """The latest report of every process as Prometheus text, for /metrics."""
+    registro = metricas.Registro("memoria")
+    mRss = registro.gauge("process_resident_bytes", "Resident set size at the process's last memory report.")
+    mReporte = registro.gauge("memory_report_timestamp_seconds", "When the process wrote its last memory report.")
+    mTrazada = registro.gauge("memory_traced_bytes", "Memory held by traced allocations (MEMORY_TRACE=1).")
+    mSitios = registro.gauge("memory_growing_sites", "Allocation sites that grew since the previous report (MEMORY_TRACE=1).")
+    mCrecimiento = registro.gauge("memory_site_growth_bytes", "Growth of each of those sites since the previous report.")
+    for reporte in (leerReportes() if reportes is None else reportes):
+        proceso = reporte.get("proceso", "?")
+        mRss.set(reporte.get("rss", 0), process=proceso)
+        mReporte.set(round(reporte.get("stamp", 0), 3), process=proceso)
+        if "traced" in reporte:
+            mTrazada.set(reporte["traced"], process=proceso)
+        if "crecimiento" in reporte:
+            mSitios.set(len(reporte["crecimiento"]), process=proceso)
+            for sitio in reporte["crecimiento"]:
+                mCrecimiento.set(sitio["delta"], process=proceso, site=sitio["sitio"])
+    return registro.exportar()
@@ -0,0 +1,203 @@
+"""
+Internal Metrics (Prometheus text format)
+Each process (daemon, netflow processor, web server) keeps its own counters,
+gauges and histograms in memory. The background processes dump them to a
+small file on the ramdisk (metrics_<process>.prom, atomically replaced) and
+the web server's /metrics merges those files with its own metrics.
+
+SnmpQuery - Network Discovery and Monitoring Tool
+Copyright (C) 2025 Agustin Garcia Maiztegui
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+"""
+
+import bisect
+import glob
+import os
+import threading
+import time
+
+DIR_METRICAS = "/ramdisk"
+PREFIJO = "snmpq_"
+TIPO_CONTENIDO = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds. Fits both an SNMP phase (ms) and a whole cycle (minutes).
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _etiquetas(claves):
+    if not claves:
+        return ""
+    return "{" + ",".join(
+        nombre + '="' + str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for nombre, valor in claves
+    ) + "}"
+
+
+def _numero(valor):
+    if valor == float("inf"):
+        return "+Inf"
+    if float(valor).is_integer():
+        return str(int(valor))
+    return repr(float(valor))
+
+
+# ============================================================================
+# METRIC TYPES
+# ============================================================================
+
+class _Metrica:
+    tipo = "untyped"
+
+    def __init__(self, nombre, ayuda):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self._valores = {}
+        self._lock = threading.Lock()
+
+    def exportar(self):
+        lineas = ["# HELP " + self.nombre + " " + self.ayuda, "# TYPE " + self.nombre + " " + self.tipo]
+        with self._lock:
+            for claves, valor in sorted(self._valores.items()):
+                lineas.extend(self._lineas(claves, valor))
+        return lineas
+
+    def _lineas(self, claves, valor):
+        return [self.nombre + _etiquetas(claves) + " " + _numero(valor)]
+
+
+class Contador(_Metrica):
+    tipo = "counter"
+
+    def inc(self, cantidad=1, **etiquetas):
+        claves = tuple(sorted(etiquetas.items()))
+        with self._lock:
+            self._valores[claves] = self._valores.get(claves, 0) + cantidad
+
+
+class Gauge(_Metrica):
+    tipo = "gauge"
+
+    def set(self, valor, **etiquetas):
+        with self._lock:
+            self._valores[tuple(sorted(etiquetas.items()))] = valor
+
+
+class Histograma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, buckets=BUCKETS_SEGUNDOS):
+        super().__init__(nombre, ayuda)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, valor, **etiquetas):
+        claves = tuple(sorted(etiquetas.items()))
+        with self._lock:
+            cuentas = self._valores.get(claves)
+            if cuentas is None:
+                # one count per bucket (not cumulative), the +Inf overflow, then the sum.
+                cuentas = self._valores[claves] = [0] * (len(self.buckets) + 1) + [0.0]
+            cuentas[bisect.bisect_left(self.buckets, valor)] += 1
+            cuentas[-1] += valor
+
+    def _lineas(self, claves, cuentas):
+        lineas = []
+        acumulado = 0
+        for limite, cantidad in zip(self.buckets + (float("inf"),), cuentas):
+            acumulado += cantidad
+            lineas.append(
+                self.nombre + "_bucket" + _etiquetas(claves + (("le", _numero(limite)),)) + " " + str(acumulado)
+            )
+        lineas.append(self.nombre + "_sum" + _etiquetas(claves) + " " + _numero(cuentas[-1]))
+        lineas.append(self.nombre + "_count" + _etiquetas(claves) + " " + str(acumulado))
+        return lineas
+
+
+# ============================================================================
+# REGISTRY
+# ============================================================================
+
+class Registro:
+    """The metrics of one process. Asking twice for the same name returns the same metric."""
+
+    def __init__(self, proceso):
+        self.proceso = proceso
+        self._metricas = {}
+
+    def _obtener(self, clase, nombre, ayuda, *args):
+        nombre = PREFIJO + nombre
+        if nombre not in self._metricas:
+            self._metricas[nombre] = clase(nombre, ayuda, *args)
+        return self._metricas[nombre]
+
+    def contador(self, nombre, ayuda):
+        return self._obtener(Contador, nombre, ayuda)
+
+    def gauge(self, nombre, ayuda):
+        return self._obtener(Gauge, nombre, ayuda)
+
+    def histograma(self, nombre, ayuda, buckets=BUCKETS_SEGUNDOS):
+        return self._obtener(Histograma, nombre, ayuda, buckets)
+
+    def exportar(self):
+        lineas = []
+        for nombre in sorted(self._metricas):
+            lineas.extend(self._metricas[nombre].exportar())
+        return "\n".join(lineas) + "\n"
+
+    def volcar(self, directorio=DIR_METRICAS):
+        """Writes metrics_<proceso>.prom, replacing the previous one in a single rename."""
+        ruta = os.path.join(directorio, "metrics_" + self.proceso + ".prom")
+        temporal = ruta + ".tmp"
+        with open(temporal, "w") as archivo:
+            archivo.write("# snmpq process " + self.proceso + " dumped at " + _numero(round(time.time(), 3)) + "\n")
+            archivo.write(self.exportar())
+        os.replace(temporal, ruta)
+
+
+def leerVolcados(directorio=DIR_METRICAS):
+    """The metrics files dumped by the other processes (missing ones are skipped), merged by family."""
+    partes = []
+    for ruta in sorted(glob.glob(os.path.join(directorio, "metrics_*.prom"))):
+        try:
+            with open(ruta) as archivo:
+                partes.append(archivo.read())
+        except OSError:
+            continue
+    return unirFamilias(partes)
+
+
+def unirFamilias(textos):
+    """
+    Several exports as one: each family once (HELP and TYPE from its first appearance) with the
+    samples of every text under it. Several processes may export the same family (e.g. one
+    collector receiver each), and the text format allows a family only once per scrape.
+    Other comments go first.
+    """
+    comentarios = []
+    familias = {}       # name -> [HELP, TYPE, samples]; dicts keep the first-appearance order
+    for texto in textos:
+        familia = None
+        for linea in texto.splitlines():
+            if not linea.strip():
+                continue
+            if linea.startswith("# HELP ") or linea.startswith("# TYPE "):
+                partes = linea.split(" ", 3)
+                familia = familias.setdefault(partes[2], [None, None, []])
+                indice = 0 if partes[1] == "HELP" else 1
+                if familia[indice] is None:
+                    familia[indice] = linea
+            elif linea.startswith("#"):
+                comentarios.append(linea)
+            elif familia is not None:
+                familia[2].append(linea)
+            else:
+                comentarios.append(linea)
+    lineas = list(comentarios)
+    for ayuda, tipo, muestras in familias.values():
+        lineas.extend(linea for linea in (ayuda, tipo) if linea is not None)
+        lineas.extend(muestras)
+    return "\n".join(lineas) + "\n" if lineas else ""
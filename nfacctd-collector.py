@@ -19,7 +19,10 @@ GNU Affero General Public License for more details.
 You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-nfacctd-collector.py - Netflow Collector using nfacctd. Maintains a raw flows table
+nfacctd-collector.py - Netflow Collector. Maintains a raw flows table.
+By default it decodes NetFlow v5/v9 and IPFIX itself (asyncio UDP receiver, one
+template cache per exporter); with COLECTOR_NATIVO = False it runs nfacctd
+(pmacct) with the print plugin and parses its output, as before.
 """
 
 
@@ -31,13 +34,66 @@ import threading
 import traceback
 import signal
 import logging
+import asyncio
+import collections
+import json
+import os
+import multiprocessing
+import socket
+import struct
+try:
+    # Memory reports for /metrics (memoria.py, next to the daemon). Optional in a standalone collector.
+    import memoria
+except ImportError:
+    memoria = None
+try:
+    # Per-exporter counters for /metrics (metricas.py). Same: optional.
+    import metricas
+except ImportError:
+    metricas = None
 
 
 RAMDISK_DB = "/ramdisk/nfacctd.db"
 BASE_DIR = pathlib.Path(__file__).resolve().parent
 nfacctdCONF = BASE_DIR / "nfacctd.conf"
-intervalo_buffer_tabla_flows = 0.5
 tiempoRetencion = 1860 # Seconds. Time to keep the data.
+# Flows are stored in one table per minute (flows_<epoch minute>): pruning drops whole tables.
+PREFIJO_BUCKET = "flows_"
+SEGUNDOS_BUCKET = 60
+# Pre-aggregation: flow records are summed in memory per (src, dst, sport, dport, proto)
+#  and written as one row per key every AGREGADO_SEGUNDOS (slices aligned to the clock).
+#  1 matches nfacctd's print_refresh_time; 5 writes (and makes the processor scan) far fewer
+#  rows on busy links, at the cost of that much latency.
+AGREGADO_SEGUNDOS = 1.0
+# Bounds, so a flood or a slow ramdisk cannot eat the box:
+#  MAX_CLAVES: 5-tuples per slice. Past it, new keys lose their ports (src, dst, 0, 0, proto);
+#   past twice that, new keys are dropped (and counted).
+#  MAX_FILAS_PENDIENTES: rows waiting to be written (a failed write is retried next slice).
+#   Past it, POLITICA_DESBORDE decides: "viejos" drops the oldest rows, "muestrear" keeps
+#   1 in N rows with their counters multiplied by N, "agregar" re-sums the pending rows
+#   without ports. The last two keep the byte totals right and lose detail instead.
+MAX_CLAVES = 200000
+MAX_FILAS_PENDIENTES = 500000
+POLITICA_DESBORDE = "agregar"
+# Native collector (no nfacctd needed).
+COLECTOR_NATIVO = True
+PUERTO_NETFLOW = 2055
+RECEPTORES = 1          # >1: that many receiver processes on the same port (SO_REUSEPORT).
+BUFFER_UDP = 8388608    # SO_RCVBUF asked for each receiver socket (capped by net.core.rmem_max).
+# Sampled exporters: packets and bytes are multiplied by the exporter's 1:N rate. It is taken
+#  from the v5 header or the v9/IPFIX options data; set it here for exporters that do not
+#  announce it (or announce it wrong), e.g. {"10.0.0.1": 100}.
+MUESTREO_EXPORTADORES = {}
+# Routers that see the same traffic: a 5-tuple already reported by another exporter in the
+#  last DEDUP_SEGUNDOS is dropped (0: off). Exporters on different receivers are not compared.
+DEDUP_SEGUNDOS = 10
+# Hand-off to netflowProcessor.py over its Unix socket (native collector only). nfacctd.db is
+#  still written when the processor is not listening or is behind by more than BUFFER_SALIDA bytes
+#  (or MAX_FILAS_PENDIENTES rows it has not acknowledged), and gets the unacknowledged batches
+#  of a connection that drops.
+ENTREGA_DIRECTA = True
+RUTA_SOCKET = "/ramdisk/netflow.sock"
+BUFFER_SALIDA = 4194304
 # ---------------------------------------------------------------------------------------------------------------------
 stop_event = threading.Event()
 def handle_sigterm(signum, frame):
@@ -51,18 +107,8 @@ signal.signal(signal.SIGINT, handle_sigterm)
 
 def crearDB(ramDB):
     cur = ramDB.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS flows (
-        stamp TEXT,
-        srcIP TEXT,
-        dstIP TEXT,
-        srcPort TEXT,
-        dstPort TEXT,
-        protocol TEXT,
-        packets TEXT,
-        bytes TEXT
-    )
-    """)
+    # The single TEXT `flows` table of older versions: replaced by the per-minute buckets (AlmacenFlujos).
+    cur.execute("DROP TABLE IF EXISTS flows")
     
     cur.execute("""
     CREATE TABLE IF NOT EXISTS sumarizados (
@@ -82,10 +128,11 @@ def crearDB(ramDB):
 # ---------------------------------------------------------------------------------------------------------------------
 
 def CollectorPipe():
-    ramDB = sqlite3.connect(RAMDISK_DB, isolation_level=None)
-    cur = ramDB.cursor()
-    insert_buffer = []
-    last_db_flush = time.time()
+    ramDB = sqlite3.connect(RAMDISK_DB, isolation_level=None, timeout=10)
+    almacen = AlmacenFlujos(ramDB)
+    agregador = Agregador()
+    cola = ColaEscritura(almacen)
+    proximoCorte = finDeTramo(time.time())
     try:
         proc = subprocess.Popen(
             ["nfacctd", "-f", nfacctdCONF],
@@ -126,41 +173,766 @@ def CollectorPipe():
                 continue  # skip malformed lines
             
             if bytes_val > 0 or packets_val > 0:
-                insert_buffer.append((
-                    str(now),
-                    src, dst, sport, dport, proto,
-                    str(packets_val),
-                    str(bytes_val)
-                ))
+                try:
+                    agregador.sumar(((src, dst, int(sport), int(dport), proto, packets_val, bytes_val),))
+                except ValueError:
+                    continue
             
             # --- flush buffer ---
-            if( ( (now - last_db_flush) >= intervalo_buffer_tabla_flows ) and ( insert_buffer ) ):
-                try:
-                    cur.execute("BEGIN IMMEDIATE")
-                    cur.executemany(
-                        "INSERT INTO flows VALUES (?,?,?,?,?,?,?,?)",
-                        insert_buffer
-                    )
-                    insert_buffer.clear()
-                    # PRUNING:
-                    floatStampCorte = time.time() - tiempoRetencion
-                    cur.execute("""
-                        DELETE FROM flows WHERE CAST(stamp AS REAL) < ?
-                        """, (floatStampCorte,))
-                    ramDB.commit()
-                    insert_buffer.clear()
-                    
-                except Exception as e:
-                    ramDB.rollback()
-                    logging.error(f"DB flush error: {e}")
-                    print("error!")
-                    traceback.print_exc()
-                last_db_flush = now
+            if( now >= proximoCorte ):
+                cola.agregar(agregador.cosechar())
+                cola.vaciar()
+                proximoCorte = finDeTramo(now)
     except Exception as e:
         logging.error(f"CollectorPipe error: {e}")
         print(e)
         traceback.print_exc()
-        
+
+
+class AlmacenFlujos:
+    """
+    Typed flow rows in per-minute tables (PREFIJO_BUCKET + epoch minute). A flush is one
+    INSERT into the current bucket; when the minute changes, the buckets older than
+    tiempoRetencion are dropped whole. So the flush cost does not grow with the retention.
+    """
+
+    def __init__(self, ramDB):
+        self.ramDB = ramDB
+        self.cur = ramDB.cursor()
+        self.bucketActual = None
+
+    def escribir(self, filas):
+        """Rows: (stamp, srcIP, dstIP, srcPort, dstPort, protocol, packets, bytes). One transaction."""
+        try:
+            self.cur.execute("BEGIN IMMEDIATE")
+            porBucket = {}
+            corte = int((time.time() - tiempoRetencion) // SEGUNDOS_BUCKET)
+            for fila in filas:
+                bucket = int(fila[0] // SEGUNDOS_BUCKET)
+                if bucket >= corte:     # already past the retention: it would be dropped right away
+                    porBucket.setdefault(bucket, []).append(fila)
+            for bucket, filasBucket in porBucket.items():
+                if bucket != self.bucketActual:
+                    self._rotar(bucket)
+                self.cur.executemany(
+                    "INSERT INTO " + PREFIJO_BUCKET + str(bucket) + " VALUES (?,?,?,?,?,?,?,?)",
+                    filasBucket
+                )
+            self.ramDB.commit()
+            return True
+        except Exception as e:
+            self.ramDB.rollback()
+            self.bucketActual = None
+            logging.error(f"DB flush error: {e}")
+            print("error!")
+            traceback.print_exc()
+            return False
+
+    def _rotar(self, bucket):
+        # Once a minute (or for a late row): creates the bucket and drops the expired ones.
+        self.cur.execute("""
+            CREATE TABLE IF NOT EXISTS """ + PREFIJO_BUCKET + str(bucket) + """ (
+                stamp REAL,
+                srcIP TEXT,
+                dstIP TEXT,
+                srcPort INTEGER,
+                dstPort INTEGER,
+                protocol TEXT,
+                packets INTEGER,
+                bytes INTEGER
+            )
+            """)
+        corte = int((time.time() - tiempoRetencion) // SEGUNDOS_BUCKET)
+        for nombre, viejo in listarBuckets(self.cur):
+            if viejo < corte:
+                self.cur.execute("DROP TABLE IF EXISTS " + nombre)
+        self.bucketActual = max(bucket, self.bucketActual or 0)
+
+
+def listarBuckets(cur):
+    """[(table, epoch minute)] of the flow buckets, oldest first."""
+    buckets = []
+    for (nombre,) in cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ?",
+                                 (PREFIJO_BUCKET + "%",)):
+        sufijo = nombre[len(PREFIJO_BUCKET):]
+        if sufijo.isdigit():
+            buckets.append((nombre, int(sufijo)))
+    buckets.sort(key=lambda bucket: bucket[1])
+    return buckets
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# NATIVE NETFLOW v5 / v9 / IPFIX DECODING
+# ---------------------------------------------------------------------------------------------------------------------
+
+# Information elements we keep (same numbers in NetFlow v9 and IPFIX).
+IN_BYTES, IN_PKTS, PROTOCOL, L4_SRC_PORT, IPV4_SRC_ADDR, L4_DST_PORT, IPV4_DST_ADDR = 1, 2, 4, 7, 8, 11, 12
+OUT_BYTES, OUT_PKTS, IPV6_SRC_ADDR, IPV6_DST_ADDR = 23, 24, 27, 28
+OCTET_TOTAL, PACKET_TOTAL = 85, 86
+# Sampling rate, in options data: samplingInterval, samplerRandomInterval, samplingPacketInterval.
+SAMPLING_INTERVAL, SAMPLER_RANDOM_INTERVAL, SAMPLING_PACKET_INTERVAL = 34, 50, 305
+VARIABLE = 65535    # IPFIX variable-length field
+
+# Protocol names as nfacctd prints them (anything else is stored as the number).
+PROTOCOLOS = {1: "icmp", 2: "igmp", 6: "tcp", 17: "udp", 41: "ipv6", 47: "gre", 50: "esp", 51: "ah",
+    58: "ipv6-icmp", 89: "ospf", 103: "pim", 112: "vrrp", 132: "sctp"}
+
+CABECERA_V5 = struct.Struct("!HHIIIIBBH")
+REGISTRO_V5 = struct.Struct("!4s4s8xII8xHHxxBx8x")     # src, dst, packets, bytes, sport, dport, proto
+CABECERA_V9 = struct.Struct("!HHIIII")
+CABECERA_IPFIX = struct.Struct("!HHIII")
+CABECERA_SET = struct.Struct("!HH")
+CABECERA_OPCIONES_V9 = struct.Struct("!HHH")
+_ENTEROS = {1: "B", 2: "H", 4: "I", 8: "Q"}
+
+
+class Plantilla:
+    """
+    One v9/IPFIX template, compiled to a struct.Struct when all its fields are fixed-length
+    (the usual case): decoding a data set is then one iter_unpack over a memoryview.
+    """
+
+    def __init__(self, campos, opciones=False):
+        # campos: [(element id, length)]; enterprise-specific elements come with id None.
+        self.campos = campos
+        self.opciones = opciones
+        self.variable = any(largo == VARIABLE for _tipo, largo in campos)
+        self.largo = 0 if self.variable else sum(largo for _tipo, largo in campos)
+        self.estructura = None
+        if self.opciones or self.variable or self.largo == 0:
+            return
+        formato = "!"
+        posiciones = {}
+        self._anchos = {}
+        for tipo, largo in campos:
+            if tipo in (IPV4_SRC_ADDR, IPV4_DST_ADDR, IPV6_SRC_ADDR, IPV6_DST_ADDR) and tipo not in posiciones:
+                posiciones[tipo] = len(posiciones)
+                formato = formato + str(largo) + "s"
+            elif tipo in (IN_BYTES, IN_PKTS, OUT_BYTES, OUT_PKTS, OCTET_TOTAL, PACKET_TOTAL, PROTOCOL,
+                          L4_SRC_PORT, L4_DST_PORT) and tipo not in posiciones:
+                posiciones[tipo] = len(posiciones)
+                if largo in _ENTEROS:
+                    formato = formato + _ENTEROS[largo]
+                else:
+                    # Odd-sized counters (3, 6 bytes...): int.from_bytes afterwards.
+                    formato = formato + str(largo) + "s"
+                    self._anchos[tipo] = largo
+            else:
+                formato = formato + str(largo) + "x"
+        self.estructura = struct.Struct(formato)
+        p = posiciones
+        self._indices = (
+            p.get(IPV4_SRC_ADDR, p.get(IPV6_SRC_ADDR)), p.get(IPV4_DST_ADDR, p.get(IPV6_DST_ADDR)),
+            p.get(L4_SRC_PORT), p.get(L4_DST_PORT), p.get(PROTOCOL),
+            p.get(IN_PKTS, p.get(PACKET_TOTAL, p.get(OUT_PKTS))), p.get(IN_BYTES, p.get(OCTET_TOTAL, p.get(OUT_BYTES))),
+        )
+
+    def registros(self, datos):
+        """(src, dst, sport, dport, proto, packets, bytes) of each record in a data set; addresses as bytes."""
+        if self.estructura is None:
+            return self._registrosVariables(datos) if self.variable else []
+        iSrc, iDst, iSport, iDport, iProto, iPkts, iBytes = self._indices
+        if iSrc is None or iDst is None:
+            return []       # options data, or a template without addresses
+        # Records are padded at the end of the set: only whole records.
+        cantidad = len(datos) // self.largo
+        filas = self.estructura.iter_unpack(datos[:cantidad * self.largo])
+        if not self._anchos:
+            return [
+                (r[iSrc], r[iDst],
+                 r[iSport] if iSport is not None else 0, r[iDport] if iDport is not None else 0,
+                 r[iProto] if iProto is not None else 0,
+                 r[iPkts] if iPkts is not None else 0, r[iBytes] if iBytes is not None else 0)
+                for r in filas
+            ]
+        devolver = []
+        for r in filas:
+            r = [int.from_bytes(v, "big") if (i != iSrc and i != iDst and isinstance(v, bytes)) else v
+                 for i, v in enumerate(r)]
+            devolver.append((r[iSrc], r[iDst],
+                 r[iSport] if iSport is not None else 0, r[iDport] if iDport is not None else 0,
+                 r[iProto] if iProto is not None else 0,
+                 r[iPkts] if iPkts is not None else 0, r[iBytes] if iBytes is not None else 0))
+        return devolver
+
+    def muestreo(self, datos):
+        """Sampling rate (1:N) announced in an options data set, or 0."""
+        for valores in self._recorrer(datos):
+            for tipo in (SAMPLING_INTERVAL, SAMPLER_RANDOM_INTERVAL, SAMPLING_PACKET_INTERVAL):
+                if tipo in valores and int.from_bytes(valores[tipo], "big") > 0:
+                    return int.from_bytes(valores[tipo], "big")
+        return 0
+
+    def _recorrer(self, datos):
+        # {element id: raw bytes} of each record, walked field by field (variable-length fields, options).
+        posicion = 0
+        while True:
+            valores = {}
+            try:
+                for tipo, largo in self.campos:
+                    if largo == VARIABLE:
+                        largo = datos[posicion]
+                        posicion = posicion + 1
+                        if largo == 255:
+                            largo = int.from_bytes(datos[posicion:posicion + 2], "big")
+                            posicion = posicion + 2
+                    if posicion + largo > len(datos):
+                        raise IndexError
+                    if tipo is not None and tipo not in valores:
+                        valores[tipo] = bytes(datos[posicion:posicion + largo])
+                    posicion = posicion + largo
+            except IndexError:
+                return      # padding (or a truncated record) at the end of the set
+            yield valores
+
+    def _registrosVariables(self, datos):
+        # IPFIX records with variable-length fields.
+        devolver = []
+        for valores in self._recorrer(datos):
+            src = valores.get(IPV4_SRC_ADDR, valores.get(IPV6_SRC_ADDR))
+            dst = valores.get(IPV4_DST_ADDR, valores.get(IPV6_DST_ADDR))
+            if src is None or dst is None:
+                continue
+            numero = lambda *tipos: next((int.from_bytes(valores[t], "big") for t in tipos if t in valores), 0)
+            devolver.append((src, dst, numero(L4_SRC_PORT), numero(L4_DST_PORT), numero(PROTOCOL),
+                numero(IN_PKTS, PACKET_TOTAL, OUT_PKTS), numero(IN_BYTES, OCTET_TOTAL, OUT_BYTES)))
+        return devolver
+
+
+class DecodificadorFlujos:
+    """
+    NetFlow v5, v9 and IPFIX datagrams to flow records. Templates are cached per
+    (exporter, source id / observation domain, template id): data sets whose template
+    has not arrived yet are counted in sinPlantilla (per exporter) and dropped, as every
+    collector does. The sampling rate each exporter announces is kept in `muestreo`
+    (one rate per exporter: samplers with different rates on one box are not told apart).
+    """
+
+    def __init__(self):
+        self.plantillas = {}
+        self.sinPlantilla = {}
+        self.muestreo = {}
+
+    def decodificar(self, datos, exportador):
+        datos = memoryview(datos)
+        version = CABECERA_SET.unpack_from(datos)[0]
+        if version == 5:
+            cabecera = CABECERA_V5.unpack_from(datos)
+            cantidad = cabecera[1]
+            # Top 2 bits: sampling mode, the other 14: the interval.
+            if( cabecera[8] & 0x3FFF > 1 ):
+                self.muestreo[exportador] = cabecera[8] & 0x3FFF
+            return [
+                (src, dst, sport, dport, proto, paquetes, octetos)
+                for src, dst, paquetes, octetos, sport, dport, proto
+                in REGISTRO_V5.iter_unpack(datos[CABECERA_V5.size:CABECERA_V5.size + cantidad * REGISTRO_V5.size])
+            ]
+        if version == 9:
+            dominio = CABECERA_V9.unpack_from(datos)[5]
+            return self._sets(datos, CABECERA_V9.size, len(datos), (exportador, 9, dominio), 0, 1)
+        if version == 10:
+            largo, _exportado, _secuencia, dominio = CABECERA_IPFIX.unpack_from(datos)[1:]
+            return self._sets(datos, CABECERA_IPFIX.size, min(largo, len(datos)), (exportador, 10, dominio), 2, 3)
+        raise ValueError("not a NetFlow v5/v9/IPFIX datagram (version " + str(version) + ")")
+
+    def _sets(self, datos, posicion, fin, origen, idPlantillas, idOpciones):
+        registros = []
+        while posicion + CABECERA_SET.size <= fin:
+            idSet, largo = CABECERA_SET.unpack_from(datos, posicion)
+            if largo < CABECERA_SET.size:
+                break       # malformed: would loop forever
+            cuerpo = datos[posicion + CABECERA_SET.size:min(posicion + largo, fin)]
+            if idSet == idPlantillas:
+                self._plantillas(cuerpo, origen, origen[1] == 10)
+            elif idSet == idOpciones:
+                self._plantillas(cuerpo, origen, origen[1] == 10, opciones=True)
+            elif idSet >= 256:
+                plantilla = self.plantillas.get(origen + (idSet,))
+                if plantilla is None:
+                    self.sinPlantilla[origen[0]] = self.sinPlantilla.get(origen[0], 0) + 1
+                elif plantilla.opciones:
+                    tasa = plantilla.muestreo(cuerpo)
+                    if tasa:
+                        self.muestreo[origen[0]] = tasa
+                else:
+                    registros.extend(plantilla.registros(cuerpo))
+            posicion = posicion + largo
+        return registros
+
+    def _plantillas(self, cuerpo, origen, ipfix, opciones=False):
+        posicion = 0
+        while posicion + 4 <= len(cuerpo):
+            if( opciones and not ipfix ):
+                # v9 options template: id, scope length, options length (in bytes, 4 per field).
+                if posicion + CABECERA_OPCIONES_V9.size > len(cuerpo):
+                    return
+                idPlantilla, largoAlcance, largoOpciones = CABECERA_OPCIONES_V9.unpack_from(cuerpo, posicion)
+                posicion = posicion + CABECERA_OPCIONES_V9.size
+                cantidadCampos = (largoAlcance + largoOpciones) // 4
+                if idPlantilla < 256:
+                    return      # padding
+            else:
+                idPlantilla, cantidadCampos = CABECERA_SET.unpack_from(cuerpo, posicion)
+                posicion = posicion + 4
+                if( opciones and cantidadCampos > 0 ):
+                    posicion = posicion + 2     # IPFIX options template: scope field count
+            if cantidadCampos == 0:
+                # IPFIX template withdrawal.
+                self.plantillas.pop(origen + (idPlantilla,), None)
+                continue
+            campos = []
+            for _i in range(cantidadCampos):
+                tipo, largo = CABECERA_SET.unpack_from(cuerpo, posicion)
+                posicion = posicion + 4
+                if ipfix and tipo & 0x8000:
+                    # Enterprise-specific element: 4 more bytes (enterprise number), and not one of ours.
+                    posicion = posicion + 4
+                    tipo = None
+                campos.append((tipo, largo))
+            self.plantillas[origen + (idPlantilla,)] = Plantilla(campos, opciones)
+
+
+def textoIP(direccion):
+    return socket.inet_ntop(socket.AF_INET if len(direccion) == 4 else socket.AF_INET6, direccion)
+
+
+def finDeTramo(momento):
+    # End of the AGREGADO_SEGUNDOS slice `momento` falls in.
+    return (momento // AGREGADO_SEGUNDOS + 1) * AGREGADO_SEGUNDOS
+
+
+def _claveNativa(src, dst, sport, dport, proto):
+    return textoIP(src), textoIP(dst), sport, dport, PROTOCOLOS.get(proto, str(proto))
+
+
+class Agregador:
+    """
+    Flow records summed per (src, dst, sport, dport, proto) in a dict, until cosechar()
+    turns them into rows. `formatear` converts a key to the stored columns (the native
+    decoder keeps addresses as bytes and protocols as numbers until then).
+    recibidos/cosechados count records in and rows out: their ratio is what aggregation saves.
+    Past maxClaves keys, new keys are summed without ports (engrosados); past twice
+    that, they are dropped (descartados).
+    """
+
+    def __init__(self, formatear=None, maxClaves=MAX_CLAVES):
+        self.formatear = formatear
+        self.maxClaves = maxClaves
+        self.agregados = {}
+        self.recibidos = 0
+        self.cosechados = 0
+        self.engrosados = 0
+        self.descartados = 0
+
+    def sumar(self, registros):
+        agregados = self.agregados
+        cantidad = 0
+        for src, dst, sport, dport, proto, paquetes, octetos in registros:
+            cantidad = cantidad + 1
+            clave = (src, dst, sport, dport, proto)
+            acumulado = agregados.get(clave)
+            if( acumulado is None and len(agregados) >= self.maxClaves ):
+                clave = (src, dst, 0, 0, proto)
+                acumulado = agregados.get(clave)
+                self.engrosados = self.engrosados + 1
+                if( acumulado is None and len(agregados) >= 2 * self.maxClaves ):
+                    self.descartados = self.descartados + 1
+                    continue
+            if acumulado is None:
+                agregados[clave] = [paquetes, octetos]
+            else:
+                acumulado[0] = acumulado[0] + paquetes
+                acumulado[1] = acumulado[1] + octetos
+        self.recibidos = self.recibidos + cantidad
+
+    def cosechar(self):
+        """(stamp, srcIP, dstIP, srcPort, dstPort, protocol, packets, bytes) of everything summed since the last call."""
+        agregados, self.agregados = self.agregados, {}
+        ahora = time.time()
+        formatear = self.formatear
+        filas = [
+            (ahora,) + (formatear(*clave) if formatear else clave) + (paquetes, octetos)
+            for clave, (paquetes, octetos) in agregados.items()
+            if paquetes > 0 or octetos > 0
+        ]
+        self.cosechados = self.cosechados + len(filas)
+        return filas
+
+
+class Deduplicador:
+    """
+    Which exporter reported each 5-tuple lately, in two generations of `ventana` seconds
+    (so memory stays bounded). A 5-tuple reported by another exporter meanwhile is a duplicate.
+    """
+
+    def __init__(self, ventana):
+        self.ventana = ventana
+        self.actual = {}
+        self.anterior = {}
+        self._rotado = time.time()
+
+    def filtrar(self, exportador, registros):
+        """(records to keep, how many were duplicates)."""
+        if time.time() - self._rotado > self.ventana:
+            self.anterior, self.actual = self.actual, {}
+            self._rotado = time.time()
+        actual, anterior = self.actual, self.anterior
+        quedan = []
+        for registro in registros:
+            clave = registro[:5]
+            dueno = actual.get(clave) or anterior.get(clave)
+            if( dueno is None or dueno == exportador ):
+                actual[clave] = exportador
+                quedan.append(registro)
+        return quedan, len(registros) - len(quedan)
+
+
+class ColaEscritura:
+    """
+    Rows waiting to be stored. vaciar() writes them oldest first and keeps whatever could
+    not be written (SQLite locked, ramdisk full) for the next call, instead of losing it.
+    Bounded by MAX_FILAS_PENDIENTES, with POLITICA_DESBORDE. Counts written and dropped rows.
+    """
+
+    def __init__(self, almacen, maxFilas=MAX_FILAS_PENDIENTES, politica=POLITICA_DESBORDE):
+        self.almacen = almacen
+        self.maxFilas = maxFilas
+        self.politica = politica
+        self.lotes = collections.deque()
+        self.pendientes = 0
+        self.escritas = 0
+        self.descartadas = 0
+        self.desbordes = 0
+
+    def agregar(self, filas):
+        if not filas:
+            return
+        self.lotes.append(filas)
+        self.pendientes = self.pendientes + len(filas)
+        if self.pendientes > self.maxFilas:
+            self.desbordes = self.desbordes + 1
+            self._acotar()
+
+    def vaciar(self):
+        while self.lotes:
+            if not self.almacen.escribir(self.lotes[0]):
+                return False
+            filas = self.lotes.popleft()
+            self.pendientes = self.pendientes - len(filas)
+            self.escritas = self.escritas + len(filas)
+        return True
+
+    def _acotar(self):
+        if self.politica == "muestrear":
+            # 1 in N rows of each batch, counters times N: the totals stay (statistically) right.
+            n = -(-self.pendientes // self.maxFilas)
+            self.lotes = collections.deque(
+                [fila[:6] + (fila[6] * n, fila[7] * n) for fila in filas[::n]] for filas in self.lotes
+            )
+            quedan = sum(len(filas) for filas in self.lotes)
+            self.descartadas = self.descartadas + (self.pendientes - quedan)
+            self.pendientes = quedan
+        elif self.politica == "agregar":
+            # Everything pending re-summed per (src, dst, proto), stamped as the newest batch. Nothing is lost.
+            sumas = {}
+            for filas in self.lotes:
+                for fila in filas:
+                    clave = (fila[1], fila[2], fila[5])
+                    acumulado = sumas.get(clave)
+                    if acumulado is None:
+                        sumas[clave] = [fila[6], fila[7]]
+                    else:
+                        acumulado[0] = acumulado[0] + fila[6]
+                        acumulado[1] = acumulado[1] + fila[7]
+            stamp = self.lotes[-1][0][0]
+            self.lotes = collections.deque([[(stamp, src, dst, 0, 0, proto, paquetes, octetos)
+                for (src, dst, proto), (paquetes, octetos) in sumas.items()]])
+            self.pendientes = len(sumas)
+        # "viejos", or still too many after the above: whole batches go, oldest first.
+        while( self.lotes and self.pendientes > self.maxFilas ):
+            filas = self.lotes.popleft()
+            self.pendientes = self.pendientes - len(filas)
+            self.descartadas = self.descartadas + len(filas)
+
+
+def estadoUDP(inodo):
+    """(bytes waiting in the socket, datagrams the kernel dropped on it) from /proc/net/udp*."""
+    for ruta in ("/proc/net/udp", "/proc/net/udp6"):
+        try:
+            with open(ruta) as archivo:
+                next(archivo)
+                for linea in archivo:
+                    campos = linea.split()
+                    # sl local rem st tx_queue:rx_queue tr:tm retrnsmt uid timeout inode ref pointer drops
+                    if( len(campos) >= 13 and campos[9] == str(inodo) ):
+                        return int(campos[4].split(":")[1], 16), int(campos[12])
+        except (OSError, ValueError, StopIteration):
+            continue
+    return 0, 0
+
+
+class ReceptorFlujos(asyncio.DatagramProtocol):
+    """
+    Decodes each datagram, drops cross-exporter duplicates, scales sampled exporters and
+    sums the records into `agregador`. porExportador holds, per exporter, the
+    [datagrams, records, bytes (scaled), duplicates] since the last metrics dump.
+    """
+
+    def __init__(self):
+        self.decodificador = DecodificadorFlujos()
+        self.agregador = Agregador(_claveNativa)
+        self.deduplicador = Deduplicador(DEDUP_SEGUNDOS) if DEDUP_SEGUNDOS > 0 else None
+        self.malformados = 0
+        self.porExportador = {}
+
+    def tasa(self, exportador):
+        return MUESTREO_EXPORTADORES.get(exportador) or self.decodificador.muestreo.get(exportador, 1)
+
+    def datagram_received(self, datos, direccion):
+        exportador = direccion[0]
+        try:
+            registros = self.decodificador.decodificar(datos, exportador)
+        except (struct.error, ValueError, IndexError):
+            self.malformados = self.malformados + 1
+            return
+        duplicados = 0
+        if( self.deduplicador and registros ):
+            registros, duplicados = self.deduplicador.filtrar(exportador, registros)
+        tasa = self.tasa(exportador)
+        if tasa > 1:
+            registros = [(src, dst, sport, dport, proto, paquetes * tasa, octetos * tasa)
+                for src, dst, sport, dport, proto, paquetes, octetos in registros]
+        cuentas = self.porExportador.get(exportador)
+        if cuentas is None:
+            cuentas = self.porExportador[exportador] = [0, 0, 0, 0]
+        cuentas[0] = cuentas[0] + 1
+        cuentas[1] = cuentas[1] + len(registros)
+        cuentas[2] = cuentas[2] + sum(registro[6] for registro in registros)
+        cuentas[3] = cuentas[3] + duplicados
+        self.agregador.sumar(registros)
+
+
+class MetricasReceptor:
+    """The receiver's counters in metricas.py form, dumped to /ramdisk/metrics_<proceso>.prom."""
+
+    def __init__(self, proceso, receptor, cola, inodo, salida=None):
+        self.proceso = proceso
+        self.receptor = receptor
+        self.cola = cola
+        self.salida = salida
+        self.inodo = inodo
+        self.registro = metricas.Registro(proceso)
+        self.mDatagramas = self.registro.contador("collector_datagrams_total", "NetFlow/IPFIX datagrams received, per exporter.")
+        self.mRegistros = self.registro.contador("collector_records_total", "Flow records kept (after de-duplication), per exporter.")
+        self.mOctetos = self.registro.contador("collector_bytes_total", "Bytes in the kept records, scaled by the sampling rate, per exporter.")
+        self.mDuplicados = self.registro.contador("collector_duplicate_records_total", "Records dropped as already reported by another exporter.")
+        self.mSinPlantilla = self.registro.contador("collector_missing_template_total", "Data sets dropped because their template had not arrived yet.")
+        self.mMalformados = self.registro.contador("collector_malformed_datagrams_total", "Datagrams that could not be decoded.")
+        self.mMuestreo = self.registro.gauge("collector_sampling_rate", "Sampling rate (1:N) applied to each exporter.")
+        # Loss accounting: records in, rows after aggregation, rows stored (socket or nfacctd.db), rows lost.
+        self.mRecibidos = self.registro.contador("collector_records_received_total", "Flow records received (after de-duplication).")
+        self.mAgregadas = self.registro.contador("collector_rows_aggregated_total", "Rows produced by pre-aggregation.")
+        self.mEscritas = self.registro.contador("collector_rows_written_total", "Rows acknowledged by the processor or written to nfacctd.db.")
+        self.mPerdidas = self.registro.contador("collector_rows_dropped_total", "Records or rows dropped by the MAX_CLAVES / MAX_FILAS_PENDIENTES bounds.")
+        self.mEngrosados = self.registro.contador("collector_records_coarsened_total", "Records summed without ports because MAX_CLAVES was reached.")
+        self.mDesbordes = self.registro.contador("collector_queue_overflows_total", "Times the pending rows passed MAX_FILAS_PENDIENTES.")
+        self.mCaidasUDP = self.registro.contador("collector_udp_drops_total", "Datagrams the kernel dropped on the receiver's socket (full receive buffer).")
+        self.mPendientes = self.registro.gauge("collector_rows_pending", "Rows waiting to be written.")
+        self.mSinConfirmar = self.registro.gauge("collector_rows_unacked", "Rows sent to the processor and not acknowledged yet.")
+        self.mColaUDP = self.registro.gauge("collector_udp_queue_bytes", "Bytes waiting in the receiver's UDP socket.")
+        self._totales = {}
+
+    def _avanzar(self, metrica, total):
+        # The receiver keeps running totals: the counter gets what was added since the last dump.
+        metrica.inc(total - self._totales.get(metrica.nombre, 0), receiver=self.proceso)
+        self._totales[metrica.nombre] = total
+
+    def volcar(self):
+        receptor = self.receptor
+        porExportador, receptor.porExportador = receptor.porExportador, {}
+        for exportador, (datagramas, registros, octetos, duplicados) in porExportador.items():
+            # receiver too: with RECEPTORES > 1 every receiver exports these families (merged by /metrics).
+            self.mDatagramas.inc(datagramas, exporter=exportador, receiver=self.proceso)
+            self.mRegistros.inc(registros, exporter=exportador, receiver=self.proceso)
+            self.mOctetos.inc(octetos, exporter=exportador, receiver=self.proceso)
+            self.mDuplicados.inc(duplicados, exporter=exportador, receiver=self.proceso)
+            self.mMuestreo.set(receptor.tasa(exportador), exporter=exportador, receiver=self.proceso)
+        sinPlantilla, receptor.decodificador.sinPlantilla = receptor.decodificador.sinPlantilla, {}
+        for exportador, cantidad in sinPlantilla.items():
+            self.mSinPlantilla.inc(cantidad, exporter=exportador, receiver=self.proceso)
+        self._avanzar(self.mMalformados, receptor.malformados)
+        agregador, cola, salida = receptor.agregador, self.cola, self.salida
+        self._avanzar(self.mRecibidos, agregador.recibidos)
+        self._avanzar(self.mAgregadas, agregador.cosechados)
+        self._avanzar(self.mEscritas, (salida.confirmadas if salida else 0) + cola.escritas)
+        self._avanzar(self.mPerdidas, agregador.descartados + cola.descartadas)
+        self._avanzar(self.mEngrosados, agregador.engrosados)
+        self._avanzar(self.mDesbordes, cola.desbordes)
+        colaUDP, caidasUDP = estadoUDP(self.inodo)
+        self._avanzar(self.mCaidasUDP, caidasUDP)
+        self.mPendientes.set(cola.pendientes, receiver=self.proceso)
+        self.mSinConfirmar.set(salida.filasSinConfirmar if salida else 0, receiver=self.proceso)
+        self.mColaUDP.set(colaUDP, receiver=self.proceso)
+        self.registro.volcar()
+
+
+# Same framing as EntradaFlujos in netflowProcessor.py: magic, collector id, sequence number,
+#  payload length, then the rows as JSON. The processor answers with magic, collector id and
+#  the highest sequence number it has committed.
+CABECERA_LOTE = struct.Struct("!4sIQI")
+MAGIA_LOTE = b"SQF1"
+CABECERA_CONFIRMACION = struct.Struct("!4sIQ")
+MAGIA_CONFIRMACION = b"SQA1"
+
+
+class SalidaFlujos:
+    """
+    Pushes batches to the processor's socket. enviar() never waits: if the processor is not
+    there, or the bytes not yet taken by it pass BUFFER_SALIDA (backpressure), it returns
+    False and the caller stores the batch in nfacctd.db, where the processor will find it.
+    A batch sent is only delivered once the processor acknowledges it, after its commit.
+    Until then it is kept here; if the connection drops, devueltos() hands the unacknowledged
+    batches back so they go to nfacctd.db too. The one gap left: a processor that dies between
+    its commit and the acknowledgement gets those batches again through nfacctd.db.
+    """
+
+    def __init__(self, ruta=RUTA_SOCKET, limite=BUFFER_SALIDA, maxFilas=MAX_FILAS_PENDIENTES):
+        self.ruta = ruta
+        self.limite = limite
+        self.maxFilas = maxFilas
+        self.secuencia = 0
+        self.desviados = 0
+        self.confirmadas = 0
+        self.sinConfirmar = collections.OrderedDict()     # sequence number -> rows, oldest first
+        self.filasSinConfirmar = 0
+        self._devueltos = []
+        self._escritor = None
+        self._reintento = 0.0
+
+    async def enviar(self, filas):
+        if self._escritor is None or self._escritor.is_closing():
+            if self._escritor is not None:
+                self._caida(self._escritor)
+            if time.time() < self._reintento:
+                self.desviados = self.desviados + 1
+                return False
+            try:
+                lector, self._escritor = await asyncio.open_unix_connection(self.ruta)
+            except OSError:
+                self._reintento = time.time() + 5
+                self.desviados = self.desviados + 1
+                return False
+            asyncio.ensure_future(self._confirmaciones(lector, self._escritor))
+        if( self._escritor.transport.get_write_buffer_size() > self.limite or self.filasSinConfirmar > self.maxFilas ):
+            self.desviados = self.desviados + 1
+            return False
+        self.secuencia = self.secuencia + 1
+        datos = json.dumps(filas, separators=(",", ":")).encode()
+        self._escritor.write(CABECERA_LOTE.pack(MAGIA_LOTE, os.getpid() & 0xFFFFFFFF, self.secuencia, len(datos)) + datos)
+        self.sinConfirmar[self.secuencia] = filas
+        self.filasSinConfirmar = self.filasSinConfirmar + len(filas)
+        return True
+
+    def devueltos(self):
+        """Batches of a dropped connection that the processor never acknowledged, oldest first."""
+        if( self._escritor is not None and self._escritor.is_closing() ):
+            self._caida(self._escritor)
+        lotes, self._devueltos = self._devueltos, []
+        return lotes
+
+    async def _confirmaciones(self, lector, escritor):
+        try:
+            while True:
+                magia, _colector, secuencia = CABECERA_CONFIRMACION.unpack(await lector.readexactly(CABECERA_CONFIRMACION.size))
+                if magia != MAGIA_CONFIRMACION:
+                    break
+                # Sequence numbers only grow, so an acknowledgement covers everything up to it.
+                while( self.sinConfirmar and next(iter(self.sinConfirmar)) <= secuencia ):
+                    _secuencia, filas = self.sinConfirmar.popitem(last=False)
+                    self.filasSinConfirmar = self.filasSinConfirmar - len(filas)
+                    self.confirmadas = self.confirmadas + len(filas)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        self._caida(escritor)
+
+    def _caida(self, escritor):
+        escritor.close()
+        if escritor is self._escritor:
+            self._escritor = None
+            self._devueltos.extend(self.sinConfirmar.values())
+            self.sinConfirmar.clear()
+            self.filasSinConfirmar = 0
+
+    def cerrar(self):
+        # What is still unacknowledged stays with the processor, which has it queued.
+        if self._escritor is not None:
+            self._escritor.close()
+
+
+def abrirSocketUDP(puerto, compartido):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if compartido:
+        # The kernel spreads exporters among the receivers by source address, so each
+        #  exporter (and its templates) always lands on the same process.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, BUFFER_UDP)
+    except OSError:
+        pass
+    sock.bind(("0.0.0.0", puerto))
+    sock.setblocking(False)
+    return sock
+
+
+async def _colectorNativo(stop_event, numero):
+    loop = asyncio.get_running_loop()
+    sock = abrirSocketUDP(PUERTO_NETFLOW, RECEPTORES > 1)
+    inodo = os.fstat(sock.fileno()).st_ino
+    transporte, receptor = await loop.create_datagram_endpoint(ReceptorFlujos, sock=sock)
+    # Short lock timeout: a busy nfacctd.db must not stall the receive loop (rows wait in the queue).
+    ramDB = sqlite3.connect(RAMDISK_DB, isolation_level=None, timeout=0.5)
+    almacen = AlmacenFlujos(ramDB)
+    cola = ColaEscritura(almacen)
+    salida = SalidaFlujos() if ENTREGA_DIRECTA else None
+    memoriaReceptor = memoria.Contabilidad("collector-" + str(numero)) if (memoria and RECEPTORES > 1) else None
+    proceso = "collector" if RECEPTORES <= 1 else "collector-" + str(numero)
+    metricasReceptor = MetricasReceptor(proceso, receptor, cola, inodo, salida) if metricas else None
+    ultimoVolcado = 0.0
+    try:
+        while not stop_event.is_set():
+            await asyncio.sleep(max(finDeTramo(time.time()) - time.time(), 0.01))
+            filas = receptor.agregador.cosechar()
+            if salida:
+                # Sent over a connection that dropped before the processor acknowledged them.
+                for devueltas in salida.devueltos():
+                    cola.agregar(devueltas)
+            # Straight to the processor when it takes them, and nothing older is waiting (order).
+            if not( filas and salida and not cola.lotes and await salida.enviar(filas) ):
+                cola.agregar(filas)
+            cola.vaciar()
+            if memoriaReceptor:
+                memoriaReceptor.cortarCada(60)
+            if( metricasReceptor and time.time() - ultimoVolcado > 5 ):
+                try:
+                    metricasReceptor.volcar()
+                except OSError:
+                    pass
+                ultimoVolcado = time.time()
+    finally:
+        transporte.close()
+        if salida:
+            salida.cerrar()
+        ramDB.close()
+
+
+def CollectorNativo(stop_event, numero=0):
+    try:
+        asyncio.run(_colectorNativo(stop_event, numero))
+    except Exception as e:
+        logging.error(f"CollectorNativo error: {e}")
+        print(e)
+        traceback.print_exc()
+
       
 # ---------------------------------------------------------------------------------------------------------------------
 # ---------------------------------------------------------------------------------------------------------------------
@@ -174,11 +946,26 @@ if __name__ == "__main__":
     crearDB(ramDB)
     print("database OK")
     
-    thr_CollectorPipe = None
-    thr_CollectorPipe = threading.Thread(target=CollectorPipe)
-    thr_CollectorPipe.start()
+    if not COLECTOR_NATIVO:
+        trabajadores = [threading.Thread(target=CollectorPipe)]
+    elif RECEPTORES <= 1:
+        trabajadores = [threading.Thread(target=CollectorNativo, args=(stop_event,))]
+    else:
+        # Receiver processes: they share this event (SIGTERM/SIGINT set it, see handle_sigterm).
+        stop_event = multiprocessing.Event()
+        trabajadores = [multiprocessing.Process(target=CollectorNativo, args=(stop_event, numero))
+            for numero in range(RECEPTORES)]
+    for trabajador in trabajadores:
+        trabajador.start()
     
+    # The collector does not read siteData: RSS once a minute, plus tracemalloc growth sites
+    #  when started with PYTHONTRACEMALLOC=1.
+    memoriaCollector = memoria.Contabilidad("collector") if memoria else None
     while not stop_event.is_set():
         time.sleep(1.005)
+        if memoriaCollector:
+            memoriaCollector.cortarCada(60)
+    for trabajador in trabajadores:
+        trabajador.join(timeout=5)
     print("FIN.")
     
\ No newline at end of file
@@ -0,0 +1,225 @@
+"""
+OUI Vendor Database
+Compact, memory-mapped MAC vendor file built from local copies of the IEEE
+registries (oui.csv, mam.csv, oui36.csv). Lookups are a bisect over sorted
+integer prefixes, longest prefix (MA-S, MA-M, MA-L) first.
+
+File layout (native byte order, all sections 8-byte aligned):
+    header      magic, format, byte order, source stamp, entry counts, offsets
+    per table   n x u64 prefix (sorted) + n x u32 string offset
+    strings     u16 length + UTF-8 bytes, each vendor name stored once
+
+SnmpQuery - Network Discovery and Monitoring Tool
+Copyright (C) 2025 Agustin Garcia Maiztegui
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+"""
+
+import bisect
+import csv
+import mmap
+import os
+import struct
+import sys
+import urllib.request
+from array import array
+
+# ============================================================================
+# FORMAT
+# ============================================================================
+
+MAGIC = b"SQOUI\x00"
+FORMATO = 1
+# magic, format, byte order, source stamp, (count, prefixes offset, names offset) x 3, strings offset
+_CABECERA = struct.Struct("=6sHBxd" + "III" * 3 + "I")
+_ORDEN = 0 if sys.byteorder == "little" else 1
+BITS = (36, 28, 24)
+
+# Registry file per prefix length, and where the IEEE publishes it.
+FUENTES = {
+    24: ("oui.csv", "https://standards-oui.ieee.org/oui/oui.csv"),
+    28: ("mam.csv", "https://standards-oui.ieee.org/oui28/mam.csv"),
+    36: ("oui36.csv", "https://standards-oui.ieee.org/oui36/oui36.csv"),
+}
+
+
+def _alinear(n):
+    return (n + 7) & ~7
+
+
+# ============================================================================
+# READING
+# ============================================================================
+
+class BaseOUI:
+    """Read-only view of a vendor file. Cheap to open, nothing is parsed up front."""
+
+    def __init__(self, ruta):
+        with open(ruta, "rb") as archivo:
+            self._mapa = mmap.mmap(archivo.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            campos = _CABECERA.unpack_from(self._mapa, 0)
+        except struct.error:
+            self._mapa.close()
+            raise ValueError("archivo OUI truncado")
+        if campos[0] != MAGIC or campos[1] != FORMATO or campos[2] != _ORDEN:
+            self._mapa.close()
+            raise ValueError("archivo OUI de otra version")
+        self.stamp = campos[3]
+        vista = memoryview(self._mapa)
+        self._tablas = {}
+        for i, bits in enumerate(BITS):
+            cantidad, offPrefijos, offNombres = campos[4 + 3 * i:7 + 3 * i]
+            self._tablas[bits] = (
+                vista[offPrefijos:offPrefijos + 8 * cantidad].cast("Q"),
+                vista[offNombres:offNombres + 4 * cantidad].cast("I"),
+            )
+        self._offTextos = campos[13]
+
+    def __len__(self):
+        return sum(len(prefijos) for prefijos, _ in self._tablas.values())
+
+    def _texto(self, offset):
+        pos = self._offTextos + offset
+        (largo,) = struct.unpack_from("=H", self._mapa, pos)
+        return self._mapa[pos + 2:pos + 2 + largo].decode("utf-8")
+
+    def buscar(self, numero):
+        """Vendor for a 48 bit MAC (int), longest prefix first. None if unknown."""
+        for bits in BITS:
+            prefijos, nombres = self._tablas[bits]
+            clave = numero >> (48 - bits)
+            i = bisect.bisect_left(prefijos, clave)
+            if i < len(prefijos) and prefijos[i] == clave:
+                return self._texto(nombres[i])
+        return None
+
+
+def abrir(ruta):
+    """BaseOUI for `ruta`, or None if it's missing or unusable."""
+    try:
+        return BaseOUI(ruta)
+    except (OSError, ValueError):
+        return None
+
+
+# ============================================================================
+# BUILDING
+# ============================================================================
+
+def leerRegistro(rutaCSV, bits):
+    """(prefix, vendor) pairs from an IEEE registry CSV (Registry,Assignment,Organization Name,...)."""
+    filas = []
+    with open(rutaCSV, "r", encoding="utf-8", errors="replace", newline="") as archivo:
+        for fila in csv.reader(archivo):
+            if len(fila) < 3 or len(fila[1]) != bits // 4:
+                continue
+            try:
+                filas.append((int(fila[1], 16), fila[2].strip()))
+            except ValueError:
+                continue
+    return filas
+
+
+def construir(dirCSV, rutaSalida):
+    """
+    Builds the vendor file from the registry CSVs found in dirCSV.
+    Written next to rutaSalida and renamed over it, so readers never see half a file.
+    Returns the number of prefixes, or None if there was no registry to read.
+    """
+    tablas = {}
+    stampFuente = 0.0
+    for bits in BITS:
+        rutaCSV = os.path.join(dirCSV, FUENTES[bits][0])
+        try:
+            tablas[bits] = dict(leerRegistro(rutaCSV, bits))
+            stampFuente = max(stampFuente, os.path.getmtime(rutaCSV))
+        except OSError:
+            tablas[bits] = {}
+    if not any(tablas.values()):
+        return None
+    # String pool, each vendor once.
+    textos = bytearray()
+    posiciones = {}
+    secciones = []
+    for bits in BITS:
+        prefijos = array("Q")
+        nombres = array("I")
+        for prefijo in sorted(tablas[bits]):
+            elVendor = tablas[bits][prefijo].encode("utf-8")[:0xFFFF]
+            if elVendor not in posiciones:
+                posiciones[elVendor] = len(textos)
+                textos += struct.pack("=H", len(elVendor)) + elVendor
+            prefijos.append(prefijo)
+            nombres.append(posiciones[elVendor])
+        secciones.append((prefijos, nombres))
+    # Offsets.
+    pos = _alinear(_CABECERA.size)
+    campos = [MAGIC, FORMATO, _ORDEN, stampFuente]
+    for prefijos, nombres in secciones:
+        offPrefijos = pos
+        offNombres = _alinear(offPrefijos + 8 * len(prefijos))
+        pos = _alinear(offNombres + 4 * len(nombres))
+        campos.extend((len(prefijos), offPrefijos, offNombres))
+    campos.append(pos)
+    temporal = rutaSalida + ".tmp"
+    with open(temporal, "wb") as archivo:
+        archivo.write(_CABECERA.pack(*campos))
+        for prefijos, nombres in secciones:
+            archivo.write(b"\x00" * (_alinear(archivo.tell()) - archivo.tell()))
+            archivo.write(prefijos.tobytes())
+            archivo.write(b"\x00" * (_alinear(archivo.tell()) - archivo.tell()))
+            archivo.write(nombres.tobytes())
+        archivo.write(b"\x00" * (_alinear(archivo.tell()) - archivo.tell()))
+        archivo.write(bytes(textos))
+        archivo.flush()
+        os.fsync(archivo.fileno())
+    os.replace(temporal, rutaSalida)
+    return sum(len(prefijos) for prefijos, _ in secciones)
+
+
+def necesitaReconstruir(dirCSV, rutaSalida):
+    """True if rutaSalida is missing, from another format, or older than any registry CSV."""
+    base = abrir(rutaSalida)
+    if base is None:
+        return True
+    for bits in BITS:
+        try:
+            if os.path.getmtime(os.path.join(dirCSV, FUENTES[bits][0])) > base.stamp:
+                return True
+        except OSError:
+            continue
+    return False
+
+
+def descargar(dirCSV, timeout=60):
+    """
+    Refreshes the local registry CSVs from the IEEE. Each file is replaced only
+    when it downloaded completely; failures leave the previous copy in place.
+    Returns the number of files updated.
+    """
+    os.makedirs(dirCSV, exist_ok=True)
+    actualizados = 0
+    for bits in BITS:
+        nombre, url = FUENTES[bits]
+        destino = os.path.join(dirCSV, nombre)
+        temporal = destino + ".tmp"
+        try:
+            with urllib.request.urlopen(url, timeout=timeout) as respuesta, open(temporal, "wb") as archivo:
+                while True:
+                    bloque = respuesta.read(65536)
+                    if not bloque:
+                        break
+                    archivo.write(bloque)
+            if os.path.getsize(temporal) > 1024:
+                os.replace(temporal, destino)
+                actualizados = actualizados + 1
+        except (OSError, ValueError):
+            pass
+        finally:
+            if os.path.exists(temporal):
+                os.remove(temporal)
+    return actualizados
@@ -0,0 +1,185 @@
+"""
+On-demand Profiling
+Nothing runs until a profile is asked for (pedir): then the next N units of
+work (daemon cycles, web requests) run under cProfile while a sampler thread
+records their stacks. When the N units are done the result is written to
+the ramdisk as <process>-<stamp>.pstats (for pstats/snakeviz) and
+<process>-<stamp>.collapsed (for flamegraph.pl / speedscope), keeping the
+last few of each process.
+
+SnmpQuery - Network Discovery and Monitoring Tool
+Copyright (C) 2025 Agustin Garcia Maiztegui
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+"""
+
+import cProfile
+import glob
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+DIR_PERFILES = "/ramdisk/perfiles"
+
+
+def _nombreFrame(frame):
+    codigo = frame.f_code
+    return os.path.basename(codigo.co_filename) + ":" + codigo.co_name
+
+
+class _Muestreador(threading.Thread):
+    """Every `intervalo` seconds, adds the stack of each watched thread to `pilas`."""
+
+    def __init__(self, intervalo):
+        super().__init__(name="perfilador", daemon=True)
+        self.intervalo = intervalo
+        self.pilas = Counter()
+        self.hilos = set()
+        self.parar = threading.Event()
+
+    def run(self):
+        while not self.parar.wait(self.intervalo):
+            frames = sys._current_frames()
+            for ident in list(self.hilos):
+                frame = frames.get(ident)
+                pila = []
+                while frame is not None:
+                    pila.append(_nombreFrame(frame))
+                    frame = frame.f_back
+                if pila:
+                    self.pilas[";".join(reversed(pila))] += 1
+
+
+class Perfilador:
+    """
+    Usage, around each unit of work:
+        token = perfilador.iniciar()
+        ... work ...
+        perfilador.finalizar(token)
+    Both are a single check while no profile is pending. pedir() takes a lock: not from a
+    signal handler (set a flag there and call it from the loop).
+    """
+
+    def __init__(self, proceso, directorio=DIR_PERFILES, conservar=10, intervalo=0.005):
+        self.proceso = proceso
+        self.directorio = directorio
+        self.conservar = conservar
+        self.intervalo = intervalo
+        self.pendientes = 0
+        self._lock = threading.Lock()
+        self._stats = None
+        self._muestreador = None
+
+    def pedir(self, cantidad):
+        """Profiles the next `cantidad` units (adds to a profile already running)."""
+        with self._lock:
+            self.pendientes = self.pendientes + max(int(cantidad), 0)
+
+    def iniciar(self):
+        if self.pendientes <= 0:
+            return None
+        perfil = cProfile.Profile()
+        try:
+            perfil.enable()
+        except ValueError:
+            # Another unit is being profiled in this process right now (only one profiler at a time).
+            return None
+        with self._lock:
+            if self._muestreador is None:
+                self._muestreador = _Muestreador(self.intervalo)
+                self._muestreador.start()
+            self._muestreador.hilos.add(threading.get_ident())
+        return perfil
+
+    def pausar(self, perfil):
+        """Around a fork (e.g. a multiprocessing Pool): children would inherit the profile hook, never collected."""
+        if perfil is not None:
+            perfil.disable()
+
+    def reanudar(self, perfil):
+        if perfil is not None:
+            perfil.enable()
+
+    def finalizar(self, perfil):
+        """Ends one unit. Returns the written .pstats path when it was the last one, else None."""
+        if perfil is None:
+            return None
+        perfil.disable()
+        with self._lock:
+            if self._muestreador is None:
+                # Started before the profile it belonged to was written (concurrent requests): dropped.
+                return None
+            self._muestreador.hilos.discard(threading.get_ident())
+            if self._stats is None:
+                self._stats = pstats.Stats(perfil)
+            else:
+                self._stats.add(perfil)
+            self.pendientes = self.pendientes - 1
+            if self.pendientes > 0:
+                return None
+            self.pendientes = 0
+            muestreador, stats = self._muestreador, self._stats
+            self._muestreador, self._stats = None, None
+        muestreador.parar.set()
+        muestreador.join()
+        return self._escribir(stats, muestreador.pilas)
+
+    def _escribir(self, stats, pilas):
+        os.makedirs(self.directorio, exist_ok=True)
+        base = os.path.join(self.directorio, self.proceso + "-" + time.strftime("%Y%m%d-%H%M%S"))
+        stats.dump_stats(base + ".pstats")
+        with open(base + ".collapsed", "w") as archivo:
+            for pila, cantidad in pilas.most_common():
+                archivo.write(pila + " " + str(cantidad) + "\n")
+        # Rotation: the last `conservar` profiles of this process.
+        for ruta in listar(self.directorio, self.proceso)[self.conservar:]:
+            for extension in (".pstats", ".collapsed"):
+                try:
+                    os.remove(ruta[:-len(".pstats")] + extension)
+                except OSError:
+                    pass
+        return base + ".pstats"
+
+
+def pedirPorArchivo(proceso, cantidad, directorio=DIR_PERFILES):
+    """Asks another process (that polls leerPedido) for a profile of its next `cantidad` units."""
+    os.makedirs(directorio, exist_ok=True)
+    with open(os.path.join(directorio, proceso + ".pedido"), "w") as archivo:
+        archivo.write(str(int(cantidad)) + "\n")
+
+
+def leerPedido(proceso, directorio=DIR_PERFILES):
+    """Units asked by pedirPorArchivo (the request is consumed), or 0."""
+    ruta = os.path.join(directorio, proceso + ".pedido")
+    try:
+        with open(ruta) as archivo:
+            cantidad = int(archivo.read().strip() or 0)
+        os.remove(ruta)
+        return cantidad
+    except (OSError, ValueError):
+        return 0
+
+
+# ============================================================================
+# READING
+# ============================================================================
+
+def listar(directorio=DIR_PERFILES, proceso="*"):
+    """.pstats files, newest first."""
+    return sorted(glob.glob(os.path.join(directorio, proceso + "-*.pstats")), reverse=True)
+
+
+def topFunciones(ruta, cantidad=25, orden="tottime"):
+    """[(function, calls, own seconds, cumulative seconds)] from a .pstats file, by `orden`."""
+    filas = []
+    for (archivo, linea, funcion), (_cc, llamadas, propio, acumulado, _callers) in pstats.Stats(ruta).stats.items():
+        filas.append((os.path.basename(archivo) + ":" + str(linea) + " " + funcion, llamadas, propio, acumulado))
+    columna = 3 if orden == "cumtime" else 2
+    filas.sort(key=lambda fila: fila[columna], reverse=True)
+    return filas[:cantidad]
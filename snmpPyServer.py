@@ -24,22 +24,29 @@ snmpPyServer.py - gets data from switches & router, maintains and updates a data
 
 
 
-from datetime import datetime
 import time
 import os
 import sys
 import subprocess
-from subprocess import PIPE
 import shutil
-import fcntl
+import signal
 import multiprocessing
 from multiprocessing import Pool
 import sqlite3
 import re
 import traceback
 import pathlib
+import ipaddress
+import random
 import funciones
-from collections import deque
+import hostnames
+import oui
+import historico
+import bitacora
+import metricas
+import trazas
+import perfilador
+import memoria
 
 
 ###################################################################################################
@@ -58,9 +65,10 @@ settingsFile = BASE_DIR / "snmpQuery.ini"
 systemEnabled = 1
 global_community = ""
 # HISTORICOS:
-histDBPath = BASE_DIR / "historicaldata.db"
+histDir = BASE_DIR / "historico"   # one SQLite file per day/week + catalogo.db, see historico.py
 lastHistoric = 0.0
-histDBperiod = 1800 # how often to aggregate data to the historical database (DB not in use yet)
+lastHistMantenimiento = 0.0
+histDBperiod = 60 # default HISTORY_PERIOD: how often the history intervals are extended (see historico.py)
 haltFlag = 0
 
 # armo las regex para NetSNMP.
@@ -71,19 +79,41 @@ oid1_regex = re.compile(
 oid2_regex = re.compile(r"dot1dStpPort\[(\d+)\]\s*=\s*INTEGER:\s*(\d+)")
 oid3_regex = re.compile(r"dot1dBasePortIfIndex\[(\d+)\]\s*=\s*INTEGER:\s*(\d+)")
 oid4_regex = re.compile(r"ifDescr\[(\d+)\]\s*=\s*STRING:\s*(.+)")
-nbtscan_regex = re.compile(r"^(\d{1,3}(?:\.\d{1,3}){3})\s+(\S+)")
 
 
 # Debug & helper vars
 global_offline = 0
 elTTL = 0
 maxLogs = 150
-elStack = deque(maxlen=maxLogs)
+elStack = bitacora.PilaDebug(maxlen=maxLogs)
 
 
 # statistics
 global_stats_perf = 0
 global_stats_switches = 0
+# /metrics (see metricas.py): dumped to /ramdisk/metrics_core.prom every cycle.
+registro = metricas.Registro("core")
+mCiclo = registro.histograma("cycle_seconds", "Duration of a full polling cycle.")
+mConcurrentes = registro.gauge("pool_processes", "SNMP pool size chosen by the auto-tuner.")
+mSegundosSwitch = registro.gauge("seconds_per_switch", "Cycle time divided by the switches online.")
+mSwitchesOnline = registro.gauge("switches_online", "Switches that answered in the last cycle.")
+mPoll = registro.histograma("poll_seconds", "Time to poll one switch (fetch_oid_fast).")
+mFase = registro.histograma("poll_phase_seconds", "fetch_oid_fast time per phase, all switches.")
+mTimeouts = registro.contador("snmp_timeouts_total", "Switches that did not answer SNMP (marked OFFLINE).")
+mFallas = registro.contador("poll_failures_total", "Switches that answered but gave no usable MAC table.")
+mEstrategia = registro.contador("strategy_total", "Cached SNMP strategy: hit, miss (full tests again) or none.")
+mTransaccion = registro.histograma("db_transaction_seconds", "Main DB write stages of the cycle.")
+
+# On-demand profiling (see perfilador.py): `kill -USR1 <pid>` or the web UI profile the next PROFILE_CYCLES cycles.
+elPerfil = perfilador.Perfilador("core")
+ciclosPerfil = 3
+
+# Memory reports (see memoria.py): RSS per process every cycle, tracemalloc growth sites with MEMORY_TRACE=1.
+memoriaCore = memoria.Contabilidad("core")
+memoriaPool = None   # one per pool worker, created inside the worker
+
+# LLDP/CDP: last time each switch's neighbors were walked ( switchIP -> time.time() )
+ultimosVecinos = {}
 
 ###################################################################################################
 
@@ -101,37 +131,32 @@ else:
 ###################################################################################################
 ###################################################################################################
 
+# syslog_core.txt, written in the background. See bitacora.py.
+elLog = bitacora.Bitacora(archivoLog, logFlag)
+elLog.escucharSenal()
+
+
+# Set by SIGUSR1 and turned into a profile request at the start of the next cycle: the handler
+#  cannot take the Perfilador's lock, the main thread may be holding it when the signal lands.
+perfilPorSenal = False
+
+
+def pedirPerfil(*_senal):
+    global perfilPorSenal
+    perfilPorSenal = True
+
+
+signal.signal(signal.SIGUSR1, pedirPerfil)
+
+
 def loguear(texto):
-    global archivoLog
-    ahora = datetime.now()
-    elStamp = ahora.strftime("%d/%m/%Y %H:%M:%S - ")
-    escribir = elStamp + texto + "\n"
-    try:
-        if os.path.exists(logFlag):
-            with open(archivoLog,"a") as f:
-                fcntl.flock(f, fcntl.LOCK_EX)
-                f.write(escribir)
-                f.flush()
-                fcntl.flock(f, fcntl.LOCK_UN)
-        return 0
-    except Exception as e:
-        print("There was an error attempting to read/write the syslog (!)")
-        print(e)
-        return -1
+    return elLog.escribir(texto)
     
     
-def stackear(texto):
-    global elStack
-    ahora = datetime.now()
-    elStamp = ahora.strftime("%d/%m/%Y %H:%M:%S - ")
-    escribir = elStamp + str(texto.rstrip())
-    try:
-        elStack.append(escribir)
-        return 0
-    except Exception as e:
-        print("An error occurred trying to add text to the debugging stack.")
-        print(e)
-        return -1
+def stackear(*partes):
+    # Parts are kept as they come and joined only if the stack is dumped.
+    elStack.agregar(*partes)
+    return 0
 ###################################################################################################
 
 ### 2. SINGLETON ###
@@ -297,8 +322,7 @@ def leerPreferencias():
 
 
 def familiarizar(elSwitchPadre, elPuertoPadre, elSwitchHijo):
-    unString = "inicio familiarizar con (padre, puertoPadre, hijo): "+elSwitchPadre+", "+elPuertoPadre+", "+elSwitchHijo
-    stackear(unString)
+    stackear("inicio familiarizar con (padre, puertoPadre, hijo): ", elSwitchPadre, ", ", elPuertoPadre, ", ", elSwitchHijo)
     localCur = diskDB.cursor()
     
     # We assume the father-son relationship exist, so we try to delete it.
@@ -326,15 +350,18 @@ def familiarizar(elSwitchPadre, elPuertoPadre, elSwitchHijo):
 # ---------------------------------------------------------------------------------------------------------------------
 
 # def switchSewingRecursive(listaMinions, elMaster):
-def switchSewingRecursive(listaMinions, elMaster, depth=0, max_depth=30):
-    unString = "inicio switchSewingRecursive con elMaster: "+elMaster
-    
+def switchSewingRecursive(listaMinions, elMaster, depth=0, max_depth=30, enlacesVecinos=None, conDescendientes=None):
     if(depth >= max_depth):
         loguear("switchSewingRecursive: Max Depth reached. Exiting")
         return -1
     
-    stackear(unString)
+    stackear("inicio switchSewingRecursive con elMaster: ", elMaster)
     localCur = diskDB.cursor()
+    # LLDP/CDP links already known (see vecinosSewing): {(padre, puertoPadre): hijo}
+    if(enlacesVecinos is None):
+        enlacesVecinos = {}
+    if(conDescendientes is None):
+        conDescendientes = set()
     
     # 1. For every port (elMaster) "aQuienVes()" is called, so:
         # 2. If a port sees other switches,
@@ -365,8 +392,16 @@ def switchSewingRecursive(listaMinions, elMaster, depth=0, max_depth=30):
     # iterating through the ports..
     elRetorno = 0
     for unPuertoMaster in losPuertosMaster:
+        ### 0. If LLDP/CDP already told us who the son on this port is, there is nothing to infer.
+        ###    We only go down that son if it has sons of its own.
+        if( (elMaster, unPuertoMaster[1]) in enlacesVecinos ):
+            elHijo = enlacesVecinos[(elMaster, unPuertoMaster[1])]
+            if( elHijo in conDescendientes ):
+                stackear("hago llamada recursiva (LLDP/CDP) con ", elHijo)
+                elRetorno = switchSewingRecursive([], elHijo, (depth+1), max_depth, enlacesVecinos, conDescendientes)
+            continue
         ### 1. For every port (elMaster) "aQuienVes()" is called, so:
-        stackear("llamo aQuienVes con (laDB, "+elMaster+", "+unPuertoMaster[1]+")")
+        stackear("llamo aQuienVes con (laDB, ", elMaster, ", ", unPuertoMaster[1], ")")
         switchesVisibles = funciones.aQuienVes(diskDB,elMaster,unPuertoMaster[1])
         stackear("volvi de aQuienVes.")
         # aQuienVes returns data like [(ip,desc,mac),(ip,desc,mac),(ip,desc,mac),(ip,desc,mac)]
@@ -405,7 +440,7 @@ def switchSewingRecursive(listaMinions, elMaster, depth=0, max_depth=30):
                 ### 8. A recursive call is done, where "elMasterDOS" becomes "elMaster",
                 ###    and "losMinions" become "listaMinions". The process repeats.
                 stackear("hago llamada recursiva.")
-                elRetorno = switchSewingRecursive(laBolsa, elMasterDOS, (depth+1), max_depth)
+                elRetorno = switchSewingRecursive(laBolsa, elMasterDOS, (depth+1), max_depth, enlacesVecinos, conDescendientes)
     return elRetorno
 
 
@@ -413,6 +448,67 @@ def switchSewingRecursive(listaMinions, elMaster, depth=0, max_depth=30):
 # ---------------------------------------------------------------------------------------------------------------------
 
 
+def vecinosSewing():
+    # LLDP/CDP fast path. Every neighbor pair between two known switches becomes a father-son
+    #   relationship right away, no MAC inference needed (works even if the FDB was just flushed).
+    # Direction: the side that sees the gateway on that port (isRoot = ROOT) is the son.
+    # Returns ( {(padre, puertoPadre): hijo}, set of switches with downlinks ).
+    enlaces = {}
+    conDescendientes = set()
+    if( funciones.leerDBenSQL(diskDB, "NEIGHBORS") != "1" ):
+        return enlaces, conDescendientes
+    localCur = diskDB.cursor()
+    online = set()
+    for row in localCur.execute("""
+        SELECT switchIP
+        FROM switch
+        WHERE switchStatus LIKE "%ONLINE%"
+        """):
+        online.add(row[0])
+    puertosRoot = set()
+    for row in localCur.execute("""
+        SELECT switchIP, portNum
+        FROM switchPort
+        WHERE isRoot = 'ROOT'
+        """):
+        puertosRoot.add((row[0], row[1]))
+    lados = {}      # (switchA, switchB) -> port on switchA
+    for row in localCur.execute("""
+        SELECT DISTINCT switchIP, localPort, remoteSwitchIP
+        FROM neighborCache
+        WHERE remoteSwitchIP IS NOT NULL
+            AND localPort IS NOT NULL
+        """):
+        lados[(row[0], row[2])] = row[1]
+    for (unSwitch, elRemoto), unPuerto in lados.items():
+        if( (unSwitch not in online) or (elRemoto not in online) ):
+            continue
+        if( (unSwitch, unPuerto) in puertosRoot ):
+            # That's unSwitch's uplink: unSwitch is the son. The other side's entry registers it.
+            continue
+        puertoRemoto = lados.get((elRemoto, unSwitch))
+        if( (puertoRemoto is not None) and ((elRemoto, puertoRemoto) not in puertosRoot) ):
+            # Neither side is an uplink. We can't tell who is who, MAC inference will decide.
+            continue
+        enlaces[(unSwitch, unPuerto)] = elRemoto
+    for (elPadre, elPuerto), elHijo in enlaces.items():
+        familiarizar(elPadre, elPuerto, elHijo)
+        conDescendientes.add(elPadre)
+    for row in localCur.execute("""
+        SELECT DISTINCT switchIP
+        FROM switchPort
+        WHERE portType = 'TRUNK'
+            AND isRoot != 'ROOT'
+        """):
+        conDescendientes.add(row[0])
+    stackear("vecinosSewing: "+str(len(enlaces))+" enlaces LLDP/CDP.")
+    return enlaces, conDescendientes
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------
+
+
 def embolsamiento(individual, todos):
     laBolsa = []
     for unItem in todos:
@@ -431,10 +527,6 @@ def embolsamiento(individual, todos):
 
 
 def losConoces(listaMinions, elMaster):
-    unString = "inicio losConoces con (elMaster, [listaMinions] ): "+elMaster+", ["
-    for minion in listaMinions:
-        unString = unString + ", " + minion[0]
-    unString = unString + "]"
     localCur = diskDB.cursor()
     hijosDelMaster = []
     for rowSwitch in localCur.execute("""
@@ -500,9 +592,11 @@ def switchMapper():
     stackear(unLog)
     laBolsa = embolsamiento(elRoot[0], switches)
     # CALL:
-    stackear("switchMapper: llamo a switchSewingRecursive con laBolsa y elRoot.")
     try:
-        switchSewingRecursive(laBolsa, elRoot[0])
+        stackear("switchMapper: llamo a vecinosSewing (LLDP/CDP).")
+        enlacesVecinos, conDescendientes = vecinosSewing()
+        stackear("switchMapper: llamo a switchSewingRecursive con laBolsa y elRoot.")
+        switchSewingRecursive(laBolsa, elRoot[0], enlacesVecinos=enlacesVecinos, conDescendientes=conDescendientes)
     except Exception:
         loguear("Problema con llamada recursiva switchSewingRecursive")
         loguear("valores de switchMapper, (1) elRoot: "+elRoot[0])
@@ -516,6 +610,7 @@ def switchMapper():
         loguear("vuelco del stack descriptivo:")
         for item in elStack:
             loguear(item.rstrip())
+    return elRoot[0]
     
             
 
@@ -975,6 +1070,7 @@ def fetch_oid_fast(parametros):
     if(funciones.validateStrategy(strategy)):
         # the process received a none blank strategy to try.
         useStrategy = 1
+    conEstrategia = useStrategy
     time1 = time.time()
     success = 0
     attempts = 0
@@ -1026,7 +1122,7 @@ def fetch_oid_fast(parametros):
                 if(sinProcesar == -1):
                     # Switch OFFLINE!
                     #loguear("switch "+host+" offline")
-                    return(host, 0.0, -1, None, None)
+                    return(host, time.time() - debugStart, -1, None, None)
                 for varBind in sinProcesar:
                     oid = tuple(varBind[0])
                     # dot1qTpFdbPort
@@ -1066,7 +1162,7 @@ def fetch_oid_fast(parametros):
                 pass
         if(resultadoOK == 0):
             #loguear("switch "+host+" resultadoOK == 0")
-            return(host, 0.0, -2, None, None)
+            return(host, time.time() - debugStart, -2, None, None)
         #
         #  
         time2 = time.time()
@@ -1406,7 +1502,7 @@ def fetch_oid_fast(parametros):
         time5 = time.time()
         # either if we used a strategy or not, we should have some sort of SELECT defined.
         if(elSelect is None):
-            return(host, 0.0, -2, None, None)
+            return(host, time.time() - debugStart, -2, None, None)
         elMerge = []
         try:
             for row in unCur.execute(elSelect):
@@ -1444,25 +1540,281 @@ def fetch_oid_fast(parametros):
             useStrategy = 0
         #    
         time7 = time.time()
-        losTiempos = None
         if( success == 1 ):
-            strTiempos = "\n\n   TIEMPOS SWITCH "+host+"\n"
-            strTiempos += f"      validateStrategy: {time1 - debugStart:.3f}\n"
-            strTiempos += f"      snmp call & rows: {time2 - time1:.3f}\n"
-            strTiempos += f"      portNum selected: {time3 - time2:.3f}\n"
-            strTiempos += f"      13 TESTs + query: {time4 - time3:.3f}\n"
-            strTiempos += f"      strategy + query: {time5 - time4:.3f}\n"
-            strTiempos += f"      > executequery(): {time6 - time5:.3f}\n"
-            strTiempos += f"      verif. resultado: {time7 - time6:.3f}\n"
-            return host, 0.0, elMerge, losTiempos, strategy
+            # Phase timings and whether the cached strategy worked, for /metrics.
+            if( conEstrategia == 0 ):
+                usoEstrategia = "none"
+            elif( useStrategy == 1 ):
+                usoEstrategia = "hit"
+            else:
+                usoEstrategia = "miss"
+            losTiempos = {
+                "fases": {
+                    "validate_strategy": time1 - debugStart,
+                    "snmp_walk": time2 - time1,
+                    "port_index": time3 - time2,
+                    "tests": time4 - time3,
+                    "strategy_query": time5 - time4,
+                    "join": time6 - time5,
+                    "verify": time7 - time6,
+                },
+                "estrategia": usoEstrategia,
+            }
+            return host, time7 - debugStart, elMerge, losTiempos, strategy
             # Returned data looks like this:
             # [switchIP][time][ dataTable ][moreTimes][strategy]
             # [a.b.c.d][1.23455][ [vlan][mac][unPort][portDesc] ][ losTiempos ][ [][][][][][][][][][][][] ]
+            # losTiempos = {"fases": {phase: seconds}, "estrategia": "hit" | "miss" | "none"}
         else:
             attempts = attempts + 1
     # We run out of attempts.
-    return(host, 0.0, -2, None, None)
-    
+    return(host, time.time() - debugStart, -2, None, None)
+
+
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------
+# LLDP / CDP NEIGHBORS (optional, "NEIGHBORS=1" on the .ini file)
+# ---------------------------------------------------------------------------------------------------------------------
+
+
+def netsnmpWalk(host, OIDS, timeout=2, retries=1):
+    # Generic snmpbulkwalk over a list of OIDs. Returns [(oid_tuple, value)], or -1 if the host didn't answer.
+    # Only the rows under the requested OID are kept ("No Such Object" answers are discarded).
+    salida = []
+    bulk = 50
+    for oid in OIDS:
+        prefijo = tuple(int(x) for x in oid.split("."))
+        elComando = [
+                "snmpbulkwalk",
+                "-v2c",
+                "-c", global_community,
+                "-On",
+                "-Ox",
+                f"-Cr{bulk}",
+                "-Cc",
+                "-t", str(timeout),
+                "-r", str(retries),
+                host,
+                oid,
+            ]
+        try:
+            proc = subprocess.run(
+                elComando,
+                capture_output=True,
+                text=True,
+            )
+            if proc.returncode != 0:
+                return -1
+            rawLines = []
+            parte = ""
+            for line in proc.stdout.splitlines():
+                if line.startswith(".1."):
+                    if(parte):
+                        rawLines.append(parte.strip())
+                    parte = line
+                else:
+                    parte = parte + " " + line.strip()
+            if(parte):
+                rawLines.append(parte.strip())
+            for line in rawLines:
+                if(" = " not in line):
+                    continue
+                oid_str, value_str = line.split(" = ", 1)
+                oid_tuple = tuple(
+                    int(x) for x in oid_str.lstrip(".").split(".")
+                )
+                if(oid_tuple[:len(prefijo)] != prefijo):
+                    continue
+                salida.append((oid_tuple, normalize_value(value_str)))
+        except Exception as e:
+            loguear("netsnmpWalk "+host+" "+oid+": "+str(e))
+            return -1
+    return salida
+
+
+
+def snmpTexto(valor):
+    # LLDP/CDP strings come back as Hex-STRING (-Ox). We want plain text.
+    if isinstance(valor, bytes):
+        return valor.decode("utf-8", errors="ignore").strip("\x00 ").strip()
+    return str(valor).strip()
+
+
+
+def snmpMac(valor):
+    # 6 raw bytes -> aa-bb-cc-dd-ee-ff (same format as the macaddress table).
+    if isinstance(valor, bytes) and len(valor) == 6:
+        return '-'.join(f"{b:02x}" for b in valor)
+    return None
+
+
+
+def fetch_neighbors(host):
+    # Runs inside the Pool. Walks lldpRemTable / cdpCacheTable plus what's needed to translate the
+    # LOCAL port to something we can match against switchPort (bridge port -> ifIndex -> ifDescr).
+    # Returns (host, [ (protocolo, localNum, (localDescs), remoteIP, remoteMAC, remoteName, remotePort) ]),
+    #   or (host, -1) if the switch did not answer (the cached neighbors are kept in that case).
+    LLDP_REM = "1.0.8802.1.1.2.1.4.1.1"
+    LLDP_REM_MAN = "1.0.8802.1.1.2.1.4.2.1.3"
+    LLDP_LOC_DESC = "1.0.8802.1.1.2.1.3.7.1.4"
+    CDP_CACHE = "1.3.6.1.4.1.9.9.23.1.2.1.1"
+    OIDS = [
+        LLDP_REM+".4",      # lldpRemChassisIdSubtype
+        LLDP_REM+".5",      # lldpRemChassisId
+        LLDP_REM+".7",      # lldpRemPortId
+        LLDP_REM+".9",      # lldpRemSysName
+        LLDP_REM_MAN,       # lldpRemManAddrIfSubtype (we only need the index: it carries the address)
+        LLDP_LOC_DESC,      # lldpLocPortDesc
+        CDP_CACHE+".4",     # cdpCacheAddress
+        CDP_CACHE+".6",     # cdpCacheDeviceId
+        CDP_CACHE+".7",     # cdpCacheDevicePort
+        "1.3.6.1.2.1.17.1.4.1.2",   # dot1dBasePortIfIndex
+        "1.3.6.1.2.1.2.2.1.2",      # ifDescr
+    ]
+    sinProcesar = netsnmpWalk(host, OIDS)
+    if(sinProcesar == -1):
+        return (host, -1)
+    lldp = {}           # (localNum, remIndex) -> {campo: valor}
+    cdp = {}            # (ifIndex, devIndex) -> {campo: valor}
+    locDesc = {}        # lldpLocPortNum -> desc
+    basePortIfIndex = {}
+    ifDescr = {}
+    pfxRem = tuple(int(x) for x in LLDP_REM.split("."))
+    pfxMan = tuple(int(x) for x in LLDP_REM_MAN.split("."))
+    pfxLoc = tuple(int(x) for x in LLDP_LOC_DESC.split("."))
+    pfxCdp = tuple(int(x) for x in CDP_CACHE.split("."))
+    largoRem = len(pfxRem)
+    largoMan = len(pfxMan)
+    largoLoc = len(pfxLoc)
+    largoCdp = len(pfxCdp)
+    for oid, valor in sinProcesar:
+        if oid[:largoRem] == pfxRem:
+            # ...lldpRemEntry.<column>.<timeMark>.<localPortNum>.<remIndex>
+            columna = oid[largoRem]
+            clave = (oid[largoRem+2], oid[largoRem+3])
+            lldp.setdefault(clave, {})[columna] = valor
+        elif oid[:largoMan] == pfxMan:
+            # ...<timeMark>.<localPortNum>.<remIndex>.<addrSubtype>.<addrLen>.<addr...>
+            resto = oid[largoMan:]
+            if len(resto) >= 9 and resto[3] == 1 and resto[4] == 4:
+                clave = (resto[1], resto[2])
+                lldp.setdefault(clave, {})["ip"] = ".".join(str(b) for b in resto[5:9])
+        elif oid[:largoLoc] == pfxLoc:
+            locDesc[oid[-1]] = snmpTexto(valor)
+        elif oid[:largoCdp] == pfxCdp:
+            # ...cdpCacheEntry.<column>.<ifIndex>.<deviceIndex>
+            columna = oid[largoCdp]
+            clave = (oid[largoCdp+1], oid[largoCdp+2])
+            cdp.setdefault(clave, {})[columna] = valor
+        elif oid[:11] == (1,3,6,1,2,1,17,1,4,1,2):
+            bridge_port, ifindex = parse_dot1dBasePortIfIndex((oid, valor))
+            basePortIfIndex[bridge_port] = ifindex
+        elif oid[:10] == (1,3,6,1,2,1,2,2,1,2):
+            ifDescr[oid[-1]] = snmpTexto(valor)
+    vecinos = []
+    for (localNum, remIndex), campos in lldp.items():
+        # lldpLocPortNum is usually the bridge port, sometimes the ifIndex. We hand every candidate description.
+        descs = []
+        if localNum in basePortIfIndex and basePortIfIndex[localNum] in ifDescr:
+            descs.append(ifDescr[basePortIfIndex[localNum]])
+        if localNum in ifDescr:
+            descs.append(ifDescr[localNum])
+        if localNum in locDesc:
+            descs.append(locDesc[localNum])
+        remoteMAC = None
+        if campos.get(4) == 4:
+            # lldpRemChassisIdSubtype 4 = macAddress
+            remoteMAC = snmpMac(campos.get(5))
+        vecinos.append(("LLDP", localNum, tuple(descs), campos.get("ip"), remoteMAC,
+                        snmpTexto(campos.get(9, "")), snmpTexto(campos.get(7, ""))))
+    for (ifIndex, devIndex), campos in cdp.items():
+        remoteIP = None
+        direccion = campos.get(4)
+        if isinstance(direccion, bytes) and len(direccion) == 4:
+            remoteIP = ".".join(str(b) for b in direccion)
+        descs = ()
+        if ifIndex in ifDescr:
+            descs = (ifDescr[ifIndex],)
+        vecinos.append(("CDP", ifIndex, descs, remoteIP, None,
+                        snmpTexto(campos.get(6, "")), snmpTexto(campos.get(7, ""))))
+    return (host, vecinos)
+
+
+
+def vecinosPendientes(HOSTS):
+    # Which switches need a new LLDP/CDP walk. The cache is per device and lives "NEIGHBORS_REFRESH" seconds.
+    refresco = funciones.leerDBenSQL(diskDB, "NEIGHBORS_REFRESH")
+    try:
+        refresco = float(refresco)
+    except (TypeError, ValueError):
+        refresco = 600.0
+    ahora = time.time()
+    pendientes = []
+    for unHost in HOSTS:
+        elSwitch = unHost[0]
+        if( not funciones.isOnline(diskDB, elSwitch) ):
+            continue
+        if( (ahora - ultimosVecinos.get(elSwitch, 0.0)) >= refresco ):
+            pendientes.append(elSwitch)
+    return pendientes
+
+
+
+def guardarVecinos(result):
+    # result = (switchIP, [neighbors]) from fetch_neighbors. Local ports are resolved against switchPort
+    #   (by description first, by number as a fallback) and remote devices against the switch table.
+    elSwitch, vecinos = result
+    if(vecinos == -1):
+        return
+    ultimosVecinos[elSwitch] = time.time()
+    localCur = diskDB.cursor()
+    puertosPorDesc = {}
+    puertosPorNum = set()
+    for row in localCur.execute("""
+        SELECT portNum, portDesc
+        FROM switchPort
+        WHERE switchIP = ?
+        """, (elSwitch,)):
+        puertosPorDesc[row[1]] = row[0]
+        puertosPorNum.add(str(row[0]))
+    switchesPorIP = set()
+    switchesPorMAC = {}
+    for row in localCur.execute("SELECT switchIP, switchMAC FROM switch"):
+        switchesPorIP.add(row[0])
+        if(row[1] is not None):
+            switchesPorMAC[row[1]] = row[0]
+    unStamp = time.time()
+    filas = []
+    for protocolo, localNum, descs, remoteIP, remoteMAC, remoteName, remotePort in vecinos:
+        localPort = None
+        for unaDesc in descs:
+            if unaDesc in puertosPorDesc:
+                localPort = puertosPorDesc[unaDesc]
+                break
+        if(localPort is None and str(localNum) in puertosPorNum):
+            localPort = str(localNum)
+        remoteSwitchIP = None
+        if(remoteIP in switchesPorIP):
+            remoteSwitchIP = remoteIP
+        elif(remoteMAC in switchesPorMAC):
+            remoteSwitchIP = switchesPorMAC[remoteMAC]
+        if(remoteSwitchIP == elSwitch):
+            continue
+        filas.append((unStamp, elSwitch, localPort, remoteSwitchIP, remoteIP, remotePort, remoteName, protocolo))
+    try:
+        localCur.execute("BEGIN")
+        localCur.execute("DELETE FROM neighborCache WHERE switchIP = ?", (elSwitch,))
+        localCur.executemany("""
+            INSERT INTO neighborCache (stamp, switchIP, localPort, remoteSwitchIP, remoteIP, remotePort, remoteName, protocolo)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, filas)
+        diskDB.commit()
+    except Exception:
+        diskDB.rollback()
+        loguear("guardarVecinos: rollback para "+elSwitch)
+        loguear(traceback.format_exc())
 
 
 
@@ -1477,16 +1829,8 @@ def fetch_oid_fast(parametros):
 
 
 def vendorLookup(unaMAC):
-    localCur = diskDB.cursor()
-    # Gets a MAC address, Gives VENDOR for it.
-    devolver = None
-    for row in localCur.execute("""
-        SELECT elVendor
-        FROM vendor
-        WHERE ? LIKE halfMac || '%'
-    """,(unaMAC,)):
-        devolver = row[0]
-    return devolver
+    # Gets a MAC address, Gives VENDOR for it (longest OUI prefix, see funciones.macVendor).
+    return funciones.macVendor(unaMAC)
     
 
 
@@ -1496,47 +1840,261 @@ def vendorLookup(unaMAC):
 
 
 
+def hostnamesPendientes(localCur, fuente, laRed, elLote):
+    # IPs in arp (inside NETWORK/MASKBITS) that "fuente" has never asked, whose MAC changed, or whose cached answer expired.
+    # Returns {ip: (mac, cambioMAC)}, at most elLote of them, never-asked ones first.
+    pendientes = {}
+    for row in localCur.execute("""
+        SELECT enArp.ipaddr, enArp.macaddr, hc.macaddr
+        FROM (SELECT ipaddr, MAX(macaddr) AS macaddr FROM arp GROUP BY ipaddr) AS enArp
+            LEFT JOIN hostnameCache AS hc
+                ON hc.ipaddr = enArp.ipaddr AND hc.source = ?
+        WHERE hc.ipaddr IS NULL
+            OR hc.macaddr IS NOT enArp.macaddr
+            OR CAST(hc.expires AS REAL) <= ?
+        ORDER BY CAST(hc.expires AS REAL)
+        """, (fuente, time.time())):
+        try:
+            if( ipaddress.ip_address(row[0]) not in laRed ):
+                continue
+        except ValueError:
+            continue
+        pendientes[row[0]] = (row[1], (row[2] is not None) and (row[2] != row[1]))
+        if( len(pendientes) >= elLote ):
+            break
+    return pendientes
+
+
+
+def guardarHostnames(laDB, fuente, pendientes, resultados, ttlPositivo, ttlNegativo, ttlMinimo=0):
+    # resultados: {ip: (hostname or None, ttl or None)}. No ttl means ttlPositivo / ttlNegativo.
+    # Updates hostnameCache for "fuente" and merges the best known name into hostname (see hostnames.PRIORIDAD).
+    localCur = laDB.cursor()
+    unStamp = time.time()
+    filasCache = []
+    filasBorrar = []
+    for unaIP, (unHostname, unTTL) in resultados.items():
+        unaMAC, cambioMAC = pendientes[unaIP]
+        if( unTTL is None ):
+            if( unHostname is not None ):
+                unTTL = ttlPositivo
+            else:
+                unTTL = ttlNegativo
+        unTTL = max(unTTL, ttlMinimo)
+        if( (unHostname is None) and cambioMAC ):
+            # Another device took this IP, the old name is no longer valid.
+            filasBorrar.append((unaIP,))
+        filasCache.append((unaIP, fuente, unaMAC, unHostname, unStamp, unStamp + unTTL * random.uniform(0.9, 1.1)))
+    try:
+        localCur.execute("BEGIN")
+        localCur.executemany("""
+            INSERT INTO hostnameCache (ipaddr, source, macaddr, hostname, stamp, expires)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(ipaddr, source) DO UPDATE SET
+                macaddr = excluded.macaddr,
+                hostname = excluded.hostname,
+                stamp = excluded.stamp,
+                expires = excluded.expires
+            """, filasCache)
+        localCur.executemany("DELETE FROM hostname WHERE ipaddr = ?", filasBorrar)
+        hostnames.fusionarHostnames(localCur, list(resultados), unStamp)
+        laDB.commit()
+    except Exception as e:
+        laDB.rollback()
+        print(e)
+
+
+
+def procesarLeasesDHCP(laDB, archivos, ttlPositivo):
+    # Follows the DHCP lease files (DHCP_LEASES, comma separated) from where we left them (dhcpLeaseState).
+    # Active leases with a client hostname feed hostnameCache (source "dhcp") and the macHostname map.
+    # Returns True if there was something new.
+    localCur = laDB.cursor()
+    hayNuevos = False
+    for archivo in archivos.split(","):
+        archivo = archivo.strip()
+        if( archivo == "" ):
+            continue
+        inode = None
+        offset = 0
+        for row in localCur.execute("SELECT inode, offset FROM dhcpLeaseState WHERE archivo = ?", (archivo,)):
+            inode, offset = row
+        leido = hostnames.leerLeasesNuevos(archivo, inode, offset)
+        if( leido is None ):
+            continue
+        nuevoInode, nuevoOffset, leases = leido
+        # The same IP may show up several times, the last record is the current one.
+        porIP = {}
+        for unLease in leases:
+            porIP[unLease[0]] = unLease
+        unStamp = time.time()
+        filasCache = []
+        filasMac = []
+        filasMacBorrar = []
+        # MAC of each IP's previous lease: if another device got the IP, that one's lease is over.
+        anteriores = dict(localCur.execute(
+            "SELECT ipaddr, macaddr FROM hostnameCache WHERE source = 'dhcp' AND macaddr IS NOT NULL"
+        ).fetchall()) if porIP else {}
+        for unaIP, unaMAC, unHostname, activo, vence in porIP.values():
+            unaMAC = funciones.standarizeFullMAC(unaMAC) if unaMAC else None
+            if( anteriores.get(unaIP) not in (None, unaMAC) ):
+                filasMacBorrar.append((anteriores[unaIP],))
+            finLease = vence
+            if( (not activo) or (vence is not None and vence <= unStamp) ):
+                unHostname = None
+            if( vence is None or vence <= unStamp ):
+                vence = unStamp + ttlPositivo
+            filasCache.append((unaIP, "dhcp", unaMAC, unHostname, unStamp, vence))
+            if( unaMAC is not None ):
+                if( unHostname is not None ):
+                    filasMac.append((unaMAC, unHostname, "dhcp", unStamp, finLease))
+                else:
+                    # Released or expired: the name the lease gave this MAC is not current anymore.
+                    filasMacBorrar.append((unaMAC,))
+        try:
+            localCur.execute("BEGIN")
+            localCur.executemany("""
+                INSERT INTO hostnameCache (ipaddr, source, macaddr, hostname, stamp, expires)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(ipaddr, source) DO UPDATE SET
+                    macaddr = excluded.macaddr,
+                    hostname = excluded.hostname,
+                    stamp = excluded.stamp,
+                    expires = excluded.expires
+                """, filasCache)
+            localCur.executemany("""
+                INSERT INTO macHostname (macaddr, hostname, source, stamp, expires)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(macaddr) DO UPDATE SET
+                    hostname = excluded.hostname,
+                    source = excluded.source,
+                    stamp = excluded.stamp,
+                    expires = excluded.expires
+                """, filasMac)
+            localCur.executemany("DELETE FROM macHostname WHERE macaddr = ? AND source = 'dhcp'", filasMacBorrar)
+            hostnames.fusionarHostnames(localCur, list(porIP), unStamp, retirar=("dhcp",))
+            localCur.execute("DELETE FROM dhcpLeaseState WHERE archivo = ?", (archivo,))
+            localCur.execute("""
+                INSERT INTO dhcpLeaseState (archivo, inode, offset, stamp)
+                VALUES (?, ?, ?, ?)
+                """, (archivo, nuevoInode, nuevoOffset, unStamp))
+            laDB.commit()
+        except Exception as e:
+            laDB.rollback()
+            print(e)
+            continue
+        if( len(porIP) > 0 ):
+            hayNuevos = True
+    return hayNuevos
+
+
+
+def vencerMacHostname(laDB):
+    # Leases that ran out without a new record in the file (the client just went away): their
+    #  name goes from macHostname, from the dhcp answer in hostnameCache, and from hostname.
+    localCur = laDB.cursor()
+    unStamp = time.time()
+    try:
+        localCur.execute("BEGIN")
+        vencidas = [row[0] for row in localCur.execute("""
+            SELECT DISTINCT c.ipaddr
+            FROM macHostname AS mh
+                JOIN hostnameCache AS c ON (c.macaddr = mh.macaddr AND c.source = 'dhcp' AND c.hostname IS NOT NULL)
+            WHERE mh.source = 'dhcp' AND mh.expires IS NOT NULL AND mh.expires <= ?
+            """, (unStamp,))]
+        localCur.executemany("UPDATE hostnameCache SET hostname = NULL WHERE ipaddr = ? AND source = 'dhcp'",
+                             [(unaIP,) for unaIP in vencidas])
+        hostnames.fusionarHostnames(localCur, vencidas, unStamp, retirar=("dhcp",))
+        localCur.execute("DELETE FROM macHostname WHERE expires IS NOT NULL AND expires <= ?", (unStamp,))
+        laDB.commit()
+    except Exception as e:
+        laDB.rollback()
+        print(e)
+
+
+
 def hostnameUpdateWorker(stop_event):
-    diskDBworker = sqlite3.connect("/ramdisk/snmpqserver.db", isolation_level=None)
-    diskDBworker.execute("PRAGMA journal_mode=WAL;")
-    diskDBworker.execute("PRAGMA synchronous=NORMAL;")
+    diskDBworker = funciones.conectarDB()
     localCur = diskDBworker.cursor()
     
     
     # worker lives in an endless LOOP.
-    ### 1. Operation check ###
+    # DHCP lease files are followed incrementally. Only the IPs that are new in arp, changed MAC,
+    # or whose cached answer expired are asked on the network (see hostnames.py).
+    # NetBIOS answers live HOSTNAME_TTL seconds, DNS answers live what the record says.
+    # Hosts that don't answer are not asked again for HOSTNAME_NEGATIVE_TTL (NXDOMAIN: the SOA's negative TTL).
 
+    memoriaWorker = memoria.Contabilidad("hostnames")
     while not stop_event.is_set():
+        elLog.refrescar()
         try:
+            memoriaWorker.configurar(funciones.leerDBenSQL(diskDBworker, "MEMORY_TRACE") == "1")
+            memoriaWorker.cortarCada(60)
             laRedLocal = funciones.leerDBenSQL(diskDBworker, "NETWORK")
             maskbits = funciones.leerDBenSQL(diskDBworker, "MASKBITS")
-            losHosts = []
-            comando = "nbtscan -t 500 -l -q "+laRedLocal+"/"+maskbits
-            proceso2 = subprocess.Popen(comando, shell=True, close_fds=True, stdout=PIPE)
-            resultado = proceso2.communicate()[0]
-            losHostnames = resultado
-            losHostnames = losHostnames.splitlines()
-            for unHostLinea in losHostnames:
-                unHostLinea = unHostLinea.decode("utf-8")
-                unHostLinea = unHostLinea.strip()
-                unMatch = nbtscan_regex.match(unHostLinea)
-                if unMatch:
-                    unaIP, unHostname = unMatch.groups()
-                    losHosts.append((unaIP,unHostname),)
-            # We've got a list with hosts and IPs.
-            unStamp = time.time()
-            try:
-                localCur.execute("BEGIN")
-                for unPar in losHosts:
-                    localCur.execute("DELETE FROM hostname WHERE ipaddr = ?", (unPar[0],))
-                    localCur.execute("INSERT INTO hostname VALUES (?,?,?)", (unStamp,unPar[0],unPar[1]))
-                diskDBworker.commit()
-            except Exception as e:
-                diskDBworker.rollback()
-                print(e)
+            laRed = ipaddress.ip_network(laRedLocal+"/"+maskbits, strict=False)
+            ttlPositivo = funciones.leerDBenSQLnum(diskDBworker, "HOSTNAME_TTL", 3600)
+            ttlNegativo = funciones.leerDBenSQLnum(diskDBworker, "HOSTNAME_NEGATIVE_TTL", 300)
+            elLote = int(funciones.leerDBenSQLnum(diskDBworker, "HOSTNAME_BATCH", 256))
+            hayTrabajo = False
+            # 0. DHCP lease files (no network traffic at all).
+            archivosDHCP = funciones.leerDBenSQL(diskDBworker, "DHCP_LEASES")
+            if( archivosDHCP ):
+                procesarLeasesDHCP(diskDBworker, archivosDHCP, ttlPositivo)
+            vencerMacHostname(diskDBworker)
+            # 1. NetBIOS.
+            pendientes = hostnamesPendientes(localCur, "netbios", laRed, elLote)
+            if( len(pendientes) > 0 ):
+                hayTrabajo = True
+                losNombres = hostnames.resolverNetbios(list(pendientes))
+                resultados = {unaIP: (unHostname, None) for unaIP, unHostname in losNombres.items()}
+                guardarHostnames(diskDBworker, "netbios", pendientes, resultados, ttlPositivo, ttlNegativo)
+            # 2. Reverse DNS (PTR), unless DNS_PTR=0.
+            if( funciones.leerDBenSQL(diskDBworker, "DNS_PTR") != "0" ):
+                servidores = hostnames.servidoresDNS(funciones.leerDBenSQL(diskDBworker, "DNS_SERVERS"))
+                pendientes = hostnamesPendientes(localCur, "dns", laRed, elLote)
+                if( (len(pendientes) > 0) and (len(servidores) > 0) ):
+                    hayTrabajo = True
+                    ttlMinimo = funciones.leerDBenSQLnum(diskDBworker, "DNS_MIN_TTL", 60)
+                    losNombres = hostnames.resolverPTR(list(pendientes), servidores)
+                    resultados = {}
+                    for unaIP, respuesta in losNombres.items():
+                        if( respuesta is None ):
+                            # Timeout / SERVFAIL: negative for HOSTNAME_NEGATIVE_TTL.
+                            resultados[unaIP] = (None, None)
+                        else:
+                            resultados[unaIP] = respuesta
+                    guardarHostnames(diskDBworker, "dns", pendientes, resultados, ttlPositivo, ttlNegativo, ttlMinimo)
+            if( not hayTrabajo ):
+                time.sleep(2)
+        except Exception as e:
+            print(e)
             time.sleep(2)
-        except Exception:
-            pass
+
+
+
+def ouiUpdateWorker(stop_event):
+    # Keeps oui/oui.bin (see oui.py) up to date, never in the way of the polling.
+    # 1. With OUI_DOWNLOAD=1 (default) the IEEE registry CSVs in oui/ are downloaded every OUI_REFRESH seconds.
+    #    Without internet the local copies are simply kept.
+    # 2. oui.bin is rebuilt when it's missing or older than the CSVs, and atomically replaced.
+    diskDBworker = funciones.conectarDB()
+    ultimaDescarga = 0
+    while not stop_event.is_set():
+        elLog.refrescar()
+        try:
+            intervalo = funciones.leerDBenSQLnum(diskDBworker, "OUI_REFRESH", 86400)
+            if( (funciones.leerDBenSQL(diskDBworker, "OUI_DOWNLOAD") != "0") and ((time.time() - ultimaDescarga) > intervalo) ):
+                ultimaDescarga = time.time()
+                actualizados = oui.descargar(str(funciones.OUI_DIR))
+                loguear("ouiUpdateWorker: "+str(actualizados)+" registros IEEE descargados.")
+            if( oui.necesitaReconstruir(str(funciones.OUI_DIR), str(funciones.OUI_BIN)) ):
+                cantidad = oui.construir(str(funciones.OUI_DIR), str(funciones.OUI_BIN))
+                if( cantidad is not None ):
+                    loguear("ouiUpdateWorker: oui.bin reconstruido, "+str(cantidad)+" prefijos.")
+        except Exception as e:
+            loguear("ouiUpdateWorker: "+str(e))
+        stop_event.wait(60)
 
 
 
@@ -1544,8 +2102,9 @@ def hostnameUpdateWorker(stop_event):
 # ---------------------------------------------------------------------------------------------------------------------
 
 def testearRequerimientos():
-    if shutil.which("nbtscan") is None:
-        print("ERROR: nbtscan no está instalado y es necesario para resolucion de nombres.")
+    # NetBIOS names are resolved natively (hostnames.py), nbtscan is no longer needed.
+    if shutil.which("snmpbulkwalk") is None:
+        print("ERROR: snmpbulkwalk (net-snmp) no está instalado y es necesario.")
         sys.exit(1)
 
 
@@ -1600,6 +2159,50 @@ def crearTablas():
             hostname TEXT
         )
     """)
+    # Where the name came from (netbios / dns / ...), see hostnames.PRIORIDAD.
+    funciones.agregarColumna(diskDB, "hostname", "source", "TEXT")
+    # One name per IP. Older databases may have duplicates: keep the newest row.
+    localCur.execute("""
+        DELETE FROM hostname
+        WHERE rowid NOT IN (SELECT MAX(rowid) FROM hostname GROUP BY ipaddr)
+    """)
+    localCur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_hostname_ip
+        ON hostname(ipaddr)
+    """)
+    # Resolver cache, per IP and source. NULL hostname = negative answer, asked again after "expires".
+    localCur.execute("""
+        CREATE TABLE IF NOT EXISTS hostnameCache (
+            ipaddr TEXT,
+            source TEXT,
+            macaddr TEXT,
+            hostname TEXT,
+            stamp TEXT,
+            expires TEXT,
+            PRIMARY KEY (ipaddr, source)
+        )
+    """)
+    # MAC -> hostname, from sources that know the device rather than the IP (DHCP leases).
+    localCur.execute("""
+        CREATE TABLE IF NOT EXISTS macHostname (
+            macaddr TEXT PRIMARY KEY,
+            hostname TEXT,
+            source TEXT,
+            stamp TEXT,
+            expires REAL
+        )
+    """)
+    # End of the lease (NULL: unknown, kept until the lease is released). See vencerMacHostname.
+    funciones.agregarColumna(diskDB, "macHostname", "expires", "REAL")
+    # How far each DHCP lease file was read (see procesarLeasesDHCP).
+    localCur.execute("""
+        CREATE TABLE IF NOT EXISTS dhcpLeaseState (
+            archivo TEXT,
+            inode TEXT,
+            offset TEXT,
+            stamp TEXT
+        )
+    """)
     localCur.execute("""
         CREATE TABLE IF NOT EXISTS switch (
             stamp TEXT,
@@ -1619,6 +2222,8 @@ def crearTablas():
             unPuerto TEXT
         )
     """)
+    # Vendor stored at ingest (VENDOR_AT_INGEST=1), so big reports don't have to look it up.
+    funciones.agregarColumna(diskDB, "macaddress", "elVendor", "TEXT")
     localCur.execute("""
         CREATE TABLE IF NOT EXISTS switchHijosPadre (
             stamp TEXT,
@@ -1627,12 +2232,6 @@ def crearTablas():
             switchHijo TEXT
         )
     """)
-    localCur.execute("""
-        CREATE TABLE IF NOT EXISTS vendor (
-            halfMac TEXT,
-            elVendor TEXT
-        )
-    """)
     localCur.execute("""
         CREATE TABLE IF NOT EXISTS siteData (
             parametro TEXT,
@@ -1654,6 +2253,40 @@ def crearTablas():
             isRoot TEXT
         )
     """)
+    # LLDP/CDP neighbors, cached per switch (see fetch_neighbors / guardarVecinos).
+    localCur.execute("""
+        CREATE TABLE IF NOT EXISTS neighborCache (
+            stamp TEXT,
+            switchIP TEXT,
+            localPort TEXT,
+            remoteSwitchIP TEXT,
+            remoteIP TEXT,
+            remotePort TEXT,
+            remoteName TEXT,
+            protocolo TEXT
+        )
+    """)
+    # Path from every switch up to the Root (closure table, see funciones.rebuildSwitchPaths).
+    localCur.execute("""
+        CREATE TABLE IF NOT EXISTS switchPath (
+            switchIP TEXT,
+            ancestorIP TEXT,
+            depth INTEGER,
+            portPadre TEXT,
+            rootPort TEXT
+        )
+    """)
+    localCur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_switchPath
+        ON switchPath(switchIP, depth)
+    """)
+    localCur.execute("""
+        CREATE TABLE IF NOT EXISTS switchPathMeta (
+            firma TEXT,
+            rootSwitch TEXT,
+            stamp TEXT
+        )
+    """)
     
 
 
@@ -1661,8 +2294,7 @@ def crearTablas():
 # ---------------------------------------------------------------------------------------------------------------------
 
 
-def crearTablasHistoricas(histDB):
-    localCur = histDB.cursor()
+def crearTablasHistoricas():
     
     # Tables for NETFLOW data!
     diskCur.execute("""
@@ -1692,72 +2324,8 @@ def crearTablasHistoricas(histDB):
         )
     """)
     
-    localCur.execute("""
-        CREATE TABLE IF NOT EXISTS arp (
-            stamp TEXT,
-            ifNameA TEXT,
-            laVlan TEXT,
-            ipaddr TEXT,
-            macaddr TEXT
-        )
-    """)
-    localCur.execute("""
-        CREATE TABLE IF NOT EXISTS hostname (
-            stamp TEXT,
-            ipaddr TEXT,
-            hostname TEXT
-        )
-    """)
-    localCur.execute("""
-        CREATE TABLE IF NOT EXISTS switch (
-            stamp TEXT,
-            switchIP TEXT,
-            switchMAC TEXT,
-            switchDesc TEXT,
-            switchStatus TEXT
-        )
-    """)
-    localCur.execute("""
-        CREATE TABLE IF NOT EXISTS macaddress (
-            stamp TEXT,
-            switchIP TEXT,
-            unaVLAN TEXT,
-            unaMAC TEXT,
-            unPuerto TEXT
-        )
-    """)
-    localCur.execute("""
-        CREATE TABLE IF NOT EXISTS switchHijosPadre (
-            stamp TEXT,
-            switchPadre TEXT,
-            portPadre TEXT,
-            switchHijo TEXT
-        )
-    """)
-    localCur.execute("""
-        CREATE TABLE IF NOT EXISTS siteData (
-            stamp TEXT,
-            parametro TEXT,
-            valor TEXT
-        )
-    """)
-    localCur.execute("""
-        CREATE TABLE IF NOT EXISTS accessPoints (
-            stamp TEXT,
-            apMac TEXT,
-            apNombre TEXT
-        )
-    """)
-    localCur.execute("""
-        CREATE TABLE IF NOT EXISTS switchPort (
-            stamp TEXT,
-            switchIP TEXT,
-            portNum TEXT,
-            portDesc TEXT,
-            portType TEXT,
-            isRoot TEXT
-        )
-    """)
+    # History is kept as validity intervals in time partitions, see historico.py.
+    historico.abrirCatalogo(str(histDir)).close()
     
 
 
@@ -1800,6 +2368,62 @@ def ARPrefresh():
 # ---------------------------------------------------------------------------------------------------------------------
 
 
+def registrarPoll(result):
+    # Poll metrics of one fetch_oid_fast result (see metricas.py).
+    mPoll.observe(result[1], switch=result[0])
+    if(result[2] == -1):
+        mTimeouts.inc(switch=result[0])
+    elif(result[2] == -2):
+        mFallas.inc(switch=result[0])
+    if(result[3] is not None):
+        for fase, segundos in result[3]["fases"].items():
+            mFase.observe(segundos, phase=fase)
+        mEstrategia.inc(result=result[3]["estrategia"])
+
+
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------
+
+
+
+def fetch_oid_medido(parametros):
+    # fetch_oid_fast plus this pool worker's memory report (pool-<pid>.json) after each switch.
+    global memoriaPool
+    result = fetch_oid_fast(parametros)
+    if(memoriaPool is None):
+        memoriaPool = memoria.Contabilidad("pool-"+str(os.getpid()))
+    memoriaPool.cortar()
+    return result
+
+
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------
+
+
+
+def trazarPoll(traza, spanPool, result, llegada):
+    # The poll ran inside a pool worker: its span ends when the result arrived here and lasts result[1].
+    # The fetch_oid_fast phases go under it, one after the other. Returns the switch span id.
+    inicio = llegada - result[1]
+    spanSwitch = traza.agregar(result[0], "switch", inicio, result[1], spanPool)
+    if(result[3] is not None):
+        for fase, segundos in result[3]["fases"].items():
+            traza.agregar(fase, "phase", inicio, segundos, spanSwitch)
+            inicio = inicio + segundos
+    return spanSwitch
+
+
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------
+
+
+
 def updateSwitchStatus(result):
     unStamp = time.time()
     switchOffline = 0
@@ -1847,10 +2471,15 @@ def procesarMacAddresses(result):
         # preparo las MACs.
         macInserts = []
         switchPortInserts = []
+        conVendor = ( funciones.leerDBenSQL(diskDB, "VENDOR_AT_INGEST") == "1" )
         for unRow in result[2]:
             # [vlan][mac][unPort][portDesc]
-            # [stamp][switchip][vlan][mac][unPort]
-            macInserts.append((unStamp,result[0],) + (unRow[0], unRow[1], unRow[2]))
+            # [stamp][switchip][vlan][mac][unPort][vendor]
+            if( conVendor ):
+                elVendor = funciones.macVendor(unRow[1])
+            else:
+                elVendor = None
+            macInserts.append((unStamp,result[0],) + (unRow[0], unRow[1], unRow[2], elVendor))
             # [switchip][unPort][portDesc]
             switchPortInserts.append((result[0],) + (unRow[2], unRow[3]))
         # Temp table:
@@ -1877,8 +2506,8 @@ def procesarMacAddresses(result):
             localCur.execute(elQuery)
             #
             localCur.executemany("""
-                INSERT INTO macaddress (stamp, switchIP, unaVLAN, unaMAC, unPuerto)
-                VALUES (?, ?, ?, ?, ?)
+                INSERT INTO macaddress (stamp, switchIP, unaVLAN, unaMAC, unPuerto, elVendor)
+                VALUES (?, ?, ?, ?, ?, ?)
             """, macInserts)
             #
             localCur.executemany("""
@@ -1903,6 +2532,8 @@ def portTypeUpdater():
     localCur = diskDB.cursor()
     laGatewayMAC = funciones.getGatewayMAC(diskDB)
     elBypassString = None
+    switchBypass = None
+    portBypass = None
     elBypassString = funciones.leerDBenSQL(diskDB,"bypass")
     if(elBypassString is not None):
         switchBypass,portBypass = extraerVariable(elBypassString)
@@ -1928,6 +2559,11 @@ def portTypeUpdater():
                         FROM switch 
                     )
                 ) THEN 'TRUNK'
+                WHEN (switchIP, portNum) IN (
+                    SELECT switchIP, localPort
+                    FROM neighborCache
+                    WHERE remoteSwitchIP IS NOT NULL
+                ) THEN 'TRUNK'
                 WHEN (switchIP = ? AND portNum = ?) THEN 'TRUNK'
                 ELSE 'ACCESS'
             END;
@@ -1945,72 +2581,59 @@ def portTypeUpdater():
 def persitirHistoricos(diskDB):
     global lastHistoric
     localCur = diskDB.cursor()
-    #
+    # Every HISTORY_PERIOD seconds, the current state is merged into the history intervals (see historico.py):
+    # what is still there gets its last_seen extended, only what changed is inserted.
+    # Something missing for more than HISTORY_GAP seconds starts a new interval when it comes back.
     ahora = time.time()
-    if( (ahora - lastHistoric) < histDBperiod ):
+    periodo = funciones.leerDBenSQLnum(diskDB, "HISTORY_PERIOD", histDBperiod)
+    if( (ahora - lastHistoric) < periodo ):
         return
+    tolerancia = funciones.leerDBenSQLnum(diskDB, "HISTORY_GAP", 3 * periodo)
     lastHistoric = ahora
+    modo = funciones.leerDBenSQL(diskDB, "HISTORY_PARTITION")
+    if( modo != "week" ):
+        modo = "day"
     try:
-        localCur.execute("ATTACH DATABASE ? AS history", (str(histDBPath),) )
-        localCur.execute("BEGIN")
-        # ARP table
-        localCur.execute("""
-            INSERT INTO history.arp (stamp, ifNameA, laVlan, ipaddr, macaddr)
-            SELECT ?, ifNameA, laVlan, ipaddr, macaddr
-            FROM main.arp
-        """, (str(ahora),) )
-        
-        # hostname table
-        localCur.execute("""
-            INSERT INTO history.hostname (stamp, ipaddr, hostname)
-            SELECT ?, ipaddr, hostname
-            FROM main.hostname
-        """, (str(ahora),) )
-        # switch table
-        localCur.execute("""
-            INSERT INTO history.switch (stamp, switchIP, switchMAC, switchDesc, switchStatus)
-            SELECT ?, switchIP, switchMAC, switchDesc, switchStatus
-            FROM main.switch
-        """, (str(ahora),) )
-        # macaddress table
-        localCur.execute("""
-            INSERT INTO history.macaddress (stamp, switchIP, unaVLAN, unaMac, unPuerto)
-            SELECT ?, switchIP, unaVLAN, unaMac, unPuerto
-            FROM main.macaddress
-        """, (str(ahora),) )
-        # switchHijosPadre table
-        localCur.execute("""
-            INSERT INTO history.switchHijosPadre (stamp, switchPadre, portPadre, switchHijo)
-            SELECT ?, switchPadre, portPadre, switchHijo
-            FROM main.switchHijosPadre
-        """, (str(ahora),) )
-        # siteData table
-        localCur.execute("""
-            INSERT INTO history.siteData (stamp, parametro, valor)
-            SELECT ?, parametro, valor
-            FROM main.siteData
-        """, (str(ahora),) )
-        # accessPoints table
-        localCur.execute("""
-            INSERT INTO history.accessPoints (stamp, apMac, apNombre)
-            SELECT ?, apMac, apNombre
-            FROM main.accessPoints
-        """, (str(ahora),) )
-        # switchPort table
-        localCur.execute("""
-            INSERT INTO history.switchPort (stamp, switchIP, portNum, portDesc, portType, isRoot)
-            SELECT ?, switchIP, portNum, portDesc, portType, isRoot
-            FROM main.switchPort
-        """, (str(ahora),) )
-        diskDB.commit()
-        localCur.execute("DETACH DATABASE history")
+        laParticion = historico.particionActual(str(histDir), ahora, modo)
+        localCur.execute("ATTACH DATABASE ? AS history", (laParticion,) )
+        try:
+            localCur.execute("BEGIN")
+            resumen = historico.registrarCiclo(localCur, ahora, tolerancia)
+            diskDB.commit()
+            unLog = "persitirHistoricos:"
+            for tabla, (extendidos, nuevos) in resumen.items():
+                unLog = unLog + " " + tabla + "=" + str(extendidos) + "/+" + str(nuevos)
+            stackear(unLog)
+        except Exception:
+            diskDB.rollback()
+            raise
+        finally:
+            localCur.execute("DETACH DATABASE history")
     except Exception as e:
-        diskDB.rollback()
         print(e)
         traceback.print_exc()
+    historicosMantenimiento(diskDB)
 
 
 
+def historicosMantenimiento(diskDB):
+    global lastHistMantenimiento
+    # Once an hour: whole partitions older than HISTORY_RETENTION_DAYS are deleted,
+    # the ones older than HISTORY_COMPRESS_DAYS are compacted and lzma compressed.
+    ahora = time.time()
+    if( (ahora - lastHistMantenimiento) < 3600 ):
+        return
+    lastHistMantenimiento = ahora
+    retencion = funciones.leerDBenSQLnum(diskDB, "HISTORY_RETENTION_DAYS", 90)
+    comprimir = funciones.leerDBenSQLnum(diskDB, "HISTORY_COMPRESS_DAYS", 2)
+    try:
+        borradas, comprimidas = historico.mantenimiento(str(histDir), ahora, retencion, comprimir)
+        if( (borradas > 0) or (comprimidas > 0) ):
+            loguear("historicosMantenimiento: "+str(borradas)+" particiones borradas, "+str(comprimidas)+" comprimidas.")
+    except Exception as e:
+        loguear("historicosMantenimiento: "+str(e))
+        loguear(traceback.format_exc())
+
 
 
 
@@ -2081,25 +2704,22 @@ def persitirHistoricos(diskDB):
 if __name__ == "__main__":
     testearRequerimientos()
     #
-    diskDB = sqlite3.connect("/ramdisk/snmpqserver.db", isolation_level=None)
-    diskDB.execute("PRAGMA journal_mode=WAL;")
-    diskDB.execute("PRAGMA synchronous=NORMAL;")
+    diskDB = funciones.conectarDB()
     diskCur = diskDB.cursor()
     #
-    histDB = sqlite3.connect(histDBPath, isolation_level=None)
-    crearTablasHistoricas(histDB)
+    crearTablasHistoricas()
     # We attempt to create the database and tables.
     crearTablas()
     if(global_offline == 0):
         leerPreferencias()
     global_community = funciones.leerDBenSQL(diskDB, "community")
-    # updating the VENDORS table
-    if( not os.path.exists("/ramdisk/index.html") ):
-        funciones.updateVendors(diskDB)
     # Starting an endless hostname updater process, completely independant.
     stop_event = multiprocessing.Event()
     process_hostnames = multiprocessing.Process(target=hostnameUpdateWorker, args=(stop_event,),)
     process_hostnames.start()
+    # Vendor file (oui.bin) is refreshed in the background too. Until it exists, vendors are just empty.
+    process_oui = multiprocessing.Process(target=ouiUpdateWorker, args=(stop_event,),)
+    process_oui.start()
     # ---#---#---#---#---#---#---#---#---#---#---#---#---#---#---#---#---#---#---#---#
     concurrentes = 10
     tiempoAnterior = 0
@@ -2115,41 +2735,84 @@ if __name__ == "__main__":
     while( ((time.time() - startingTime) < runtime_secs ) and (haltFlag == 0) ):
         # MAIN LOOP
         inicio = time.time()
+        # Spans of this cycle (stages, switches, phases), saved to /ramdisk/trazas.db at the end. See trazas.py.
+        traza = trazas.Traza()
+        # Profiling, when asked for (SIGUSR1 or the web UI).
+        ciclosPerfil = int(funciones.leerDBenSQLnum(diskDB, "PROFILE_CYCLES", 3))
+        elPerfil.pedir(perfilador.leerPedido("core"))
+        if perfilPorSenal:
+            perfilPorSenal = False
+            elPerfil.pedir(ciclosPerfil)
+        tokenPerfil = elPerfil.iniciar()
         # We read the preferences file to get settings, switches, APs, etc.
         if(global_offline == 0):
-            leerPreferencias()
+            with traza.span("leerPreferencias"):
+                leerPreferencias()
+        # Logging on/off (logging.enabled) and rotation, once per cycle. SIGHUP applies it immediately.
+        elLog.refrescar()
+        elLog.configurar(funciones.leerDBenSQLnum(diskDB, "LOG_MAX_BYTES", 10485760), funciones.leerDBenSQLnum(diskDB, "LOG_BACKUPS", 3))
         # HOSTS = getSwitchesAll(diskDB)
         HOSTS = funciones.get_SWITCHES_with_STRATS(diskDB)
+        # Picks up a rebuilt vendor file, if ouiUpdateWorker replaced it.
+        funciones.cargarVendores()
         # We fetch the ARP Table from the router and update the switches' MAC addresses.
         if(global_offline == 0):
-            ARPrefresh()
+            with traza.span("ARPrefresh"):
+                ARPrefresh()
         if(len(HOSTS)==0):
             print("No hay switches en el sistema, verifique snmpQuery.ini")
             sys.exit(0)
         #
         # MULTIPROCESSING POOL for SNMP walks.
         if(global_offline == 0):    
-            with Pool(processes=concurrentes) as pool:
-                for result in pool.imap_unordered(fetch_oid_fast, HOSTS):
+            # Workers are new every cycle (and inherit tracemalloc from here): last cycle's reports go.
+            memoria.borrar("pool-*")
+            # They must not inherit the profiler either: it is paused while they are forked.
+            elPerfil.pausar(tokenPerfil)
+            pool = Pool(processes=concurrentes)
+            elPerfil.reanudar(tokenPerfil)
+            with pool, traza.span("pool") as spanPool:
+                for result in pool.imap_unordered(fetch_oid_medido, HOSTS):
                     # result = [switchIP][time][ dataTable ][moreTimes][strategy]
+                    registrarPoll(result)
+                    t0 = time.time()
+                    spanSwitch = trazarPoll(traza, spanPool, result, t0)
                     # Update switches ONLINE/OFFLINE status.
                     updateSwitchStatus(result)
+                    t1 = time.time()
                     procesarMacAddresses(result)
                     if(result[4] is not None):
                         funciones.setStrategy(diskDB, result[4])
+                    t2 = time.time()
+                    mTransaccion.observe(t1 - t0, stage="switch_status")
+                    mTransaccion.observe(t2 - t1, stage="macaddress")
+                    traza.agregar("procesarMacAddresses", "db", t0, t2 - t0, spanSwitch)
                     #
+                # LLDP/CDP neighbors (optional). Only the switches whose cache expired are walked.
+                if( funciones.leerDBenSQL(diskDB, "NEIGHBORS") == "1" ):
+                    with traza.span("vecinos", padre=spanPool):
+                        for resultVecinos in pool.imap_unordered(fetch_neighbors, vecinosPendientes(HOSTS)):
+                            guardarVecinos(resultVecinos)
         # Now that we've got MACs and Ports for all switches, we can update switchPort
         # with ACCESS/TRUNK [ROOT] data.
         try:
-            switchMapper()
+            with traza.span("switchMapper"):
+                elRootSwitch = switchMapper()
+            # Materialized path-to-root (switchPath). Only rebuilt if the topology changed.
+            with traza.span("rebuildSwitchPaths"):
+                if( funciones.rebuildSwitchPaths(diskDB, elRootSwitch) ):
+                    stackear("switchPath reconstruida.")
         except Exception as e:
             loguear("Problema con switchMapper. Pongo haltFlag en 1.")
             loguear(str(e))
             loguear(traceback.format_exc())
             haltFlag = 1
             continue
-        # HISTORICOS! not in use right now. Can be commented out.
-        persitirHistoricos(diskDB)
+        # HISTORICOS: validity intervals, see historico.py.
+        t0 = time.time()
+        with traza.span("persitirHistoricos"):
+            persitirHistoricos(diskDB)
+        mTransaccion.observe(time.time() - t0, stage="history")
         #
         fin = time.time()
         global_stats_switches = funciones.countSwitchesOnline(diskDB)
@@ -2202,6 +2865,26 @@ if __name__ == "__main__":
             concurrentes = 100
         tiempoAnterior = tiempoCiclo
         estadisticas = "tiempoBruto: "+str(fin-inicio)
+        mCiclo.observe(tiempoCiclo)
+        mConcurrentes.set(concurrentes)
+        mSegundosSwitch.set(global_stats_perf)
+        mSwitchesOnline.set(global_stats_switches)
+        try:
+            registro.volcar()
+        except OSError:
+            pass
+        try:
+            trazas.guardar(traza, int(funciones.leerDBenSQLnum(diskDB, "TRACE_KEEP", 50)))
+        except Exception as e:
+            loguear("trazas.guardar: "+str(e))
+        memoriaCore.cortar()
+        memoriaCore.configurar(funciones.leerDBenSQL(diskDB, "MEMORY_TRACE") == "1")
+        try:
+            rutaPerfil = elPerfil.finalizar(tokenPerfil)
+            if(rutaPerfil is not None):
+                loguear("Perfil escrito: "+rutaPerfil)
+        except Exception as e:
+            loguear("perfilador: "+str(e))
         # - - - - - - - - - - - - - - - - - -
         # - - - - - - - - - - - - - - - - - - 
         if(elTTL == 0):
@@ -2223,6 +2906,7 @@ if __name__ == "__main__":
 
 stop_event.set()
 process_hostnames.join()
+process_oui.join()
 time.sleep(0.5)
 try:
     os.remove(archivoControl)
@@ -2230,6 +2914,7 @@ except Exception:
     pass
 print("END.")
 loguear("END.")
+elLog.cerrar()
 # DEBUG. printing the debug stack:
 for cosita in elStack:
     print(cosita)
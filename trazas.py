@@ -0,0 +1,150 @@
+"""
+Cycle Traces
+Each daemon cycle records a tree of spans (stage, switch, phase) in memory
+and saves it at the end of the cycle, in one transaction, to a small SQLite
+file on the ramdisk that only keeps the last cycles. The web server reads it
+for the /traces waterfall and the slowest switches/phases.
+
+Recording a span is two clock reads and a tuple, so it stays on.
+
+SnmpQuery - Network Discovery and Monitoring Tool
+Copyright (C) 2025 Agustin Garcia Maiztegui
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+"""
+
+import sqlite3
+import time
+from contextlib import contextmanager
+
+RUTA_TRAZAS = "/ramdisk/trazas.db"
+
+
+class Traza:
+    """Spans of one cycle: (id, parent id, name, kind, start, duration)."""
+
+    def __init__(self):
+        self.inicio = time.time()
+        self.spans = []
+
+    @contextmanager
+    def span(self, nombre, tipo="stage", padre=None):
+        """Times the `with` block. Yields the span id, to hang children from it."""
+        idSpan = len(self.spans)
+        self.spans.append(None)
+        inicio = time.time()
+        try:
+            yield idSpan
+        finally:
+            self.spans[idSpan] = (idSpan, padre, nombre, tipo, inicio, time.time() - inicio)
+
+    def agregar(self, nombre, tipo, inicio, duracion, padre=None):
+        """A span measured somewhere else (e.g. inside a pool worker). Returns its id."""
+        idSpan = len(self.spans)
+        self.spans.append((idSpan, padre, nombre, tipo, inicio, duracion))
+        return idSpan
+
+
+# ============================================================================
+# STORE
+# ============================================================================
+
+def abrir(ruta=RUTA_TRAZAS):
+    laDB = sqlite3.connect(ruta, isolation_level=None, timeout=5)
+    laDB.execute("PRAGMA journal_mode=WAL;")
+    laDB.execute("""
+        CREATE TABLE IF NOT EXISTS ciclos (
+            ciclo INTEGER PRIMARY KEY,
+            inicio REAL,
+            duracion REAL
+        )
+    """)
+    laDB.execute("""
+        CREATE TABLE IF NOT EXISTS spans (
+            ciclo INTEGER,
+            id INTEGER,
+            padre INTEGER,
+            nombre TEXT,
+            tipo TEXT,
+            inicio REAL,
+            duracion REAL,
+            PRIMARY KEY (ciclo, id)
+        )
+    """)
+    laDB.execute("CREATE INDEX IF NOT EXISTS idx_spans_tipo ON spans (tipo, duracion)")
+    return laDB
+
+
+def guardar(traza, conservar=50, ruta=RUTA_TRAZAS):
+    """Saves a finished cycle and drops all but the last `conservar` ones."""
+    fin = time.time()
+    laDB = abrir(ruta)
+    try:
+        laDB.execute("BEGIN")
+        ciclo = laDB.execute(
+            "INSERT INTO ciclos (inicio, duracion) VALUES (?, ?)", (traza.inicio, fin - traza.inicio)
+        ).lastrowid
+        laDB.executemany(
+            "INSERT INTO spans (ciclo, id, padre, nombre, tipo, inicio, duracion) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(ciclo,) + span for span in traza.spans if span is not None],
+        )
+        laDB.execute("DELETE FROM spans WHERE ciclo <= ?", (ciclo - conservar,))
+        laDB.execute("DELETE FROM ciclos WHERE ciclo <= ?", (ciclo - conservar,))
+        laDB.execute("COMMIT")
+    except Exception:
+        laDB.execute("ROLLBACK")
+        raise
+    finally:
+        laDB.close()
+
+
+def ultimosCiclos(cantidad=10, ruta=RUTA_TRAZAS):
+    """
+    [{ciclo, inicio, duracion, spans: [(id, padre, nombre, tipo, offset, duracion, profundidad)]}],
+    newest first. Spans come in tree order (each one right after its parent), offset is from the cycle start.
+    """
+    laDB = abrir(ruta)
+    try:
+        ciclos = laDB.execute(
+            "SELECT ciclo, inicio, duracion FROM ciclos ORDER BY ciclo DESC LIMIT ?", (cantidad,)
+        ).fetchall()
+        devolver = []
+        for ciclo, inicio, duracion in ciclos:
+            hijos = {}
+            for fila in laDB.execute(
+                "SELECT id, padre, nombre, tipo, inicio, duracion FROM spans WHERE ciclo = ? ORDER BY inicio, id",
+                (ciclo,),
+            ):
+                hijos.setdefault(fila[1], []).append(fila)
+            ordenados = []
+            pendientes = [(fila, 0) for fila in reversed(hijos.get(None, []))]
+            while pendientes:
+                fila, profundidad = pendientes.pop()
+                ordenados.append(fila[:4] + (fila[4] - inicio, fila[5], profundidad))
+                pendientes.extend((hijo, profundidad + 1) for hijo in reversed(hijos.get(fila[0], [])))
+            devolver.append({"ciclo": ciclo, "inicio": inicio, "duracion": duracion, "spans": ordenados})
+        return devolver
+    finally:
+        laDB.close()
+
+
+def masLentos(tipo, cantidad=10, ruta=RUTA_TRAZAS):
+    """[(nombre, average, max, times seen)] of one kind of span over the stored cycles, slowest average first."""
+    laDB = abrir(ruta)
+    try:
+        return laDB.execute(
+            """
+            SELECT nombre, AVG(duracion), MAX(duracion), COUNT(*)
+            FROM spans
+            WHERE tipo = ?
+            GROUP BY nombre
+            ORDER BY AVG(duracion) DESC
+            LIMIT ?
+            """,
+            (tipo, cantidad),
+        ).fetchall()
+    finally:
+        laDB.close()